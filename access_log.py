@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+访问日志模块
+每个连接（UDP为每个会话）结束时记录一条JSON访问记录：客户端、规则、上游、收发字节数、持续时间和关闭原因。
+转发线程只做采样、限速判断并把记录放入有界队列（QueueHandler），
+格式化和写文件（RotatingFileHandler）由QueueListener的后台线程完成，队列满时丢弃记录而不阻塞转发。
+未配置日志文件时不记录访问日志，也不启动后台线程。
+"""
+
+import os
+import json
+import queue
+import random
+import threading
+import time
+import logging
+import logging.handlers
+from typing import Optional
+from rate_limit import TokenBucket
+from dual_stack import format_address
+
+# 关闭原因
+REASON_CLOSED = 'closed'
+REASON_IDLE_TIMEOUT = 'idle_timeout'
+REASON_CONNECT_FAILED = 'connect_failed'
+REASON_RATE_LIMITED = 'rate_limited'
+REASON_EVICTED = 'evicted'
+REASON_ERROR = 'error'
+# 停止规则或排空超时时被强制关闭
+REASON_ABORTED = 'aborted'
+
+# 单个日志文件的最大字节数和保留的历史文件数
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+# 每秒最多写入的访问记录数（0表示不限），突发上限为1秒的量
+DEFAULT_ACCESS_LOG_RATE = 200
+# 等待写入的记录数上限，超过时丢弃新记录
+DEFAULT_QUEUE_SIZE = 10000
+
+
+class JsonFormatter(logging.Formatter):
+    """把访问记录格式化为一行JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) +
+                  f'.{int(record.msecs):03d}'}
+        fields.update(record.msg)
+        return json.dumps(fields, ensure_ascii=False)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃记录的QueueHandler；记录原样入队，格式化留给后台线程"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> bool:
+        """放入队列，队列满时返回False"""
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            return False
+
+
+class _AccessLogListener(logging.handlers.QueueListener):
+    """停止时阻塞等待队列空位放入结束标记（队列满时put_nowait会抛出queue.Full）"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class AccessLogger:
+    """异步、可采样和限速的访问日志"""
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES,
+                 backup_count: int = DEFAULT_BACKUP_COUNT, sample_rate: float = 1.0,
+                 rate: float = DEFAULT_ACCESS_LOG_RATE, queue_size: int = DEFAULT_QUEUE_SIZE):
+        """
+        path为空时不记录；sample_rate为正常关闭的连接被记录的比例，
+        异常关闭（连接失败、空闲超时等）的连接总是记录，所有记录共同受rate限速
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.handler: Optional[_DroppingQueueHandler] = None
+        self.listener: Optional[_AccessLogListener] = None
+        self._target: Optional[logging.Handler] = None
+        if path:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            target = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                          encoding='utf-8', delay=True)
+            target.setFormatter(JsonFormatter())
+            self.handler = _DroppingQueueHandler(queue.Queue(queue_size))
+            self.listener = _AccessLogListener(self.handler.queue, target)
+            self.listener.start()
+            self._target = target
+        self._bucket = TokenBucket(rate) if rate else None
+        # 保护限速桶和计数（多个转发线程同时写访问记录）
+        self._lock = threading.Lock()
+        self.logged = 0
+        self.sampled_out = 0
+        self.rate_limited = 0
+        self.dropped = 0
+
+    def log(self, rule_name: str, client: Optional[tuple], upstream=None, bytes_in: int = 0, bytes_out: int = 0,
+            duration: float = 0.0, reason: str = REASON_CLOSED, error: Optional[str] = None,
+            protocol: str = 'tcp'):
+        """记录一个连接；被采样或限速跳过的记录只计数"""
+        if self.listener is None:
+            return
+        sampled_out = reason == REASON_CLOSED and self.sample_rate < 1.0 and random.random() >= self.sample_rate
+        with self._lock:
+            if sampled_out:
+                self.sampled_out += 1
+                return
+            if self._bucket and not self._bucket.try_consume(1, time.monotonic()):
+                self.rate_limited += 1
+                return
+            self.logged += 1
+
+        fields = {
+            'rule': rule_name,
+            'protocol': protocol,
+            'client': format_address(client[0], client[1]) if client else None,
+            'upstream': str(upstream) if upstream else None,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'duration': round(duration, 3),
+            'reason': reason
+        }
+        if error:
+            fields['error'] = error
+        record = logging.LogRecord('PortForwarder.access', logging.INFO, '', 0, fields, None, None)
+        # 直接入队，不经过Handler.handle（其中的过滤器和RLock对访问记录没有意义）
+        if not self.handler.enqueue(record):
+            with self._lock:
+                self.logged -= 1
+                self.dropped += 1
+
+    def get_stats(self) -> dict:
+        """获取写入、采样跳过、限速跳过和队列满丢弃的记录数"""
+        with self._lock:
+            return {
+                'path': self.path,
+                'logged': self.logged,
+                'sampled_out': self.sampled_out,
+                'rate_limited': self.rate_limited,
+                'dropped': self.dropped,
+                'queued': self.handler.queue.qsize() if self.handler else 0
+            }
+
+    @property
+    def enabled(self) -> bool:
+        """是否正在记录访问日志"""
+        return self.listener is not None
+
+    def close(self):
+        """写完队列中的记录并关闭文件"""
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+            self._target.close()
+
+
+def worker_log_path(path: str, index: int) -> str:
+    """多进程模式下每个工作进程写自己的日志文件（RotatingFileHandler不支持多进程同时写）"""
+    root, ext = os.path.splitext(path)
+    return f'{root}.{index}{ext}'
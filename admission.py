@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+连接准入控制模块
+限制全局和单条规则的并发连接数，并按过载策略处理超出限制的新连接：
+- queue: 放入有界等待队列，有空闲名额时按顺序放行，队列满或等待超时则拒绝；
+  只有同一规则已有排队连接时新连接才需要排队，一条规则满载不影响其他规则的准入
+- reject: 立即以RST拒绝
+- wait: 监听线程最多等待overload_timeout秒，仍无名额则拒绝
+"""
+
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+OVERLOAD_QUEUE = 'queue'
+OVERLOAD_REJECT = 'reject'
+OVERLOAD_WAIT = 'wait'
+OVERLOAD_POLICIES = (OVERLOAD_QUEUE, OVERLOAD_REJECT, OVERLOAD_WAIT)
+
+# queue策略下等待队列的默认长度
+DEFAULT_QUEUE_SIZE = 1024
+# wait策略的等待时间以及queue策略下排队的最长时间（秒）
+DEFAULT_OVERLOAD_TIMEOUT = 5.0
+
+
+def reset_connection(sock: socket.socket):
+    """以RST方式关闭连接（SO_LINGER超时为0）"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    except OSError:
+        pass
+    try:
+        sock.close()
+    except OSError:
+        pass
+
+
+class AdmissionController:
+    """连接准入控制器"""
+
+    def __init__(self, max_connections: int, policy: str = OVERLOAD_QUEUE,
+                 overload_timeout: float = DEFAULT_OVERLOAD_TIMEOUT, queue_size: int = DEFAULT_QUEUE_SIZE):
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"不支持的过载策略: {policy}")
+
+        self.max_connections = max_connections
+        self.policy = policy
+        self.overload_timeout = overload_timeout
+        self.queue_size = queue_size
+        self.active = 0
+        self.active_by_rule: Dict[str, int] = {}
+        self.rejected = 0
+        self.rejected_by_rule: Dict[str, int] = {}
+        # queue策略的等待队列: (规则, 客户端套接字, 客户端地址, 入队时间)
+        self.pending: Deque[Tuple[object, socket.socket, tuple, float]] = deque()
+        # 规则名 -> 该规则在等待队列中的连接数
+        self.pending_by_rule: Dict[str, int] = {}
+        self._cond = threading.Condition()
+        # 清理排队超时连接的线程，队列非空时运行
+        self._expiry_thread: Optional[threading.Thread] = None
+
+    def _can_admit(self, rule) -> bool:
+        """检查全局和规则名额（需持有锁）"""
+        if self.max_connections and self.active >= self.max_connections:
+            return False
+        limit = getattr(rule, 'max_connections', 0)
+        if limit and self.active_by_rule.get(rule.name, 0) >= limit:
+            return False
+        return True
+
+    def _take(self, rule):
+        """占用一个名额（需持有锁）"""
+        self.active += 1
+        self.active_by_rule[rule.name] = self.active_by_rule.get(rule.name, 0) + 1
+
+    def _reject(self, rule, sock: socket.socket):
+        """记录拒绝并重置连接（需持有锁）"""
+        self.rejected += 1
+        self.rejected_by_rule[rule.name] = self.rejected_by_rule.get(rule.name, 0) + 1
+        reset_connection(sock)
+
+    def admit(self, rule, sock: socket.socket, addr: tuple, dispatch: Callable) -> bool:
+        """对新连接执行准入，放行时调用dispatch(rule, sock, addr)，返回是否已放行"""
+        with self._cond:
+            # 同一规则已有连接在排队时按顺序排在其后
+            if self._can_admit(rule) and not self.pending_by_rule.get(rule.name):
+                self._take(rule)
+                admitted = True
+            elif self.policy == OVERLOAD_WAIT:
+                admitted = self._cond.wait_for(lambda: self._can_admit(rule), self.overload_timeout)
+                if admitted:
+                    self._take(rule)
+                else:
+                    self._reject(rule, sock)
+                    return False
+            elif self.policy == OVERLOAD_QUEUE and len(self.pending) < self.queue_size:
+                self.pending.append((rule, sock, addr, time.monotonic()))
+                self.pending_by_rule[rule.name] = self.pending_by_rule.get(rule.name, 0) + 1
+                self._start_expiry()
+                return False
+            else:
+                self._reject(rule, sock)
+                return False
+
+        dispatch(rule, sock, addr)
+        return True
+
+    def release(self, rule, dispatch: Callable):
+        """释放名额，并放行等待队列中可以准入的连接"""
+        ready: List[Tuple[object, socket.socket, tuple]] = []
+        with self._cond:
+            self.active -= 1
+            count = self.active_by_rule.get(rule.name, 0) - 1
+            if count > 0:
+                self.active_by_rule[rule.name] = count
+            else:
+                self.active_by_rule.pop(rule.name, None)
+
+            if self.pending:
+                ready = self._drain_pending()
+            self._cond.notify_all()
+
+        for item in ready:
+            dispatch(*item)
+
+    def _unqueue(self, rule):
+        """减少规则的排队计数（需持有锁）"""
+        count = self.pending_by_rule.get(rule.name, 0) - 1
+        if count > 0:
+            self.pending_by_rule[rule.name] = count
+        else:
+            self.pending_by_rule.pop(rule.name, None)
+
+    def _drain_pending(self) -> List[Tuple[object, socket.socket, tuple]]:
+        """从等待队列中取出可放行的连接，丢弃超时的连接（需持有锁）"""
+        ready = []
+        now = time.monotonic()
+        remaining: Deque = deque()
+        while self.pending:
+            rule, sock, addr, queued_at = self.pending.popleft()
+            if now - queued_at > self.overload_timeout or not getattr(rule, 'is_running', True):
+                self._unqueue(rule)
+                self._reject(rule, sock)
+            elif self._can_admit(rule):
+                self._unqueue(rule)
+                self._take(rule)
+                ready.append((rule, sock, addr))
+            else:
+                remaining.append((rule, sock, addr, queued_at))
+        self.pending = remaining
+        return ready
+
+    def _start_expiry(self):
+        """启动排队超时清理线程（需持有锁）"""
+        if self._expiry_thread is None:
+            self._expiry_thread = threading.Thread(target=self._expiry_loop, name='AdmissionExpiry')
+            self._expiry_thread.daemon = True
+            self._expiry_thread.start()
+
+    def _expiry_loop(self):
+        """按入队顺序拒绝排队超过overload_timeout的连接，不依赖其他连接释放名额；队列清空后退出"""
+        with self._cond:
+            while self.pending:
+                rule, sock, _, queued_at = self.pending[0]
+                wait = queued_at + self.overload_timeout - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                self.pending.popleft()
+                self._unqueue(rule)
+                self._reject(rule, sock)
+            self._expiry_thread = None
+
+    def discard_rule(self, rule_name: str):
+        """规则停止时关闭其等待中的连接"""
+        with self._cond:
+            remaining: Deque = deque()
+            for item in self.pending:
+                if item[0].name == rule_name:
+                    reset_connection(item[1])
+                else:
+                    remaining.append(item)
+            self.pending = remaining
+            self.pending_by_rule.pop(rule_name, None)
+
+    def get_stats(self, rule_name: Optional[str] = None) -> dict:
+        """获取准入统计，用于评估连接数限制"""
+        with self._cond:
+            if rule_name is not None:
+                return {
+                    'active': self.active_by_rule.get(rule_name, 0),
+                    'queued': self.pending_by_rule.get(rule_name, 0),
+                    'rejected': self.rejected_by_rule.get(rule_name, 0)
+                }
+            return {
+                'policy': self.policy,
+                'max_connections': self.max_connections,
+                'active': self.active,
+                'queued': len(self.pending),
+                'rejected': self.rejected,
+                'rejected_by_rule': dict(self.rejected_by_rule)
+            }
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio转发引擎模块
+所有规则和连接共用一个事件循环线程，替代每个方向一个线程的转发方式；
+支持上游连接超时、会话空闲超时和半关闭（一方发送FIN后另一方向继续转发）
+"""
+
+import asyncio
+import socket
+import threading
+import time
+import logging
+from typing import Dict, Optional, Set
+from metrics import MetricsRegistry, BYTES_IN, BYTES_OUT
+from upstream_pool import UpstreamPoolManager
+from balancer import HealthChecker
+from dual_stack import create_listener, DEFAULT_ATTEMPT_DELAY
+from dns_cache import DnsCache
+from access_log import AccessLogger, REASON_CLOSED, REASON_IDLE_TIMEOUT, REASON_CONNECT_FAILED, REASON_RATE_LIMITED, REASON_ERROR, REASON_ABORTED
+
+# 每个连接每个方向的读缓冲大小，同时作为StreamReader的缓冲上限
+DEFAULT_BUFFER_SIZE = 64 * 1024
+# 监听队列长度
+DEFAULT_BACKLOG = 128
+
+
+class AsyncForwardEngine:
+    """基于单个asyncio事件循环的转发引擎"""
+
+    def __init__(self, logger: logging.Logger, metrics: MetricsRegistry, upstream_pools: UpstreamPoolManager,
+                 health_checkers: Dict[str, HealthChecker], buffer_size: int = DEFAULT_BUFFER_SIZE, backlog: int = DEFAULT_BACKLOG, reuse_port: bool = False,
+                 dns_cache: Optional[DnsCache] = None, access_log: Optional[AccessLogger] = None):
+        self.logger = logger
+        self.metrics = metrics
+        self.upstream_pools = upstream_pools
+        # 规则名 -> 健康检查器（与PortForwarder共享），用于记录上游连接失败
+        self.health_checkers = health_checkers
+        self.buffer_size = buffer_size
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        # 上游域名解析缓存，命中时不经过线程池中的getaddrinfo
+        self.dns_cache = dns_cache or DnsCache(logger=logger)
+        self.access_log = access_log
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.servers: Dict[str, asyncio.AbstractServer] = {}
+        self.writers: Dict[str, Set[asyncio.StreamWriter]] = {}
+        # 正在处理的连接任务数（只在事件循环线程中修改）
+        self.active_tasks = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """启动事件循环线程（已启动时直接返回）"""
+        with self._lock:
+            if self.loop and self.loop.is_running():
+                return
+
+            # Linux上为基于selectors(epoll)的循环，Windows上为基于IOCP的Proactor循环
+            self.loop = asyncio.new_event_loop()
+
+            ready = threading.Event()
+            self.thread = threading.Thread(target=self._run_loop, args=(ready,), name='AsyncForwardEngine')
+            self.thread.daemon = True
+            self.thread.start()
+            ready.wait()
+
+    def _run_loop(self, ready: threading.Event):
+        """事件循环线程"""
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(ready.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def _call(self, coro, timeout: float = 10):
+        """在事件循环中执行协程并等待结果"""
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(timeout)
+
+    def start_rule(self, rule) -> bool:
+        """启动规则监听"""
+        return self._call(self._start_server(rule))
+
+    def stop_rule(self, rule) -> bool:
+        """停止规则监听并关闭该规则的所有连接"""
+        if not self.loop or not self.loop.is_running():
+            return True
+        return self._call(self._stop_server(rule))
+
+    def stop_listening(self, rule) -> bool:
+        """关闭规则的监听服务，已建立的连接继续转发"""
+        if not self.loop or not self.loop.is_running():
+            return True
+        return self._call(self._close_server(rule.name))
+
+    def handoff_rule(self, old_rule, new_rule) -> bool:
+        """规则重载：监听服务和连接登记转到新规则名下（监听服务按接替关系把新连接交给新规则）"""
+        return self._call(self._handoff(old_rule.name, new_rule.name))
+
+    def shutdown(self):
+        """停止所有规则并结束事件循环"""
+        if not self.loop or not self.loop.is_running():
+            return
+
+        for name in list(self.servers.keys()):
+            self._call(self._stop_server_by_name(name))
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.thread = None
+
+    def get_connection_count(self, rule_name: str) -> int:
+        """获取规则当前的连接数"""
+        return len(self.writers.get(rule_name, ()))
+
+    async def _start_server(self, rule) -> bool:
+        """创建监听服务"""
+        # asyncio为IPv6套接字固定设置IPV6_V6ONLY，双栈监听需要自行创建套接字
+        sock = create_listener(rule.listen_address, rule.local_port, backlog=self.backlog, reuse_port=self.reuse_port)
+        # 规则重载后同一监听服务的新连接交给接替的规则
+        server = await asyncio.start_server(
+            lambda reader, writer: self._handle_client(rule.current(), reader, writer),
+            sock=sock,
+            backlog=self.backlog,
+            limit=self.buffer_size
+        )
+        self.servers[rule.name] = server
+        self.writers.setdefault(rule.name, set())
+        return True
+
+    async def _stop_server(self, rule) -> bool:
+        """关闭监听服务"""
+        return await self._stop_server_by_name(rule.name)
+
+    async def _close_server(self, rule_name: str) -> bool:
+        """按规则名关闭监听服务"""
+        server = self.servers.pop(rule_name, None)
+        if server:
+            server.close()
+            await server.wait_closed()
+        return True
+
+    async def _handoff(self, old_name: str, new_name: str) -> bool:
+        """把监听服务和连接登记从旧规则名转到新规则名"""
+        server = self.servers.pop(old_name, None)
+        if server:
+            self.servers[new_name] = server
+        # 保持同一个集合对象，旧会话结束时仍能从中移除自己的连接
+        writers = self.writers.pop(old_name, None)
+        if writers is not None:
+            self.writers.setdefault(new_name, writers)
+        return True
+
+    async def _stop_server_by_name(self, rule_name: str) -> bool:
+        """按规则名关闭监听服务和所有连接"""
+        await self._close_server(rule_name)
+
+        for writer in list(self.writers.pop(rule_name, ())):
+            writer.close()
+        return True
+
+    async def _handle_client(self, rule, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        """处理客户端连接"""
+        addr = client_writer.get_extra_info('peername')
+        client_ip = addr[0] if addr else None
+        # 超过新建连接速率的连接直接中止（RST）
+        if rule.rate_limiter and not rule.rate_limiter.allow_connection(client_ip):
+            client_writer.transport.abort()
+            if self.access_log:
+                self.access_log.log(rule.name, addr, reason=REASON_RATE_LIMITED)
+            return
+
+        writers = self.writers.setdefault(rule.name, set())
+        writers.add(client_writer)
+        # 连接的套接字也登记到规则上，重载排空超时或停止时由PortForwarder统一强制关闭
+        rule.add_connections(client_writer.get_extra_info('socket'))
+        rule.session_started()
+        self.active_tasks += 1
+        target_writer = None
+        metrics = self.metrics.get(rule.name)
+        metrics.connection_opened()
+        started = time.monotonic()
+        # 按负载均衡策略选择上游目标
+        target = rule.balancer.select(client_ip)
+        rule.balancer.acquire(target)
+        # 本连接的收发字节数和关闭原因，结束时写入访问日志
+        transferred = {BYTES_IN: 0, BYTES_OUT: 0}
+        reason = REASON_CLOSED
+        error = None
+        try:
+            try:
+                target_reader, target_writer = await asyncio.wait_for(
+                    self._open_upstream(rule, target.host, target.port), rule.connect_timeout or None)
+            except Exception:
+                reason = REASON_CONNECT_FAILED
+                metrics.connect_failed()
+                checker = self.health_checkers.get(rule.name)
+                if checker:
+                    checker.record(target, False)
+                raise
+            metrics.connect_succeeded(time.monotonic() - started)
+            writers.add(target_writer)
+            rule.add_connections(target_writer.get_extra_info('socket'))
+
+            # 限制发送缓冲区，配合drain()实现背压，使每个连接的内存占用有上界
+            for writer in (client_writer, target_writer):
+                writer.transport.set_write_buffer_limits(high=self.buffer_size)
+                rule.tune_socket(writer.get_extra_info('socket'))
+
+            # 事件循环单线程运行，所有连接共用同一个统计分片
+            counters = metrics.shard().counters
+            # 两个方向共用的最近活动时间，任一方向有数据都算会话活跃
+            activity = [time.monotonic()]
+            results = await asyncio.gather(
+                self._pipe(client_reader, target_writer, counters, BYTES_IN, rule, client_ip, activity, transferred),
+                self._pipe(target_reader, client_writer, counters, BYTES_OUT, rule, client_ip, activity, transferred)
+            )
+            if not all(results):
+                metrics.idle_timed_out()
+                reason = REASON_IDLE_TIMEOUT
+
+        except Exception as e:
+            # 连接超时的TimeoutError没有错误信息，使用异常类型名
+            error = str(e) or type(e).__name__
+            self.logger.error(f"转发连接错误: {error}")
+            if reason == REASON_CLOSED:
+                reason = REASON_ERROR
+        finally:
+            self.active_tasks -= 1
+            rule.balancer.release(target)
+            duration = time.monotonic() - started
+            metrics.connection_closed(duration)
+            if rule.aborted and reason in (REASON_CLOSED, REASON_ERROR):
+                reason = REASON_ABORTED
+            if self.access_log:
+                self.access_log.log(rule.name, addr, target, transferred[BYTES_IN], transferred[BYTES_OUT],
+                                    duration, reason, error)
+            for writer in (client_writer, target_writer):
+                if writer:
+                    writers.discard(writer)
+                    rule.remove_connection(writer.get_extra_info('socket'))
+                    writer.close()
+            rule.session_finished()
+
+    async def _open_upstream(self, rule, host: str, port: int):
+        """获取上游连接：优先使用预热池中已就绪的连接，否则新建"""
+        pool = self.upstream_pools.get_pool(rule, host, port)
+        sock = pool.acquire() if pool else None
+        if sock:
+            return await asyncio.open_connection(sock=sock, limit=self.buffer_size)
+        addresses = await asyncio.wrap_future(self.dns_cache.lookup(host, port))
+        sock = await self._connect_addresses(addresses)
+        return await asyncio.open_connection(sock=sock, limit=self.buffer_size)
+
+    async def _connect_addresses(self, addresses: list) -> socket.socket:
+        """
+        以happy eyeballs方式连接解析出的地址：每个尝试间隔250毫秒，某个尝试失败时立即开始下一个，
+        最先建立的连接胜出，其余尝试取消
+        """
+        loop = asyncio.get_running_loop()
+        pending = list(addresses)
+        attempts: Dict[asyncio.Task, socket.socket] = {}
+        error: Optional[Exception] = None
+        try:
+            while pending or attempts:
+                if pending:
+                    family, sockaddr = pending.pop(0)
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    attempts[loop.create_task(loop.sock_connect(sock, sockaddr))] = sock
+                done, _ = await asyncio.wait(attempts, timeout=DEFAULT_ATTEMPT_DELAY if pending else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    sock = attempts.pop(task)
+                    if task.exception() is None:
+                        return sock
+                    sock.close()
+                    error = task.exception()
+            raise error or OSError('没有可连接的上游地址')
+        finally:
+            # 取消的尝试结束（已从事件循环注销）后再关闭套接字，避免文件描述符被复用时误注销
+            for task, sock in attempts.items():
+                task.cancel()
+                task.add_done_callback(lambda _, sock=sock: sock.close())
+
+    async def _pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, counters: list, counter: int,
+                    rule, client_ip: Optional[str], activity: list, transferred: dict) -> bool:
+        """
+        单方向转发数据；有带宽限制时按令牌桶欠额暂停读取。
+        读到EOF时半关闭目标（write_eof），会话空闲超时时关闭目标并返回False；
+        transferred（字节计数器下标 -> 字节数）累计本连接的收发字节数
+        """
+        rate_limiter = rule.rate_limiter
+        idle_timeout = rule.idle_timeout or None
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(self.buffer_size), idle_timeout)
+                except asyncio.TimeoutError:
+                    # 另一方向仍有数据时会话不算空闲
+                    if time.monotonic() - activity[0] < rule.idle_timeout:
+                        continue
+                    writer.close()
+                    return False
+                if not data:
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                        return True
+                    break
+                activity[0] = time.monotonic()
+                writer.write(data)
+                counters[counter] += len(data)
+                transferred[counter] += len(data)
+                await asyncio.wait_for(writer.drain(), idle_timeout)
+                if rate_limiter:
+                    delay = rate_limiter.consume(client_ip, len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+        except asyncio.TimeoutError:
+            # 对端在空闲超时内不再接收数据
+            writer.close()
+            return False
+        except (ConnectionError, OSError):
+            pass
+        if not writer.is_closing():
+            writer.close()
+        return True
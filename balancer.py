@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游负载均衡模块
+一条规则可以配置多个上游目标，支持轮询、最少连接、加权轮询和按客户端IP一致性哈希四种策略；
+主动TCP健康检查连续失败时摘除目标，恢复后重新加入。
+"""
+
+import bisect
+import hashlib
+import threading
+import logging
+from typing import Callable, List, Optional
+import dual_stack
+
+STRATEGY_ROUND_ROBIN = 'round_robin'
+STRATEGY_LEAST_CONNECTIONS = 'least_connections'
+STRATEGY_WEIGHTED = 'weighted'
+STRATEGY_CONSISTENT_HASH = 'consistent_hash'
+STRATEGIES = (STRATEGY_ROUND_ROBIN, STRATEGY_LEAST_CONNECTIONS, STRATEGY_WEIGHTED, STRATEGY_CONSISTENT_HASH)
+
+# 一致性哈希环上每个目标的虚拟节点数
+VIRTUAL_NODES = 160
+# 健康检查连接超时（秒）
+DEFAULT_HEALTH_CHECK_TIMEOUT = 2.0
+# 连续失败多少次摘除、连续成功多少次恢复
+DEFAULT_FALL = 3
+DEFAULT_RISE = 2
+
+
+class UpstreamTarget:
+    """上游目标"""
+
+    def __init__(self, host: str, port: int, weight: int = 1):
+        self.host = host
+        self.port = port
+        self.weight = max(int(weight), 1)
+        self.healthy = True
+        self.active = 0
+        # 平滑加权轮询的当前权重
+        self.current_weight = 0
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+
+    def to_dict(self) -> dict:
+        """转换为字典"""
+        return {
+            'host': self.host,
+            'port': self.port,
+            'weight': self.weight
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """从字典创建目标"""
+        return cls(
+            host=data['host'],
+            port=data['port'],
+            weight=data.get('weight', 1)
+        )
+
+    def __str__(self):
+        return dual_stack.format_address(self.host, self.port)
+
+
+def _hash(key: str) -> int:
+    """一致性哈希使用的哈希函数"""
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class LoadBalancer:
+    """上游目标选择器"""
+
+    def __init__(self, targets: List[UpstreamTarget], strategy: str = STRATEGY_ROUND_ROBIN):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"不支持的负载均衡策略: {strategy}")
+        if not targets:
+            raise ValueError("至少需要一个上游目标")
+
+        self.targets = targets
+        self.strategy = strategy
+        self._index = 0
+        self._lock = threading.Lock()
+        self._ring: List[int] = []
+        self._ring_targets: List[UpstreamTarget] = []
+        if strategy == STRATEGY_CONSISTENT_HASH:
+            self._build_ring()
+
+    def _build_ring(self):
+        """构建一致性哈希环（按权重分配虚拟节点）"""
+        points = []
+        for target in self.targets:
+            for index in range(VIRTUAL_NODES * target.weight):
+                points.append((_hash(f"{target.host}:{target.port}#{index}"), target))
+        points.sort(key=lambda item: item[0])
+        self._ring = [point for point, _ in points]
+        self._ring_targets = [target for _, target in points]
+
+    def _candidates(self) -> List[UpstreamTarget]:
+        """可用目标；全部不健康时退回到所有目标，避免直接拒绝服务"""
+        healthy = [target for target in self.targets if target.healthy]
+        return healthy or self.targets
+
+    def select(self, client_ip: Optional[str] = None) -> UpstreamTarget:
+        """为新连接选择上游目标"""
+        with self._lock:
+            candidates = self._candidates()
+
+            if self.strategy == STRATEGY_LEAST_CONNECTIONS:
+                return min(candidates, key=lambda target: target.active / target.weight)
+
+            if self.strategy == STRATEGY_WEIGHTED:
+                # 平滑加权轮询：每次所有目标加上自身权重，选出最大者后减去总权重
+                total = 0
+                best = None
+                for target in candidates:
+                    target.current_weight += target.weight
+                    total += target.weight
+                    if best is None or target.current_weight > best.current_weight:
+                        best = target
+                best.current_weight -= total
+                return best
+
+            if self.strategy == STRATEGY_CONSISTENT_HASH and client_ip is not None:
+                # 顺时针查找第一个健康的节点
+                start = bisect.bisect(self._ring, _hash(client_ip))
+                size = len(self._ring)
+                for offset in range(size):
+                    target = self._ring_targets[(start + offset) % size]
+                    if target in candidates:
+                        return target
+
+            target = candidates[self._index % len(candidates)]
+            self._index += 1
+            return target
+
+    def acquire(self, target: UpstreamTarget):
+        """记录目标上新增一个连接"""
+        with self._lock:
+            target.active += 1
+
+    def release(self, target: UpstreamTarget):
+        """记录目标上结束一个连接"""
+        with self._lock:
+            target.active -= 1
+
+    def get_stats(self) -> List[dict]:
+        """获取各目标状态"""
+        return [
+            {
+                'host': target.host,
+                'port': target.port,
+                'weight': target.weight,
+                'healthy': target.healthy,
+                'active': target.active
+            }
+            for target in self.targets
+        ]
+
+
+class HealthChecker:
+    """主动TCP健康检查"""
+
+    def __init__(self, rule_name: str, balancer: LoadBalancer, interval: float,
+                 timeout: float = DEFAULT_HEALTH_CHECK_TIMEOUT, fall: int = DEFAULT_FALL, rise: int = DEFAULT_RISE,
+                 logger: Optional[logging.Logger] = None, resolver: Optional[Callable] = None):
+        self.rule_name = rule_name
+        self.balancer = balancer
+        self.interval = interval
+        self.timeout = timeout
+        self.fall = fall
+        self.rise = rise
+        self.logger = logger or logging.getLogger('PortForwarder')
+        self.resolver = resolver
+        # 检查线程、中继线程和asyncio事件循环都会记录结果，连续计数和状态切换需要加锁
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """启动健康检查线程"""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._check_thread, name=f'HealthChecker-{self.rule_name}')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """停止健康检查线程"""
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=self.timeout + 1)
+            self._thread = None
+
+    def _check_thread(self):
+        """周期性检查所有目标"""
+        while not self._stopping.is_set():
+            for target in self.balancer.targets:
+                if self._stopping.is_set():
+                    break
+                self.record(target, self._probe(target))
+            self._stopping.wait(self.interval)
+
+    def _probe(self, target: UpstreamTarget) -> bool:
+        """TCP连接探测"""
+        try:
+            with dual_stack.connect(target.host, target.port, self.timeout, resolver=self.resolver):
+                return True
+        except OSError:
+            return False
+
+    def record(self, target: UpstreamTarget, success: bool):
+        """记录一次检查结果，达到阈值时摘除或恢复目标（可在任意线程调用）"""
+        with self._lock:
+            changed = False
+            if success:
+                target.consecutive_failures = 0
+                target.consecutive_successes += 1
+                if not target.healthy and target.consecutive_successes >= self.rise:
+                    target.healthy = changed = True
+            else:
+                target.consecutive_successes = 0
+                target.consecutive_failures += 1
+                if target.healthy and target.consecutive_failures >= self.fall:
+                    target.healthy = False
+                    changed = True
+
+        if changed and success:
+            self.logger.info(f"上游目标恢复: {target} ({self.rule_name})")
+        elif changed:
+            self.logger.warning(f"上游目标不可用，已摘除: {target} ({self.rule_name})")
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PortForwarder转发基准
+在回环地址上启动echo/sink/source上游（独立进程），经PortForwarder转发，由独立的压测进程测量：
+- throughput: 批量上传（到sink）和下载（从source）的吞吐（GB/s）
+- connection_rate: 短连接（一次往返后关闭）每秒完成数
+- latency: 小消息往返延迟的p50/p99，以及相对直连上游增加的延迟
+- concurrency: 同时保持1k/5k/10k个连接时转发进程的内存（RSS/峰值RSS）和线程数
+结果以JSON输出，可用--compare与上一次的结果比较，发现性能回退。
+
+用法: python benchmarks/bench_forwarder.py [--engines thread asyncio] [--output result.json]
+      python benchmarks/bench_forwarder.py --scenarios latency --compare last.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from port_forwarder import PortForwarder, PortForwardRule, ENGINE_THREAD, ENGINE_ASYNCIO  # noqa: E402
+
+SCENARIOS = ('throughput', 'connection_rate', 'latency', 'concurrency')
+HOST = '127.0.0.1'
+CHUNK_SIZE = 256 * 1024
+# source上游的请求头: 8字节大端的字节数；sink上游读到EOF后回复同样格式的已接收字节数
+LENGTH_SIZE = 8
+# 建立大量连接时同时进行的连接数
+CONNECT_CONCURRENCY = 256
+# 比较结果时各指标的方向: True表示越大越好
+COMPARE_METRICS = {
+    ('throughput', 'upload', 'gbps'): True,
+    ('throughput', 'download', 'gbps'): True,
+    ('connection_rate', 'per_second'): True,
+    ('latency', 'added_p50_ms'): False,
+    ('latency', 'added_p99_ms'): False,
+}
+
+
+def _log(message: str):
+    """进度信息输出到stderr，stdout只输出JSON"""
+    print(message, file=sys.stderr, flush=True)
+
+
+def _raise_nofile_limit():
+    """把文件描述符软限制提高到硬限制（Windows上没有该限制）"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def process_stats() -> dict:
+    """当前进程的RSS、峰值RSS（字节）和线程数：优先使用psutil，其次/proc/self/status"""
+    try:
+        import psutil
+        process = psutil.Process()
+        memory = process.memory_info()
+        peak = getattr(memory, 'peak_wset', None)
+        if peak is None:
+            try:
+                import resource
+                # Linux上ru_maxrss的单位为KiB
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            except ImportError:
+                pass
+        return {'rss_bytes': memory.rss, 'peak_rss_bytes': peak, 'threads': process.num_threads()}
+    except ImportError:
+        pass
+
+    stats = {'rss_bytes': None, 'peak_rss_bytes': None, 'threads': threading.active_count()}
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'VmRSS':
+                    stats['rss_bytes'] = int(value.split()[0]) * 1024
+                elif key == 'VmHWM':
+                    stats['peak_rss_bytes'] = int(value.split()[0]) * 1024
+                elif key == 'Threads':
+                    stats['threads'] = int(value)
+    except OSError:
+        pass
+    return stats
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """已排序数据的百分位数（最近秩）"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+# ---------------------------------------------------------------- 上游进程
+
+async def _echo_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """原样返回收到的数据"""
+    try:
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _sink_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """丢弃收到的数据，读到EOF后回复接收的字节数"""
+    received = 0
+    try:
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            received += len(data)
+        writer.write(received.to_bytes(LENGTH_SIZE, 'big'))
+        await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _source_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """按请求的字节数持续发送数据后关闭"""
+    payload = memoryview(bytes(CHUNK_SIZE))
+    try:
+        remaining = int.from_bytes(await reader.readexactly(LENGTH_SIZE), 'big')
+        while remaining > 0:
+            size = min(remaining, CHUNK_SIZE)
+            writer.write(payload[:size])
+            remaining -= size
+            await writer.drain()
+    except (ConnectionError, OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def _upstream_main(ports, stop_event):
+    """上游进程入口，ports为(echo, sink, source)端口的共享数组"""
+    _raise_nofile_limit()
+
+    async def serve():
+        servers = []
+        for index, handler in enumerate((_echo_handler, _sink_handler, _source_handler)):
+            server = await asyncio.start_server(handler, HOST, 0, backlog=4096, limit=CHUNK_SIZE)
+            ports[index] = server.sockets[0].getsockname()[1]
+            servers.append(server)
+        while not stop_event.is_set():
+            await asyncio.sleep(0.1)
+        for server in servers:
+            server.close()
+
+    asyncio.run(serve())
+
+
+# ---------------------------------------------------------------- 压测进程
+
+async def _bench_throughput(params: dict) -> dict:
+    """并发批量上传和下载，返回吞吐"""
+    streams = params['streams']
+    share = params['bytes'] // streams
+    payload = memoryview(bytes(CHUNK_SIZE))
+
+    async def upload() -> int:
+        reader, writer = await asyncio.open_connection(HOST, params['sink_port'], limit=CHUNK_SIZE)
+        remaining = share
+        while remaining > 0:
+            size = min(remaining, CHUNK_SIZE)
+            writer.write(payload[:size])
+            remaining -= size
+            await writer.drain()
+        writer.write_eof()
+        received = int.from_bytes(await reader.readexactly(LENGTH_SIZE), 'big')
+        writer.close()
+        return received
+
+    async def download() -> int:
+        reader, writer = await asyncio.open_connection(HOST, params['source_port'], limit=CHUNK_SIZE)
+        writer.write(share.to_bytes(LENGTH_SIZE, 'big'))
+        received = 0
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            received += len(data)
+        writer.close()
+        return received
+
+    result = {}
+    for name, func in (('upload', upload), ('download', download)):
+        started = time.perf_counter()
+        transferred = sum(await asyncio.gather(*(func() for _ in range(streams))))
+        elapsed = time.perf_counter() - started
+        result[name] = {
+            'bytes': transferred,
+            'seconds': round(elapsed, 4),
+            'gbps': round(transferred / elapsed / 1e9, 4)
+        }
+    return result
+
+
+async def _bench_connection_rate(params: dict) -> dict:
+    """在限定时间内反复建立短连接（一次1字节往返后关闭）"""
+    deadline = time.perf_counter() + params['duration']
+    completed = 0
+    errors = 0
+
+    async def worker():
+        nonlocal completed, errors
+        while time.perf_counter() < deadline:
+            try:
+                reader, writer = await asyncio.open_connection(HOST, params['echo_port'])
+                writer.write(b'x')
+                await reader.readexactly(1)
+                writer.close()
+                await writer.wait_closed()
+                completed += 1
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(params['concurrency'])))
+    elapsed = time.perf_counter() - started
+    return {
+        'connections': completed,
+        'errors': errors,
+        'concurrency': params['concurrency'],
+        'seconds': round(elapsed, 4),
+        'per_second': round(completed / elapsed, 1)
+    }
+
+
+def _bench_latency(params: dict) -> dict:
+    """单个连接上的小消息往返延迟（阻塞套接字，避免事件循环调度误差）"""
+    message = b'p' * params['message_size']
+    samples = []
+    with socket.create_connection((HOST, params['echo_port'])) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for _ in range(params['samples']):
+            started = time.perf_counter()
+            sock.sendall(message)
+            received = 0
+            while received < len(message):
+                data = sock.recv(len(message) - received)
+                if not data:
+                    raise ConnectionError('连接被关闭')
+                received += len(data)
+            samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {
+        'samples': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 4),
+        'max_ms': round(samples[-1] * 1000, 4)
+    }
+
+
+async def _hold_connections(params: dict, conn) -> dict:
+    """建立指定数量的连接并各完成一次往返，通知主进程采样后再全部关闭"""
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    writers = []
+    failed = 0
+
+    async def open_one():
+        nonlocal failed
+        async with semaphore:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(HOST, params['echo_port']),
+                                                        params['timeout'])
+                writer.write(b'x')
+                await asyncio.wait_for(reader.readexactly(1), params['timeout'])
+                writers.append(writer)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(open_one() for _ in range(params['connections'])))
+    elapsed = time.perf_counter() - started
+
+    conn.send({'established': len(writers), 'failed': failed, 'setup_seconds': round(elapsed, 4)})
+    # 等待主进程采样完成
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+    for writer in writers:
+        writer.close()
+    return {}
+
+
+def _client_main(scenario: str, params: dict, conn):
+    """压测进程入口，结果通过管道返回"""
+    _raise_nofile_limit()
+    try:
+        if scenario == 'throughput':
+            result = asyncio.run(_bench_throughput(params))
+        elif scenario == 'connection_rate':
+            result = asyncio.run(_bench_connection_rate(params))
+        elif scenario == 'latency':
+            result = _bench_latency(params)
+        else:
+            result = asyncio.run(_hold_connections(params, conn))
+        conn.send(result)
+    except Exception as e:
+        conn.send({'error': f'{type(e).__name__}: {e}'})
+
+
+class BenchRunner:
+    """基准运行器：管理上游进程，在子进程中运行压测"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.context = multiprocessing.get_context('spawn')
+        self.upstream_ports = self.context.Array('i', 3)
+        self.stop_event = self.context.Event()
+        self.upstream: Optional[multiprocessing.Process] = None
+
+    def start_upstream(self) -> Dict[str, int]:
+        """启动上游进程，返回各上游端口"""
+        self.upstream = self.context.Process(target=_upstream_main, args=(self.upstream_ports, self.stop_event),
+                                             name='BenchUpstream', daemon=True)
+        self.upstream.start()
+        deadline = time.monotonic() + 10
+        while not all(self.upstream_ports[:]):
+            if time.monotonic() > deadline or not self.upstream.is_alive():
+                raise RuntimeError('上游进程启动失败')
+            time.sleep(0.05)
+        echo, sink, source = self.upstream_ports[:]
+        return {'echo_port': echo, 'sink_port': sink, 'source_port': source}
+
+    def stop_upstream(self):
+        """停止上游进程"""
+        self.stop_event.set()
+        if self.upstream:
+            self.upstream.join(5)
+            if self.upstream.is_alive():
+                self.upstream.terminate()
+
+    def run_client(self, scenario: str, params: dict, on_ready=None) -> dict:
+        """在子进程中运行一个场景；concurrency场景在连接全部建立后调用on_ready采样"""
+        parent, child = self.context.Pipe()
+        process = self.context.Process(target=_client_main, args=(scenario, params, child),
+                                       name=f'BenchClient-{scenario}', daemon=True)
+        process.start()
+        result = parent.recv()
+        if on_ready and 'error' not in result:
+            result.update(on_ready())
+            parent.send('close')
+            parent.recv()
+        process.join(10)
+        return result
+
+    def scenario_params(self, ports: Dict[str, int]) -> Dict[str, dict]:
+        """各场景的参数"""
+        args = self.args
+        return {
+            'throughput': {'streams': args.streams, 'bytes': args.bytes,
+                           'sink_port': ports['sink_port'], 'source_port': ports['source_port']},
+            'connection_rate': {'duration': args.duration, 'concurrency': args.concurrency,
+                                'echo_port': ports['echo_port']},
+            'latency': {'samples': args.samples, 'message_size': args.message_size, 'echo_port': ports['echo_port']}
+        }
+
+    def run_baseline(self, upstream: Dict[str, int]) -> dict:
+        """不经转发直连上游，作为对照"""
+        results = {}
+        params = self.scenario_params(upstream)
+        for scenario in ('throughput', 'latency'):
+            if scenario in self.args.scenarios:
+                _log(f'[direct] {scenario}')
+                results[scenario] = self.run_client(scenario, params[scenario])
+        return results
+
+    def run_engine(self, engine: str, upstream: Dict[str, int], baseline: dict) -> dict:
+        """经指定引擎转发运行各场景"""
+        args = self.args
+        # 不写访问日志（每个连接一条JSON记录会影响结果），规则启停等INFO日志也不输出
+        forwarder = PortForwarder(engine=engine, relay=args.relay, max_workers=args.max_workers,
+                                  listen_backlog=args.backlog, access_log=None)
+        forwarder.logger.setLevel('WARNING')
+        local_ports = forwarder.get_free_ports(3, start=args.port_start)
+        forwarded = {}
+        for local_port, (key, target_port) in zip(local_ports, upstream.items()):
+            forwarder.add_rule(PortForwardRule(f"bench-{key.split('_')[0]}", local_port, HOST, target_port))
+            forwarded[key] = local_port
+
+        results = {'relay': forwarder.relay_backend if engine == ENGINE_THREAD else None}
+        params = self.scenario_params(forwarded)
+        try:
+            for scenario in ('throughput', 'connection_rate', 'latency'):
+                if scenario in args.scenarios:
+                    _log(f'[{engine}] {scenario}')
+                    results[scenario] = self.run_client(scenario, params[scenario])
+
+            latency = results.get('latency')
+            direct = baseline.get('latency')
+            if latency and direct and 'error' not in latency and 'error' not in direct:
+                latency['added_p50_ms'] = round(latency['p50_ms'] - direct['p50_ms'], 4)
+                latency['added_p99_ms'] = round(latency['p99_ms'] - direct['p99_ms'], 4)
+
+            if 'concurrency' in args.scenarios:
+                results['concurrency'] = []
+                for count in args.levels:
+                    _log(f'[{engine}] concurrency {count}')
+                    level = self.run_client('concurrency', {'connections': count, 'timeout': args.connect_timeout,
+                                                            'echo_port': forwarded['echo_port']},
+                                            on_ready=process_stats)
+                    level['connections'] = count
+                    results['concurrency'].append(level)
+                    # 等待连接全部关闭后再进行下一档
+                    deadline = time.monotonic() + 10
+                    while forwarder.get_relay_task_count() and time.monotonic() < deadline:
+                        time.sleep(0.1)
+        finally:
+            forwarder.stop_all()
+        return results
+
+
+def compare_results(previous: dict, current: dict, tolerance: float) -> List[str]:
+    """与上一次结果比较，返回超过容差的回退项"""
+    regressions = []
+    for engine, results in current.get('engines', {}).items():
+        old_results = previous.get('engines', {}).get(engine)
+        if not old_results:
+            continue
+        for path, higher_is_better in COMPARE_METRICS.items():
+            old_value, new_value = old_results, results
+            for key in path:
+                old_value = old_value.get(key) if isinstance(old_value, dict) else None
+                new_value = new_value.get(key) if isinstance(new_value, dict) else None
+            if not isinstance(old_value, (int, float)) or not isinstance(new_value, (int, float)) or not old_value:
+                continue
+            change = (new_value - old_value) / abs(old_value)
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f"{engine} {'.'.join(path)}: {old_value} -> {new_value} ({change:+.1%})")
+        old_levels = {level['connections']: level for level in old_results.get('concurrency', [])}
+        for level in results.get('concurrency', []):
+            old_level = old_levels.get(level['connections'])
+            old_value = old_level.get('peak_rss_bytes') if old_level else None
+            new_value = level.get('peak_rss_bytes')
+            if old_value and new_value and (new_value - old_value) / old_value > tolerance:
+                regressions.append(f"{engine} concurrency[{level['connections']}].peak_rss_bytes: "
+                                   f"{old_value} -> {new_value} ({(new_value - old_value) / old_value:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PortForwarder转发基准（JSON输出）')
+    parser.add_argument('--engines', nargs='+', choices=(ENGINE_THREAD, ENGINE_ASYNCIO),
+                        default=[ENGINE_THREAD, ENGINE_ASYNCIO], help='参与测试的转发引擎')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS), help='运行的场景')
+    parser.add_argument('--relay', default='auto', help='线程模式的中继后端 (auto/splice/buffer)')
+    parser.add_argument('--streams', type=int, default=4, help='吞吐场景的并发流数')
+    parser.add_argument('--bytes', type=int, default=1 << 30, help='吞吐场景每个方向传输的总字节数')
+    parser.add_argument('--duration', type=float, default=5.0, help='短连接场景的持续时间（秒）')
+    parser.add_argument('--concurrency', type=int, default=64, help='短连接场景的并发数')
+    parser.add_argument('--samples', type=int, default=5000, help='延迟场景的往返次数')
+    parser.add_argument('--message-size', type=int, default=64, help='延迟场景的消息大小（字节）')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1000, 5000, 10000], help='并发连接数档位')
+    parser.add_argument('--connect-timeout', type=float, default=30.0, help='并发场景中单个连接的建立超时（秒）')
+    parser.add_argument('--max-workers', type=int, default=None, help='线程模式的中继线程数（默认为最大档位加64）')
+    parser.add_argument('--backlog', type=int, default=4096, help='转发监听队列长度')
+    parser.add_argument('--port-start', type=int, default=20000, help='转发端口的搜索起点')
+    parser.add_argument('--output', help='结果JSON文件（默认输出到stdout）')
+    parser.add_argument('--compare', help='上一次的结果JSON，报告超过容差的回退')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='比较容差（比例）')
+    args = parser.parse_args()
+    if args.max_workers is None:
+        args.max_workers = max(args.levels) + 64
+
+    _raise_nofile_limit()
+    runner = BenchRunner(args)
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'engines': {}
+    }
+    try:
+        upstream = runner.start_upstream()
+        result['direct'] = runner.run_baseline(upstream)
+        for engine in args.engines:
+            result['engines'][engine] = runner.run_engine(engine, upstream, result['direct'])
+    finally:
+        runner.stop_upstream()
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare_results(json.load(f), result, args.tolerance)
+        result['regressions'] = regressions
+        for line in regressions:
+            _log(f'回退: {line}')
+        exit_code = 1 if regressions else 0
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        _log(f'结果已保存到 {args.output}')
+    else:
+        print(text)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
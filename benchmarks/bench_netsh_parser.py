@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+netsh portproxy show all 输出解析基准
+生成包含四张表、IPv6地址和主机名的中英文合成输出，比较逐行多正则解析与单次扫描解析的耗时。
+
+用法: python benchmarks/bench_netsh_parser.py [--rules 20000] [--repeat 5]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from netsh_manager import parse_show_output  # noqa: E402
+
+HEADERS = {
+    'en': ('Listen on {listen}:             Connect to {connect}:', 'Address         Port        Address         Port'),
+    'zh': ('侦听 {listen}:                 连接到 {connect}:', '地址            端口        地址            端口'),
+}
+SEPARATOR = '--------------- ----------  --------------- ----------'
+
+
+def _address(family: str, index: int) -> str:
+    """生成合成地址，约十分之一为主机名"""
+    if index % 10 == 0:
+        return f'host{index}.example.internal'
+    if family == 'ipv6':
+        return f'fd00::{index % 65536:x}'
+    return f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}'
+
+
+def generate_output(rules: int, language: str = 'en') -> str:
+    """生成包含指定规则数的show all输出，规则平均分布在四张表中"""
+    title, columns = HEADERS[language]
+    per_table = rules // 4
+    lines = []
+    index = 0
+    for listen, connect in (('ipv4', 'ipv4'), ('ipv4', 'ipv6'), ('ipv6', 'ipv4'), ('ipv6', 'ipv6')):
+        lines.extend(['', title.format(listen=listen, connect=connect), '', columns, SEPARATOR])
+        for _ in range(per_table):
+            listen_address = '*' if index % 7 == 0 else _address(listen, index)
+            lines.append(f'{listen_address:<15} {1024 + index % 60000:<11} {_address(connect, index + 1):<15} {80 + index % 1000}')
+            index += 1
+        lines.append('')
+    return '\n'.join(lines) + '\n'
+
+
+def legacy_parse(output: str) -> list:
+    """原实现: 逐行去空白后依次尝试三个未编译的正则，只识别IPv4"""
+    rules = []
+    table_started = False
+    for line in output.split('\n'):
+        line = line.strip()
+        if not line or '监听' in line or 'Listen' in line or '---' in line:
+            if '监听' in line or 'Listen' in line:
+                table_started = True
+            continue
+        if not table_started:
+            continue
+        line = re.sub(r'\s+', ' ', line)
+        for pattern in (r'([\d\.]+):(\d+)\s+([\d\.]+):(\d+)',
+                        r'(\*|[\d\.]+):(\d+)\s+([\d\.]+):(\d+)',
+                        r'([\d\.\*]+)\s+(\d+)\s+([\d\.]+)\s+(\d+)'):
+            match = re.search(pattern, line)
+            if match:
+                rules.append(match.groups())
+                break
+    return rules
+
+
+def bench(name: str, func, output: str, repeat: int):
+    """运行repeat次，输出最快一次的耗时和吞吐"""
+    best = float('inf')
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = len(list(func(output)))
+        best = min(best, time.perf_counter() - start)
+    print(f'{name:<24} {count:>8} 条  {best * 1000:>9.2f} ms  {count / best:>12,.0f} 条/秒')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='netsh show all 输出解析基准')
+    parser.add_argument('--rules', type=int, default=20000, help='合成规则数')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数，取最快一次')
+    args = parser.parse_args()
+
+    for language in ('en', 'zh'):
+        output = generate_output(args.rules, language)
+        print(f'[{language}] {args.rules} 条规则, 输出 {len(output) / 1024:.0f} KiB')
+        bench('legacy (逐行多正则)', legacy_parse, output, args.repeat)
+        bench('parse_show_output', parse_show_output, output, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
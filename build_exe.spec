@@ -25,7 +25,25 @@ a = Analysis(
         'typing',
         'netsh_manager',
         'rule_manager',
-        'port_forwarder'
+        'port_forwarder',
+        'async_engine',
+        'relay',
+        'worker_pool',
+        'admission',
+        'metrics',
+        'metrics_exporter',
+        'upstream_pool',
+        'balancer',
+        'portproxy_backend',
+        'portproxy_watcher',
+        'rule_store',
+        'reconciler',
+        'port_inventory',
+        'rate_limit',
+        'udp_forwarder',
+        'dual_stack',
+        'dns_cache',
+        'access_log'
     ],
     hookspath=[],
     hooksconfig={},
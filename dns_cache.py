@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游域名解析缓存模块
+目标地址为域名时，新连接直接使用缓存的解析结果，不在连接建立路径上调用阻塞的getaddrinfo：
+- getaddrinfo不返回记录的TTL，缓存按配置的TTL过期，接近过期时由后台线程提前刷新
+- 解析失败时继续使用过期的结果（serve-stale），直到超过最长过期使用时间
+- 同一名称的并发解析合并为一次，所有等待者共用结果
+IP地址直接返回，不经过缓存
+"""
+
+import ipaddress
+import socket
+import threading
+import time
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+import dual_stack
+
+# 解析结果的有效期（秒）
+DEFAULT_DNS_TTL = 60.0
+# 有效期过去该比例后开始后台刷新
+DEFAULT_REFRESH_AHEAD = 0.8
+# 解析失败时，过期结果最多继续使用多久（秒）
+DEFAULT_MAX_STALE = 3600.0
+# 解析失败（且没有可用的旧结果）的缓存时间（秒），避免DNS故障时每个连接都等待解析超时
+DEFAULT_NEGATIVE_TTL = 5.0
+# 多久没有被使用的名称不再后台刷新，过期后从缓存删除（秒）
+DEFAULT_IDLE_EXPIRY = 600.0
+# 后台刷新线程的检查间隔（秒）
+REFRESH_INTERVAL = 1.0
+# 并发解析的线程数
+DEFAULT_RESOLVER_THREADS = 4
+
+
+class DnsCacheEntry:
+    """一个(名称, 端口, 套接字类型)的解析结果"""
+
+    __slots__ = ('addresses', 'error', 'resolved_at', 'checked_at', 'last_used', 'failures')
+
+    def __init__(self, now: float):
+        self.addresses: List[Tuple] = []
+        self.error: Optional[Exception] = None
+        self.resolved_at = now
+        # 最近一次解析（无论成功与否）的时间
+        self.checked_at = now
+        self.last_used = now
+        # 连续解析失败次数
+        self.failures = 0
+
+
+class DnsCache:
+    """带TTL、后台刷新、过期兜底和并发合并的解析缓存"""
+
+    def __init__(self, ttl: float = DEFAULT_DNS_TTL, refresh_ahead: float = DEFAULT_REFRESH_AHEAD,
+                 max_stale: float = DEFAULT_MAX_STALE, negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 idle_expiry: float = DEFAULT_IDLE_EXPIRY, resolver: Callable = dual_stack.resolve,
+                 logger: Optional[logging.Logger] = None):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.max_stale = max_stale
+        self.negative_ttl = negative_ttl
+        self.idle_expiry = idle_expiry
+        self.resolver = resolver
+        self.logger = logger or logging.getLogger('PortForwarder')
+        self.entries: Dict[Tuple[str, int, int], DnsCacheEntry] = {}
+        # 正在解析的名称 -> Future，合并并发解析
+        self._pending: Dict[Tuple[str, int, int], Future] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.failures = 0
+        self.lookup_time = 0.0
+        self.lookups = 0
+
+    def lookup(self, host: str, port: int, sock_type: int = socket.SOCK_STREAM) -> Future:
+        """
+        获取解析结果，返回Future（结果为(family, sockaddr)列表）。
+        缓存命中（包括过期兜底）时返回已完成的Future，未命中时返回正在进行的解析
+        """
+        if _is_ip_address(host):
+            return _completed(self.resolver, host, port, sock_type)
+
+        key = (host, port, sock_type)
+        now = time.monotonic()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry.last_used = now
+                age = now - entry.resolved_at
+                if entry.addresses:
+                    if age < self.ttl:
+                        self.hits += 1
+                        if self._needs_refresh(entry, now):
+                            self._refresh(key)
+                        return _result(entry.addresses)
+                    if age < self.ttl + self.max_stale:
+                        # 已过期：先返回旧结果，同时在后台刷新
+                        self.stale_hits += 1
+                        if self._needs_refresh(entry, now):
+                            self._refresh(key)
+                        return _result(entry.addresses)
+                elif entry.error and age < self.negative_ttl:
+                    self.negative_hits += 1
+                    future = Future()
+                    future.set_exception(entry.error)
+                    return future
+
+            if key in self._pending:
+                self.coalesced += 1
+                return self._pending[key]
+            self.misses += 1
+            return self._refresh(key)
+
+    def resolve(self, host: str, port: int, sock_type: int = socket.SOCK_STREAM) -> List[Tuple]:
+        """获取解析结果，未命中时等待解析完成；解析失败时抛出socket.gaierror"""
+        return self.lookup(host, port, sock_type).result()
+
+    def prefetch(self, host: str, port: int, sock_type: int = socket.SOCK_STREAM):
+        """提前在后台解析（规则启动时调用），第一个连接即可命中缓存"""
+        if _is_ip_address(host):
+            return
+        key = (host, port, sock_type)
+        with self._lock:
+            if key not in self.entries:
+                self._refresh(key)
+
+    def _needs_refresh(self, entry: DnsCacheEntry, now: float) -> bool:
+        """结果接近过期时需要刷新；上次解析失败时至少间隔negative_ttl再试"""
+        if now - entry.resolved_at < self.ttl * self.refresh_ahead:
+            return False
+        return not entry.failures or now - entry.checked_at >= self.negative_ttl
+
+    def _refresh(self, key: Tuple[str, int, int]) -> Future:
+        """在后台解析线程中刷新（调用方持有锁），同一名称同时只有一次解析"""
+        future = self._pending.get(key)
+        if future is None:
+            if self._executor is None:
+                self._start()
+            future = self._executor.submit(self._resolve_entry, key)
+            self._pending[key] = future
+        return future
+
+    def _resolve_entry(self, key: Tuple[str, int, int]) -> List[Tuple]:
+        """解析并更新缓存（后台解析线程）"""
+        host, port, sock_type = key
+        started = time.monotonic()
+        try:
+            addresses = self.resolver(host, port, sock_type)
+            error = None
+        except OSError as e:
+            addresses = None
+            error = e
+        now = time.monotonic()
+
+        with self._lock:
+            self._pending.pop(key, None)
+            self.lookups += 1
+            self.lookup_time += now - started
+            entry = self.entries.get(key)
+            if entry:
+                entry.checked_at = now
+            if error is None:
+                self.refreshes += 1
+                if entry is None:
+                    entry = self.entries[key] = DnsCacheEntry(now)
+                entry.addresses = addresses
+                entry.error = None
+                entry.resolved_at = now
+                entry.failures = 0
+                return addresses
+
+            self.failures += 1
+            if entry and entry.addresses and now - entry.resolved_at < self.ttl + self.max_stale:
+                # 保留旧结果继续使用，下一次刷新时再试
+                entry.failures += 1
+                if entry.failures == 1:
+                    self.logger.warning(f"解析 {host} 失败，继续使用过期的结果: {str(error)}")
+                return entry.addresses
+
+            if entry is None:
+                entry = self.entries[key] = DnsCacheEntry(now)
+            entry.addresses = []
+            entry.error = error
+            entry.resolved_at = now
+            entry.failures += 1
+        raise error
+
+    def _start(self):
+        """创建解析线程池和后台刷新线程（调用方持有锁）"""
+        self._executor = ThreadPoolExecutor(max_workers=DEFAULT_RESOLVER_THREADS, thread_name_prefix='DnsCache')
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._refresh_thread, name='DnsCacheRefresher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _refresh_thread(self):
+        """周期性刷新即将过期且最近被使用的名称，删除长时间未使用的名称"""
+        while not self._stopping.wait(REFRESH_INTERVAL):
+            now = time.monotonic()
+            with self._lock:
+                if self._stopping.is_set():
+                    return
+                for key, entry in list(self.entries.items()):
+                    if now - entry.last_used > self.idle_expiry:
+                        if now - entry.resolved_at >= self.ttl:
+                            del self.entries[key]
+                    elif entry.addresses and self._needs_refresh(entry, now):
+                        self._refresh(key)
+
+    def stop(self):
+        """停止后台刷新，正在进行的解析在后台完成"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._stopping.set()
+        if executor:
+            executor.shutdown(wait=False)
+        if self._thread:
+            self._thread.join(timeout=REFRESH_INTERVAL * 2)
+            self._thread = None
+
+    def get_stats(self) -> dict:
+        """获取命中率等统计"""
+        with self._lock:
+            answered = self.hits + self.stale_hits + self.negative_hits + self.misses + self.coalesced
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': round((self.hits + self.stale_hits) / answered, 4) if answered else 0.0,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'avg_lookup_ms': round(self.lookup_time / self.lookups * 1000, 3) if self.lookups else 0.0
+            }
+
+
+def _is_ip_address(host: str) -> bool:
+    """是否为IP地址（不需要DNS解析）"""
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def _result(value) -> Future:
+    """已完成的Future"""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def _completed(function: Callable, *args) -> Future:
+    """同步执行并把结果或异常包装为已完成的Future"""
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except OSError as e:
+        future.set_exception(e)
+    return future
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+IPv6与双栈网络模块
+- 监听: 按规则的监听地址创建套接字，监听地址为::时关闭IPV6_V6ONLY，同一个套接字同时接受IPv4和IPv6客户端
+- 上游连接: 通过getaddrinfo解析全部地址，按地址族交替排列（IPv6优先），
+  以happy eyeballs（RFC 8305）方式错开发起并行连接，最先成功的连接胜出，其余连接关闭
+"""
+
+import errno
+import socket
+import selectors
+import time
+from typing import Callable, List, Optional, Tuple
+
+# 规则默认的监听地址（仅IPv4，与netsh portproxy的v4tov4一致）
+DEFAULT_LISTEN_ADDRESS = '0.0.0.0'
+# 双栈通配地址
+DUAL_STACK_ADDRESS = '::'
+# connect_ex表示连接进行中的返回值（Windows为WSAEWOULDBLOCK）
+_CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', 10035))
+# 上一个连接尝试未完成时，间隔多久发起下一个地址的尝试（秒，RFC 8305建议250毫秒）
+DEFAULT_ATTEMPT_DELAY = 0.25
+
+
+def format_address(host: str, port: int) -> str:
+    """格式化为host:port，IPv6地址加方括号"""
+    return f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+
+
+def create_listener(address: str, port: int, sock_type: int = socket.SOCK_STREAM, backlog: Optional[int] = None,
+                    reuse_port: bool = False) -> socket.socket:
+    """
+    创建并绑定监听套接字（TCP时同时开始监听），失败时抛出异常。
+    address为空或::时创建双栈套接字，平台不支持IPv6时退回到0.0.0.0
+    """
+    if address in ('', DUAL_STACK_ADDRESS) and not socket.has_ipv6:
+        address = DEFAULT_LISTEN_ADDRESS
+    if address == '':
+        address = DUAL_STACK_ADDRESS
+
+    family, _, _, _, sockaddr = socket.getaddrinfo(address, port, socket.AF_UNSPEC, sock_type, 0, socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, sock_type)
+    try:
+        if sock_type == socket.SOCK_STREAM:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6 and address == DUAL_STACK_ADDRESS:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.bind(sockaddr)
+        if sock_type == socket.SOCK_STREAM:
+            sock.listen(backlog if backlog is not None else socket.SOMAXCONN)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def interleave_addresses(addresses: List[Tuple]) -> List[Tuple]:
+    """按地址族交替排列getaddrinfo的结果，第一个地址族保持在最前（RFC 8305第4节）"""
+    families = {}
+    for entry in addresses:
+        families.setdefault(entry[0], []).append(entry)
+    groups = list(families.values())
+    ordered = []
+    for index in range(max((len(group) for group in groups), default=0)):
+        for group in groups:
+            if index < len(group):
+                ordered.append(group[index])
+    return ordered
+
+
+def resolve(host: str, port: int, sock_type: int = socket.SOCK_STREAM) -> List[Tuple]:
+    """解析上游地址，返回交替排列的(family, sockaddr)列表，解析失败时抛出socket.gaierror"""
+    infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC, sock_type)
+    seen = set()
+    addresses = []
+    for family, _, _, _, sockaddr in infos:
+        if (family, sockaddr) not in seen:
+            seen.add((family, sockaddr))
+            addresses.append((family, sockaddr))
+    return interleave_addresses(addresses)
+
+
+def connect(host: str, port: int, timeout: Optional[float] = None, attempt_delay: float = DEFAULT_ATTEMPT_DELAY,
+            resolver: Optional[Callable] = None) -> socket.socket:
+    """
+    以happy eyeballs方式连接上游，返回阻塞模式的已连接套接字。
+    每个地址的尝试之间间隔attempt_delay秒，某个尝试失败时立即开始下一个；
+    timeout为整体超时（None表示不超时），超时抛出socket.timeout，全部失败时抛出最后一个错误。
+    resolver与resolve签名相同（如解析缓存），默认直接调用getaddrinfo
+    """
+    addresses = (resolver or resolve)(host, port)
+    if len(addresses) == 1:
+        # 只有一个地址时不需要并行尝试
+        family, sockaddr = addresses[0]
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(sockaddr)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    deadline = time.monotonic() + timeout if timeout else None
+    selector = selectors.DefaultSelector()
+    pending = list(addresses)
+    last_error: Optional[Exception] = None
+    winner = None
+    try:
+        next_attempt = time.monotonic()
+        while winner is None:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise socket.timeout(f"连接 {host}:{port} 超时")
+            # 到时间或当前没有进行中的尝试时，发起下一个地址的连接
+            if pending and (now >= next_attempt or not selector.get_map()):
+                family, sockaddr = pending.pop(0)
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                error = sock.connect_ex(sockaddr)
+                if error in _CONNECT_IN_PROGRESS:
+                    selector.register(sock, selectors.EVENT_WRITE, sockaddr)
+                else:
+                    sock.close()
+                    last_error = OSError(error, f"连接 {sockaddr} 失败")
+                next_attempt = now + attempt_delay
+                continue
+
+            if not selector.get_map():
+                raise last_error or OSError(f"无法连接 {host}:{port}")
+
+            wait = next_attempt - now if pending else None
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error == 0 and winner is None:
+                    winner = sock
+                else:
+                    sock.close()
+                    if error:
+                        last_error = OSError(error, f"连接 {key.data} 失败")
+                        # 失败的尝试不再占用间隔，立即尝试下一个地址
+                        next_attempt = time.monotonic()
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+    winner.setblocking(True)
+    return winner
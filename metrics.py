@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+转发流量统计模块
+按规则统计连接数、字节数、连接失败次数、空闲超时次数以及上游连接耗时和会话时长直方图。
+计数器按线程分片：每个线程只写自己的分片，热路径上不加锁，读取时再汇总各分片。
+"""
+
+import bisect
+import threading
+from typing import Dict, List, Optional
+
+# 直方图桶上界（秒），最后隐含一个+Inf桶
+CONNECT_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SESSION_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# 分片计数器下标
+OPENED = 0
+CLOSED = 1
+BYTES_IN = 2
+BYTES_OUT = 3
+CONNECT_FAILURES = 4
+IDLE_TIMEOUTS = 5
+COUNTER_COUNT = 6
+
+
+class HistogramShard:
+    """单个分片上的直方图"""
+
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """记录一个观测值"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsShard:
+    """单个线程的计数分片"""
+
+    __slots__ = ('counters', 'connect_time', 'session_duration')
+
+    def __init__(self):
+        self.counters = [0] * COUNTER_COUNT
+        self.connect_time = HistogramShard(CONNECT_TIME_BUCKETS)
+        self.session_duration = HistogramShard(SESSION_DURATION_BUCKETS)
+
+
+def _merge_histograms(shards: List[HistogramShard], bounds: tuple) -> dict:
+    """汇总各分片的直方图"""
+    counts = [0] * (len(bounds) + 1)
+    total = 0.0
+    count = 0
+    for shard in shards:
+        for index, value in enumerate(shard.counts):
+            counts[index] += value
+        total += shard.total
+        count += shard.count
+    return {
+        'buckets': list(bounds),
+        'counts': counts,
+        'sum': total,
+        'count': count
+    }
+
+
+def merge_snapshots(snapshots: List[dict]) -> dict:
+    """汇总多个进程中同一规则的统计快照"""
+    merged = {key: sum(snapshot[key] for snapshot in snapshots)
+              for key in ('active_connections', 'total_connections', 'bytes_in', 'bytes_out',
+                          'connect_failures', 'idle_timeouts')}
+    for key in ('connect_time', 'session_duration'):
+        histograms = [snapshot[key] for snapshot in snapshots]
+        merged[key] = {
+            'buckets': list(histograms[0]['buckets']),
+            'counts': [sum(counts) for counts in zip(*(histogram['counts'] for histogram in histograms))],
+            'sum': sum(histogram['sum'] for histogram in histograms),
+            'count': sum(histogram['count'] for histogram in histograms)
+        }
+    return merged
+
+
+class RuleMetrics:
+    """单条规则的流量统计"""
+
+    def __init__(self, rule_name: str):
+        self.rule_name = rule_name
+        self._local = threading.local()
+        self._shards: List[MetricsShard] = []
+        self._lock = threading.Lock()
+
+    def shard(self) -> MetricsShard:
+        """获取当前线程的分片（仅首次创建时加锁）"""
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = MetricsShard()
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def connection_opened(self):
+        """记录新连接"""
+        self.shard().counters[OPENED] += 1
+
+    def connection_closed(self, duration: float):
+        """记录连接关闭及会话时长"""
+        shard = self.shard()
+        shard.counters[CLOSED] += 1
+        shard.session_duration.observe(duration)
+
+    def connect_succeeded(self, elapsed: float):
+        """记录上游连接耗时"""
+        self.shard().connect_time.observe(elapsed)
+
+    def connect_failed(self):
+        """记录上游连接失败"""
+        self.shard().counters[CONNECT_FAILURES] += 1
+
+    def idle_timed_out(self):
+        """记录因空闲超时而关闭的会话"""
+        self.shard().counters[IDLE_TIMEOUTS] += 1
+
+    def snapshot(self) -> dict:
+        """汇总所有分片，返回统计快照"""
+        with self._lock:
+            shards = list(self._shards)
+
+        counters = [0] * COUNTER_COUNT
+        for shard in shards:
+            for index, value in enumerate(shard.counters):
+                counters[index] += value
+
+        return {
+            'active_connections': max(counters[OPENED] - counters[CLOSED], 0),
+            'total_connections': counters[OPENED],
+            'bytes_in': counters[BYTES_IN],
+            'bytes_out': counters[BYTES_OUT],
+            'connect_failures': counters[CONNECT_FAILURES],
+            'idle_timeouts': counters[IDLE_TIMEOUTS],
+            'connect_time': _merge_histograms([shard.connect_time for shard in shards], CONNECT_TIME_BUCKETS),
+            'session_duration': _merge_histograms([shard.session_duration for shard in shards], SESSION_DURATION_BUCKETS)
+        }
+
+
+class MetricsRegistry:
+    """所有规则的流量统计"""
+
+    def __init__(self):
+        self.rules: Dict[str, RuleMetrics] = {}
+        self._lock = threading.Lock()
+
+    def get(self, rule_name: str) -> RuleMetrics:
+        """获取规则的统计对象（不存在时创建）"""
+        metrics = self.rules.get(rule_name)
+        if metrics is None:
+            with self._lock:
+                metrics = self.rules.setdefault(rule_name, RuleMetrics(rule_name))
+        return metrics
+
+    def remove(self, rule_name: str):
+        """删除规则的统计"""
+        with self._lock:
+            self.rules.pop(rule_name, None)
+
+    def snapshot(self, rule_name: str) -> Optional[dict]:
+        """获取单条规则的统计快照"""
+        metrics = self.rules.get(rule_name)
+        return metrics.snapshot() if metrics else None
+
+    def snapshot_all(self) -> Dict[str, dict]:
+        """获取所有规则的统计快照"""
+        return {name: metrics.snapshot() for name, metrics in list(self.rules.items())}
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prometheus/OpenMetrics指标导出模块
+在独立线程中提供HTTP /metrics端点，输出各规则的吞吐、连接数、上游错误等指标。
+渲染结果按cache_ttl缓存，并发抓取合并为一次渲染；多进程模式下输出各工作进程汇总后的统计。
+"""
+
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+# 渲染结果缓存时间（秒）
+DEFAULT_CACHE_TTL = 1.0
+PREFIX = 'portforwarder'
+
+# 规则级指标族: (名称, 类型, 说明)
+RULE_FAMILIES = (
+    ('connections_active', 'gauge', '当前活动连接数'),
+    ('connections', 'counter', '累计接受的连接数'),
+    ('received_bytes', 'counter', '从客户端转发到上游的字节数'),
+    ('sent_bytes', 'counter', '从上游转发到客户端的字节数'),
+    ('upstream_connect_failures', 'counter', '上游连接失败次数'),
+    ('rejected_connections', 'counter', '准入控制拒绝的连接数'),
+    ('idle_timeouts', 'counter', '因空闲超时关闭的会话数'),
+    ('upstream_connect_seconds', 'histogram', '上游连接耗时'),
+    ('session_duration_seconds', 'histogram', '会话时长'),
+)
+
+
+def _escape(value: str) -> str:
+    """转义标签值"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_bound(bound: float) -> str:
+    """格式化直方图桶上界"""
+    return repr(float(bound))
+
+
+def _histogram_lines(name: str, labels: str, histogram: dict) -> List[str]:
+    """渲染直方图样本（累计桶）"""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram['buckets'], histogram['counts']):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{_format_bound(bound)}"}} {cumulative}')
+    cumulative += histogram['counts'][-1]
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram["sum"]}')
+    lines.append(f'{name}_count{{{labels}}} {histogram["count"]}')
+    return lines
+
+
+class MetricsExporter:
+    """OpenMetrics HTTP导出器"""
+
+    def __init__(self, forwarder, port: int, host: str = '0.0.0.0', cache_ttl: float = DEFAULT_CACHE_TTL,
+                 logger: Optional[logging.Logger] = None):
+        self.forwarder = forwarder
+        self.host = host
+        self.port = port
+        self.cache_ttl = cache_ttl
+        self.logger = logger or logging.getLogger('PortForwarder')
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.thread: Optional[threading.Thread] = None
+        self._cache: bytes = b''
+        self._cache_time = 0.0
+        self._render_lock = threading.Lock()
+
+    def start(self) -> bool:
+        """启动HTTP服务（已启动时直接返回）"""
+        if self.server:
+            return True
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = exporter.render()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # 抓取请求频繁，不写访问日志
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.server.daemon_threads = True
+            self.thread = threading.Thread(target=self.server.serve_forever, name='MetricsExporter')
+            self.thread.daemon = True
+            self.thread.start()
+            self.logger.info(f"指标导出已启动: http://{self.host}:{self.port}/metrics")
+            return True
+        except Exception as e:
+            self.logger.error(f"启动指标导出失败: {str(e)}")
+            self.server = None
+            return False
+
+    def stop(self):
+        """停止HTTP服务"""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.thread = None
+
+    def render(self) -> bytes:
+        """渲染指标文本，在cache_ttl内直接返回缓存"""
+        now = time.monotonic()
+        if self._cache and now - self._cache_time < self.cache_ttl:
+            return self._cache
+
+        with self._render_lock:
+            # 等锁期间其他线程可能已完成渲染
+            if self._cache and time.monotonic() - self._cache_time < self.cache_ttl:
+                return self._cache
+            self._cache = self._render().encode('utf-8')
+            self._cache_time = time.monotonic()
+            return self._cache
+
+    def _rule_lines(self, rule_name: str, stats: dict, rejected: int) -> Dict[str, List[str]]:
+        """渲染单条规则的各指标族文本"""
+        labels = f'rule="{_escape(rule_name)}"'
+        return {
+            'connections_active': [f'{PREFIX}_connections_active{{{labels}}} {stats["active_connections"]}'],
+            'connections': [f'{PREFIX}_connections_total{{{labels}}} {stats["total_connections"]}'],
+            'received_bytes': [f'{PREFIX}_received_bytes_total{{{labels}}} {stats["bytes_in"]}'],
+            'sent_bytes': [f'{PREFIX}_sent_bytes_total{{{labels}}} {stats["bytes_out"]}'],
+            'upstream_connect_failures': [f'{PREFIX}_upstream_connect_failures_total{{{labels}}} {stats["connect_failures"]}'],
+            'rejected_connections': [f'{PREFIX}_rejected_connections_total{{{labels}}} {rejected}'],
+            'idle_timeouts': [f'{PREFIX}_idle_timeouts_total{{{labels}}} {stats["idle_timeouts"]}'],
+            'upstream_connect_seconds': _histogram_lines(f'{PREFIX}_upstream_connect_seconds', labels, stats['connect_time']),
+            'session_duration_seconds': _histogram_lines(f'{PREFIX}_session_duration_seconds', labels, stats['session_duration']),
+        }
+
+    def _render(self) -> str:
+        """渲染完整的OpenMetrics文本"""
+        report = self.forwarder.get_metrics_report()
+        rejected_by_rule = report['rejected_by_rule']
+        rule_lines = [
+            self._rule_lines(rule_name, stats, rejected_by_rule.get(rule_name, 0))
+            for rule_name, stats in sorted(report['rules'].items())
+        ]
+
+        lines = []
+        for family, metric_type, help_text in RULE_FAMILIES:
+            lines.append(f'# TYPE {PREFIX}_{family} {metric_type}')
+            lines.append(f'# HELP {PREFIX}_{family} {help_text}')
+            for families in rule_lines:
+                lines.extend(families[family])
+
+        lines.append(f'# TYPE {PREFIX}_relay_threads gauge')
+        lines.append(f'# HELP {PREFIX}_relay_threads 转发进程内的线程数（多进程模式下为各工作进程之和）')
+        lines.append(f'{PREFIX}_relay_threads {report["threads"]}')
+        lines.append(f'# TYPE {PREFIX}_relay_tasks gauge')
+        lines.append(f'# HELP {PREFIX}_relay_tasks asyncio引擎中的连接任务数')
+        lines.append(f'{PREFIX}_relay_tasks {report["relay_tasks"]}')
+        dns = report['dns']
+        lines.append(f'# TYPE {PREFIX}_dns_lookups counter')
+        lines.append(f'# HELP {PREFIX}_dns_lookups 上游域名解析缓存的查询次数（按结果）')
+        for result in ('hits', 'stale_hits', 'negative_hits', 'misses', 'coalesced'):
+            lines.append(f'{PREFIX}_dns_lookups_total{{result="{result}"}} {dns[result]}')
+        lines.append(f'# TYPE {PREFIX}_dns_cache_entries gauge')
+        lines.append(f'# HELP {PREFIX}_dns_cache_entries 解析缓存中的名称数')
+        lines.append(f'{PREFIX}_dns_cache_entries {dns["entries"]}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
@@ -5,20 +5,99 @@ Netsh Portproxy 管理模块
 用于读取、管理Windows系统中通过netsh interface portproxy添加的规则
 """
 
+import os
+import hashlib
 import subprocess
 import re
 import logging
-from typing import List, Dict, Optional, Tuple
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable, Iterator, List, Dict, Optional, Tuple
 from port_forwarder import PortForwardRule
+from portproxy_backend import DEFAULT_TABLE, TABLES, RegistryPortproxyBackend, registry_available
+
+# 命令执行器: 接收完整的netsh命令行，返回(是否成功, 输出)
+CommandRunner = Callable[[str], Tuple[bool, str]]
+
+# 规则的唯一标识: (表, 展开后的监听地址, 监听端口)
+PortproxyKey = Tuple[str, str, int]
+# 本工具即将写入的规则状态列表: (规则标识, 写入后的(连接地址, 连接端口)，删除时为None)
+WriteObserver = Callable[[List[Tuple[PortproxyKey, Optional[Tuple[str, int]]]]], None]
+
+# 规则快照的默认缓存时间（秒）
+DEFAULT_CACHE_TTL = 5.0
+
+# 批处理拆分为多个netsh脚本并行执行: 同时运行的netsh进程数、每个脚本的最大操作数
+DEFAULT_BATCH_PARALLELISM = 4
+DEFAULT_BATCH_CHUNK_SIZE = 50
+# 单次netsh调用的超时时间（秒）；netsh -f脚本的超时在此基础上按操作数增加
+DEFAULT_COMMAND_TIMEOUT = 30.0
+DEFAULT_OPERATION_TIMEOUT = 2.0
+# netsh子进程超时时返回的输出
+COMMAND_TIMEOUT_OUTPUT = '命令执行超时'
+
+# 存储后端: netsh为子进程方式，registry为直接读写注册表，auto在可用时使用注册表
+BACKEND_NETSH = 'netsh'
+BACKEND_REGISTRY = 'registry'
+BACKEND_AUTO = 'auto'
+
+# show all输出中的数据行（"监听地址 端口 连接地址 端口"，地址可以是IPv4、IPv6或主机名）
+# 和表头（如"Listen on ipv4:  Connect to ipv6:"或"侦听 ipv4:  连接到 ipv6:"），一次finditer扫描整个输出；
+# 数据行远多于表头，放在前面的分支可以尽早匹配
+_SHOW_OUTPUT_PATTERN = re.compile(
+    r'^[^\S\n]*(?:'
+    r'(\S+)[^\S\n]+(\d{1,5})[^\S\n]+(\S+)[^\S\n]+(\d{1,5})[^\S\n]*'
+    r'|[^\n]*?\b(ipv[46])[^\S\n]*[:：][^\n]*?\b(ipv[46])[^\S\n]*[:：][^\n]*'
+    r')$',
+    re.MULTILINE | re.IGNORECASE
+)
+
+
+def parse_show_output(output: str) -> Iterator['NetshPortproxyRule']:
+    """
+    流式解析netsh interface portproxy show all的输出（中英文均可）
+    按表头记录当前所在的表（v4tov4/v4tov6/v6tov4/v6tov6），表头之前的行忽略
+    """
+    table = None
+    wildcard = None
+    for listen_address, listen_port, connect_address, connect_port, listen_family, connect_family in (
+            match.groups() for match in _SHOW_OUTPUT_PATTERN.finditer(output)):
+        if listen_family:
+            table = f'v{listen_family[-1]}tov{connect_family[-1]}'
+            wildcard = _listen_address_for_table('*', table)
+            continue
+        
+        if table is None:
+            continue
+        listen_port = int(listen_port)
+        connect_port = int(connect_port)
+        if listen_port > 65535 or connect_port > 65535:
+            continue
+        
+        yield NetshPortproxyRule(
+            wildcard if listen_address == '*' else listen_address,
+            listen_port,
+            connect_address,
+            connect_port,
+            table=table
+        )
+
 
 class NetshPortproxyRule:
     """Netsh Portproxy规则类"""
     
-    def __init__(self, listen_address: str, listen_port: int, connect_address: str, connect_port: int):
+    def __init__(self, listen_address: str, listen_port: int, connect_address: str, connect_port: int,
+                 name: Optional[str] = None, table: str = DEFAULT_TABLE):
         self.listen_address = listen_address
         self.listen_port = listen_port
         self.connect_address = connect_address
         self.connect_port = connect_port
+        # 规则名称，netsh本身不保存名称，默认按监听端口生成
+        self.name = name or f"Rule_{listen_port}"
+        # 所在的portproxy表
+        self.table = table
         
     def to_dict(self) -> dict:
         """转换为字典"""
@@ -26,7 +105,8 @@ class NetshPortproxyRule:
             'listen_address': self.listen_address,
             'listen_port': self.listen_port,
             'connect_address': self.connect_address,
-            'connect_port': self.connect_port
+            'connect_port': self.connect_port,
+            'table': self.table
         }
     
     def to_port_forward_rule(self, name: str = None) -> PortForwardRule:
@@ -51,13 +131,161 @@ class NetshPortproxyRule:
         return (self.listen_address == other.listen_address and 
                 self.listen_port == other.listen_port and
                 self.connect_address == other.connect_address and
-                self.connect_port == other.connect_port)
+                self.connect_port == other.connect_port and
+                self.table == other.table)
+
+def _normalize_listen_address(address: str) -> str:
+    """统一监听地址写法（show输出中的*解析为0.0.0.0）"""
+    return '0.0.0.0' if address in ('*', '') else address
+
+
+def _listen_address_for_table(address: str, table: str) -> str:
+    """将通配监听地址按表的监听协议展开"""
+    if address not in ('*', ''):
+        return address
+    return '0.0.0.0' if table.startswith('v4') else '::'
+
+
+def _command_listen_address(address: str, table: str = DEFAULT_TABLE) -> str:
+    """show输出把*展开为0.0.0.0或::，写回netsh时仍使用*，与添加规则时的写法一致"""
+    return '*' if address == _listen_address_for_table('*', table) else address
+
+
+def portproxy_key(table: str, listen_address: str, listen_port: int) -> PortproxyKey:
+    """规则在portproxy中的唯一标识：(表, 展开后的监听地址, 监听端口)"""
+    return (table, _listen_address_for_table(listen_address, table), listen_port)
+
+
+class PortproxySnapshot:
+    """portproxy规则表快照，带按名称、监听端口和(监听地址, 端口)的索引"""
+    
+    def __init__(self, rules: List[NetshPortproxyRule]):
+        self.rules = rules
+        self.taken_at = time.monotonic()
+        self.by_name: Dict[str, NetshPortproxyRule] = {}
+        self.by_port: Dict[int, List[NetshPortproxyRule]] = {}
+        self.by_address: Dict[Tuple[str, int], NetshPortproxyRule] = {}
+        for rule in rules:
+            # 同名规则（同一端口多个监听地址）保留第一个，与原来的顺序查找结果一致
+            self.by_name.setdefault(rule.name, rule)
+            self.by_port.setdefault(rule.listen_port, []).append(rule)
+            self.by_address[(_normalize_listen_address(rule.listen_address), rule.listen_port)] = rule
+    
+    def rules_on_port(self, listen_port: int, table: Optional[str] = None) -> List[NetshPortproxyRule]:
+        """监听端口上的规则，table不为空时只返回该表中的规则"""
+        rules = self.by_port.get(listen_port, [])
+        return [rule for rule in rules if rule.table == table] if table else list(rules)
+    
+    def rule_named(self, name: str, table: Optional[str] = None) -> Optional[NetshPortproxyRule]:
+        """按名称查找规则，table不为空时只查找该表中的规则"""
+        rule = self.by_name.get(name)
+        if rule is None or table is None or rule.table == table:
+            return rule
+        # 同名规则在同一端口上，按端口索引查找指定表中的规则
+        return next((other for other in self.by_port.get(rule.listen_port, [])
+                     if other.table == table and other.name == name), None)
+
+
+class NetshBatchOperation:
+    """批处理中的单个portproxy操作"""
+    
+    def __init__(self, action: str, listen_port: int, listen_address: str = "*",
+                 connect_address: Optional[str] = None, connect_port: Optional[int] = None,
+                 table: str = DEFAULT_TABLE):
+        self.action = action
+        self.listen_port = listen_port
+        self.listen_address = listen_address
+        self.connect_address = connect_address
+        self.connect_port = connect_port
+        # 操作的portproxy表
+        self.table = table
+        self.success = False
+        self.message = ''
+        # 执行耗时（秒）；netsh脚本中的操作记为所在脚本的耗时
+        self.elapsed = 0.0
+    
+    @property
+    def key(self) -> PortproxyKey:
+        """操作针对的表、监听地址和端口"""
+        return portproxy_key(self.table, self.listen_address, self.listen_port)
+    
+    def to_command(self) -> str:
+        """转换为netsh脚本中的一行命令（不含netsh前缀）"""
+        if self.action == 'add':
+            return (f'interface portproxy add {self.table} listenaddress={self.listen_address} listenport={self.listen_port} '
+                    f'connectaddress={self.connect_address} connectport={self.connect_port}')
+        return f'interface portproxy delete {self.table} listenaddress={self.listen_address} listenport={self.listen_port}'
+    
+    def __str__(self):
+        if self.action == 'add':
+            return f"add {self.listen_address}:{self.listen_port} -> {self.connect_address}:{self.connect_port}"
+        return f"delete {self.listen_address}:{self.listen_port}"
+
+
+class NetshBatch:
+    """netsh批处理：收集多个添加/删除操作，通过一次netsh -f脚本调用执行"""
+    
+    def __init__(self, manager: 'NetshManager'):
+        self.manager = manager
+        self.operations: List[NetshBatchOperation] = []
+        self.committed = False
+    
+    def add(self, listen_port: int, connect_address: str, connect_port: int, listen_address: str = "*") -> NetshBatchOperation:
+        """加入添加规则操作"""
+        operation = NetshBatchOperation('add', listen_port, listen_address, connect_address, connect_port)
+        self.operations.append(operation)
+        return operation
+    
+    def delete(self, listen_port: int, listen_address: str = "*", table: str = DEFAULT_TABLE) -> NetshBatchOperation:
+        """加入删除规则操作"""
+        operation = NetshBatchOperation('delete', listen_port, listen_address, table=table)
+        self.operations.append(operation)
+        return operation
+    
+    def commit(self) -> List[NetshBatchOperation]:
+        """执行所有操作，返回带有结果的操作列表"""
+        if not self.committed:
+            self.committed = True
+            self.manager.apply_batch(self.operations)
+        return self.operations
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
+
 
 class NetshManager:
     """Netsh Portproxy管理器"""
     
-    def __init__(self):
+    def __init__(self, command_runner: Optional[CommandRunner] = None, cache_ttl: float = DEFAULT_CACHE_TTL,
+                 backend: str = BACKEND_NETSH, registry=None, parallelism: int = DEFAULT_BATCH_PARALLELISM,
+                 chunk_size: int = DEFAULT_BATCH_CHUNK_SIZE, command_timeout: float = DEFAULT_COMMAND_TIMEOUT,
+                 operation_timeout: float = DEFAULT_OPERATION_TIMEOUT):
         self.logger = self._setup_logger()
+        # 可注入的命令执行器，便于在非Windows环境下用模拟的netsh测试
+        self.command_runner = command_runner or self._run_subprocess
+        # 注册表后端，为None时所有操作通过netsh子进程完成；注册表操作失败时也会退回到netsh
+        self.registry_backend = self._create_registry_backend(backend, registry)
+        # 规则表快照缓存，超过cache_ttl或本工具修改规则后重新读取
+        self.cache_ttl = cache_ttl
+        self._snapshot: Optional[PortproxySnapshot] = None
+        self._snapshot_lock = threading.Lock()
+        # 大批量操作拆分后并行执行，线程池按需创建
+        self.parallelism = max(int(parallelism), 1)
+        self.chunk_size = max(int(chunk_size), 1)
+        # 单条命令的超时；脚本的超时为command_timeout加上每个操作operation_timeout
+        self.command_timeout = command_timeout
+        self.operation_timeout = operation_timeout
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        # 由PortproxyWatcher设置：监视器运行时外部修改会被及时发现，快照不再按cache_ttl过期
+        self.watched = False
+        # 修改规则前通知的观察者（PortproxyWatcher据此区分本工具的修改和外部修改）
+        self.write_observers: List[WriteObserver] = []
         
     def _setup_logger(self) -> logging.Logger:
         """设置日志"""
@@ -72,8 +300,34 @@ class NetshManager:
             
         return logger
     
-    def _run_netsh_command(self, command: str) -> Tuple[bool, str]:
-        """执行netsh命令"""
+    def _create_registry_backend(self, backend: str, registry) -> Optional[RegistryPortproxyBackend]:
+        """按配置创建注册表后端"""
+        if backend not in (BACKEND_NETSH, BACKEND_REGISTRY, BACKEND_AUTO):
+            raise ValueError(f"不支持的存储后端: {backend}")
+        
+        if backend == BACKEND_NETSH:
+            return None
+        
+        if registry is None and not registry_available():
+            if backend == BACKEND_REGISTRY:
+                self.logger.warning("当前环境无法访问注册表，使用netsh子进程后端")
+            return None
+        
+        return RegistryPortproxyBackend(registry)
+    
+    @property
+    def backend_name(self) -> str:
+        """当前使用的存储后端名称"""
+        return BACKEND_REGISTRY if self.registry_backend else BACKEND_NETSH
+    
+    def _run_netsh_command(self, command: str, timeout: Optional[float] = None) -> Tuple[bool, str]:
+        """执行netsh命令，timeout为空时使用command_timeout（注入的命令执行器自行处理超时）"""
+        if timeout is not None and self.command_runner == self._run_subprocess:
+            return self._run_subprocess(command, timeout)
+        return self.command_runner(command)
+    
+    def _run_subprocess(self, command: str, timeout: Optional[float] = None) -> Tuple[bool, str]:
+        """通过cmd子进程执行netsh命令"""
         try:
             # 使用chcp 65001确保UTF-8编码
             full_command = f'chcp 65001 >nul && {command}'
@@ -83,7 +337,7 @@ class NetshManager:
                 capture_output=True,
                 text=True,
                 encoding='utf-8',
-                timeout=30
+                timeout=timeout or self.command_timeout
             )
             
             if result.returncode == 0:
@@ -94,13 +348,106 @@ class NetshManager:
                 
         except subprocess.TimeoutExpired:
             self.logger.error("Netsh命令执行超时")
-            return False, "命令执行超时"
+            return False, COMMAND_TIMEOUT_OUTPUT
         except Exception as e:
             self.logger.error(f"执行netsh命令时发生错误: {str(e)}")
             return False, str(e)
     
-    def get_all_portproxy_rules(self) -> List[NetshPortproxyRule]:
-        """获取所有netsh portproxy规则"""
+    def get_snapshot(self, refresh: bool = False) -> PortproxySnapshot:
+        """获取规则表快照（缓存未过期时不启动子进程）"""
+        snapshot = self._snapshot
+        if not refresh and self._is_fresh(snapshot):
+            return snapshot
+        
+        with self._snapshot_lock:
+            # 等锁期间其他线程可能已刷新
+            snapshot = self._snapshot
+            if not refresh and self._is_fresh(snapshot):
+                return snapshot
+            snapshot = PortproxySnapshot(self._fetch_portproxy_rules())
+            self._snapshot = snapshot
+            return snapshot
+    
+    def _is_fresh(self, snapshot: Optional[PortproxySnapshot]) -> bool:
+        """快照是否可以直接使用"""
+        if snapshot is None:
+            return False
+        return self.watched or time.monotonic() - snapshot.taken_at < self.cache_ttl
+    
+    def refresh_if_changed(self, fingerprint: Optional[Hashable]) -> Tuple[Hashable, Optional[PortproxySnapshot]]:
+        """
+        读取规则表指纹，与上次的指纹不同时刷新快照
+        注册表后端直接比较原始值；netsh后端比较show输出的哈希，变化时解析同一份输出，不再启动第二个子进程。
+        返回(新指纹, 新快照)，未变化时快照为None
+        """
+        if self.registry_backend:
+            try:
+                current = self.registry_backend.fingerprint()
+                if current == fingerprint:
+                    return current, None
+                return current, self.get_snapshot(refresh=True)
+            except Exception as e:
+                self.logger.warning(f"读取注册表指纹失败，改用netsh: {str(e)}")
+        
+        success, output = self._run_netsh_command('netsh interface portproxy show all')
+        if not success:
+            # 读取失败时保留原指纹，下次重试
+            return fingerprint, None
+        current = hashlib.sha1(output.encode('utf-8')).hexdigest()
+        if current == fingerprint:
+            return current, None
+        
+        with self._snapshot_lock:
+            snapshot = PortproxySnapshot(self._parse_show_output(output))
+            self._snapshot = snapshot
+        return current, snapshot
+    
+    def invalidate_cache(self):
+        """使规则表快照失效（本工具修改规则后调用）"""
+        self._snapshot = None
+    
+    def _announce_writes(self, writes: List[Tuple[PortproxyKey, Optional[Tuple[str, int]]]]):
+        """修改规则前通知观察者即将写入的状态"""
+        for observer in list(self.write_observers):
+            try:
+                observer(writes)
+            except Exception as e:
+                self.logger.error(f"通知规则修改失败: {str(e)}")
+    
+    def find_rule_by_name(self, name: str, table: Optional[str] = None) -> Optional[NetshPortproxyRule]:
+        """按名称查找规则，table不为空时只查找该表"""
+        return self.get_snapshot().rule_named(name, table)
+    
+    def find_rules_by_port(self, listen_port: int, table: Optional[str] = None) -> List[NetshPortproxyRule]:
+        """按监听端口查找规则，table不为空时只查找该表"""
+        return self.get_snapshot().rules_on_port(listen_port, table)
+    
+    def find_rule(self, listen_address: str, listen_port: int) -> Optional[NetshPortproxyRule]:
+        """按监听地址和端口查找规则"""
+        return self.get_snapshot().by_address.get((_normalize_listen_address(listen_address), listen_port))
+    
+    def get_all_portproxy_rules(self, table: Optional[str] = None) -> List[NetshPortproxyRule]:
+        """获取所有netsh portproxy规则，table不为空时只返回该表中的规则"""
+        rules = self.get_snapshot().rules
+        return [rule for rule in rules if rule.table == table] if table else list(rules)
+    
+    def _fetch_portproxy_rules(self) -> List[NetshPortproxyRule]:
+        """读取所有portproxy规则（优先从注册表读取）"""
+        if self.registry_backend:
+            try:
+                return [
+                    NetshPortproxyRule(_listen_address_for_table(listen_address, table), listen_port,
+                                       connect_address, connect_port, table=table)
+                    for table in TABLES
+                    for listen_address, listen_port, connect_address, connect_port in self.registry_backend.list_entries(table)
+                ]
+            except Exception as e:
+                self.logger.warning(f"从注册表读取portproxy规则失败，改用netsh: {str(e)}")
+        
+        return self._fetch_portproxy_rules_from_netsh()
+    
+    def _fetch_portproxy_rules_from_netsh(self) -> List[NetshPortproxyRule]:
+        """执行netsh命令读取所有portproxy规则"""
         try:
             success, output = self._run_netsh_command('netsh interface portproxy show all')
             
@@ -108,84 +455,39 @@ class NetshManager:
                 self.logger.error(f"获取portproxy规则失败: {output}")
                 return []
             
-            rules = []
-            lines = output.split('\n')
-            
-            # 查找规则表格开始位置
-            table_started = False
-            for line in lines:
-                line = line.strip()
-                
-                # 跳过空行和标题行
-                if not line or '监听' in line or 'Listen' in line or '---' in line:
-                    if '监听' in line or 'Listen' in line:
-                        table_started = True
-                    continue
-                
-                if not table_started:
-                    continue
-                
-                # 解析规则行
-                # 格式通常为: 监听地址:端口 连接地址:端口
-                # 或者: Listen Address:Port Connect Address:Port
-                rule = self._parse_rule_line(line)
-                if rule:
-                    rules.append(rule)
-            
-            self.logger.info(f"找到 {len(rules)} 个netsh portproxy规则")
-            return rules
+            return self._parse_show_output(output)
             
         except Exception as e:
             self.logger.error(f"获取portproxy规则时发生错误: {str(e)}")
             return []
     
-    def _parse_rule_line(self, line: str) -> Optional[NetshPortproxyRule]:
-        """解析规则行"""
+    def _parse_show_output(self, output: str) -> List[NetshPortproxyRule]:
+        """解析show all命令的输出"""
         try:
-            # 移除多余空格
-            line = re.sub(r'\s+', ' ', line.strip())
-            
-            # 尝试多种格式解析
-            patterns = [
-                # 格式1: 192.168.1.1:8080 192.168.1.2:80
-                r'([\d\.]+):(\d+)\s+([\d\.]+):(\d+)',
-                # 格式2: *:8080 192.168.1.2:80
-                r'(\*|[\d\.]+):(\d+)\s+([\d\.]+):(\d+)',
-                # 格式3: 带空格的格式
-                r'([\d\.\*]+)\s+(\d+)\s+([\d\.]+)\s+(\d+)'
-            ]
-            
-            for pattern in patterns:
-                match = re.search(pattern, line)
-                if match:
-                    listen_addr = match.group(1)
-                    listen_port = int(match.group(2))
-                    connect_addr = match.group(3)
-                    connect_port = int(match.group(4))
-                    
-                    # 将*转换为0.0.0.0
-                    if listen_addr == '*':
-                        listen_addr = '0.0.0.0'
-                    
-                    return NetshPortproxyRule(
-                        listen_address=listen_addr,
-                        listen_port=listen_port,
-                        connect_address=connect_addr,
-                        connect_port=connect_port
-                    )
-            
-            return None
-            
+            rules = list(parse_show_output(output))
+            self.logger.info(f"找到 {len(rules)} 个netsh portproxy规则")
+            return rules
         except Exception as e:
-            self.logger.warning(f"解析规则行失败: {line}, 错误: {str(e)}")
-            return None
+            self.logger.error(f"解析portproxy规则时发生错误: {str(e)}")
+            return []
     
     def add_portproxy_rule(self, listen_port: int, connect_address: str, connect_port: int, listen_address: str = "*") -> bool:
         """添加netsh portproxy规则"""
+        self._announce_writes([(portproxy_key(DEFAULT_TABLE, listen_address, listen_port), (connect_address, connect_port))])
+        if self.registry_backend:
+            try:
+                self.registry_backend.add(listen_port, connect_address, connect_port, listen_address)
+                self.invalidate_cache()
+                self.logger.info(f"成功添加netsh规则: {listen_address}:{listen_port} -> {connect_address}:{connect_port}")
+                return True
+            except Exception as e:
+                self.logger.warning(f"写入注册表失败，改用netsh: {str(e)}")
+        
         try:
             command = f'netsh interface portproxy add v4tov4 listenaddress={listen_address} listenport={listen_port} connectaddress={connect_address} connectport={connect_port}'
             
             success, output = self._run_netsh_command(command)
+            self.invalidate_cache()
             
             if success:
                 self.logger.info(f"成功添加netsh规则: {listen_address}:{listen_port} -> {connect_address}:{connect_port}")
@@ -198,12 +500,26 @@ class NetshManager:
             self.logger.error(f"添加netsh规则时发生错误: {str(e)}")
             return False
     
-    def delete_portproxy_rule(self, listen_port: int, listen_address: str = "*") -> bool:
+    def delete_portproxy_rule(self, listen_port: int, listen_address: str = "*", table: str = DEFAULT_TABLE) -> bool:
         """删除netsh portproxy规则"""
+        self._announce_writes([(portproxy_key(table, listen_address, listen_port), None)])
+        if self.registry_backend:
+            try:
+                existed = self.registry_backend.delete(listen_port, listen_address, table=table)
+                self.invalidate_cache()
+                if existed:
+                    self.logger.info(f"成功删除netsh规则: {listen_address}:{listen_port}")
+                else:
+                    self.logger.error(f"删除netsh规则失败: 规则 {listen_address}:{listen_port} 不存在")
+                return existed
+            except Exception as e:
+                self.logger.warning(f"删除注册表值失败，改用netsh: {str(e)}")
+        
         try:
-            command = f'netsh interface portproxy delete v4tov4 listenaddress={listen_address} listenport={listen_port}'
+            command = f'netsh interface portproxy delete {table} listenaddress={listen_address} listenport={listen_port}'
             
             success, output = self._run_netsh_command(command)
+            self.invalidate_cache()
             
             if success:
                 self.logger.info(f"成功删除netsh规则: {listen_address}:{listen_port}")
@@ -216,12 +532,195 @@ class NetshManager:
             self.logger.error(f"删除netsh规则时发生错误: {str(e)}")
             return False
     
+    def batch(self) -> NetshBatch:
+        """创建批处理，可作为上下文管理器使用，退出时自动提交"""
+        return NetshBatch(self)
+    
+    def _run_netsh_script(self, commands: List[str]) -> Tuple[bool, str]:
+        """把多条命令写入脚本文件，通过一次netsh -f调用执行"""
+        fd, script_path = tempfile.mkstemp(prefix='portproxy_', suffix='.txt')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(commands) + '\n')
+            return self._run_netsh_command(f'netsh -f "{script_path}"', self._script_timeout(len(commands)))
+        finally:
+            try:
+                os.remove(script_path)
+            except OSError:
+                pass
+    
+    def _script_timeout(self, operation_count: int) -> float:
+        """包含operation_count个操作的netsh脚本的超时时间"""
+        return self.command_timeout + self.operation_timeout * operation_count
+    
+    def _partition(self, operations: List[NetshBatchOperation]) -> List[List[NetshBatchOperation]]:
+        """按chunk_size拆分批处理，同一监听地址的操作放在同一个脚本中以保持执行顺序"""
+        groups: Dict[Tuple[str, int], List[NetshBatchOperation]] = {}
+        for operation in operations:
+            groups.setdefault(operation.key, []).append(operation)
+        
+        chunks: List[List[NetshBatchOperation]] = []
+        current: List[NetshBatchOperation] = []
+        for group in groups.values():
+            if current and len(current) + len(group) > self.chunk_size:
+                chunks.append(current)
+                current = []
+            current.extend(group)
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    def _run_chunk(self, chunk: List[NetshBatchOperation]) -> Tuple[bool, str, float]:
+        """执行一个脚本，返回(是否成功, 输出, 耗时)"""
+        start = time.perf_counter()
+        try:
+            success, output = self._run_netsh_script([operation.to_command() for operation in chunk])
+        except Exception as e:
+            success, output = False, str(e)
+        return success, output, time.perf_counter() - start
+    
+    def _run_chunks(self, chunks: List[List[NetshBatchOperation]]) -> List[Tuple[bool, str, float]]:
+        """最多parallelism个netsh进程并行执行各脚本"""
+        if len(chunks) == 1 or self.parallelism == 1:
+            return [self._run_chunk(chunk) for chunk in chunks]
+        
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.parallelism, thread_name_prefix='NetshBatch')
+        return list(self._executor.map(self._run_chunk, chunks))
+    
+    def apply_batch(self, operations: List[NetshBatchOperation]) -> bool:
+        """
+        执行批处理操作：操作较少时一次netsh脚本调用完成所有修改，较多时拆分为多个脚本并行执行，
+        最后读取一次规则表核对每个操作的结果
+        """
+        if not operations:
+            return True
+        
+        self._announce_writes([
+            (operation.key, (operation.connect_address, operation.connect_port) if operation.action == 'add' else None)
+            for operation in operations
+        ])
+        if self.registry_backend:
+            try:
+                return self._apply_batch_to_registry(operations)
+            except Exception as e:
+                self.logger.warning(f"注册表批处理失败，改用netsh: {str(e)}")
+        
+        try:
+            # 按执行前的规则表推算每个删除操作执行时规则是否存在，删除不存在的规则视为失败
+            present = {portproxy_key(rule.table, rule.listen_address, rule.listen_port) for rule in self.get_snapshot().rules}
+            missing = set()
+            for operation in operations:
+                if operation.action == 'add':
+                    present.add(operation.key)
+                elif operation.key in present:
+                    present.discard(operation.key)
+                else:
+                    missing.add(id(operation))
+            
+            chunks = self._partition(operations)
+            for chunk, (_, output, elapsed) in zip(chunks, self._run_chunks(chunks)):
+                detail = output.strip() if output else ''
+                if detail == COMMAND_TIMEOUT_OUTPUT:
+                    # 超时前已执行的操作在核对时仍记为成功，其余操作报告超时
+                    detail = f'netsh脚本执行超时（{self._script_timeout(len(chunk)):g}秒内未完成{len(chunk)}个操作）'
+                for operation in chunk:
+                    operation.elapsed = elapsed
+                    # 先记录所在脚本的输出，核对成功后清空
+                    operation.message = detail
+            self.invalidate_cache()
+            
+            # 按操作顺序推算每个监听地址的最终期望状态（None表示应不存在）
+            expected: Dict[PortproxyKey, Optional[Tuple[str, int]]] = {}
+            for operation in operations:
+                if operation.action == 'add':
+                    expected[operation.key] = (operation.connect_address, operation.connect_port)
+                else:
+                    expected[operation.key] = None
+            
+            actual = {
+                portproxy_key(rule.table, rule.listen_address, rule.listen_port): (rule.connect_address, rule.connect_port)
+                for rule in self.get_snapshot(refresh=True).rules
+            }
+            
+            # 同一监听地址上的多个操作以最终状态为准
+            for operation in operations:
+                if id(operation) in missing:
+                    operation.success = False
+                    operation.message = '规则不存在'
+                    continue
+                operation.success = actual.get(operation.key) == expected[operation.key]
+                if operation.success:
+                    operation.message = ''
+                elif not operation.message:
+                    operation.message = '规则表状态与期望不一致'
+            
+            failed = [operation for operation in operations if not operation.success]
+            if failed:
+                self.logger.error(f"批处理中 {len(failed)}/{len(operations)} 个操作失败: {', '.join(str(op) for op in failed)}")
+            else:
+                self.logger.info(f"批处理成功执行 {len(operations)} 个操作")
+            return not failed
+            
+        except Exception as e:
+            self.logger.error(f"执行netsh批处理时发生错误: {str(e)}")
+            for operation in operations:
+                operation.success = False
+                operation.message = str(e)
+            return False
+    
+    def _apply_batch_to_registry(self, operations: List[NetshBatchOperation]) -> bool:
+        """直接在注册表中执行批处理，全部完成后只通知服务一次"""
+        try:
+            for operation in operations:
+                start = time.perf_counter()
+                if operation.action == 'add':
+                    self.registry_backend.add(operation.listen_port, operation.connect_address, operation.connect_port,
+                                              operation.listen_address, notify=False, table=operation.table)
+                    operation.success = True
+                else:
+                    operation.success = self.registry_backend.delete(operation.listen_port, operation.listen_address,
+                                                                     notify=False, table=operation.table)
+                    if not operation.success:
+                        operation.message = '规则不存在'
+                operation.elapsed = time.perf_counter() - start
+        finally:
+            self.invalidate_cache()
+        
+        self.registry_backend.notify()
+        failed = [operation for operation in operations if not operation.success]
+        if failed:
+            self.logger.error(f"批处理中 {len(failed)}/{len(operations)} 个操作失败: {', '.join(str(op) for op in failed)}")
+        else:
+            self.logger.info(f"批处理成功执行 {len(operations)} 个操作")
+        return not failed
+    
+    def close(self):
+        """释放批处理线程池"""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+    
     def clear_all_portproxy_rules(self) -> bool:
         """清除所有netsh portproxy规则"""
+        self._announce_writes([(portproxy_key(rule.table, rule.listen_address, rule.listen_port), None)
+                               for rule in self.get_snapshot().rules])
+        if self.registry_backend:
+            try:
+                self.registry_backend.reset()
+                self.invalidate_cache()
+                self.logger.info("成功清除所有netsh portproxy规则")
+                return True
+            except Exception as e:
+                self.logger.warning(f"清除注册表值失败，改用netsh: {str(e)}")
+        
         try:
             command = 'netsh interface portproxy reset'
             
             success, output = self._run_netsh_command(command)
+            self.invalidate_cache()
             
             if success:
                 self.logger.info("成功清除所有netsh portproxy规则")
@@ -238,11 +737,9 @@ class NetshManager:
         """将应用规则同步到netsh"""
         try:
             # 先检查是否已存在相同规则
-            existing_rules = self.get_all_portproxy_rules()
-            for existing_rule in existing_rules:
-                if existing_rule.listen_port == rule.local_port:
-                    # 如果已存在，先删除
-                    self.delete_portproxy_rule(existing_rule.listen_port, existing_rule.listen_address)
+            for existing_rule in self.find_rules_by_port(rule.local_port):
+                # 如果已存在，先删除
+                self.delete_portproxy_rule(existing_rule.listen_port, existing_rule.listen_address)
             
             # 添加新规则
             return self.add_portproxy_rule(
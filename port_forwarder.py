@@ -5,24 +5,165 @@
 """
 
 import socket
+import selectors
 import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Tuple
+from async_engine import AsyncForwardEngine
+from relay import (RELAY_AUTO, resolve_relay_backend, create_relay_channel, tune_socket, shutdown_write,
+                   DEFAULT_CONNECT_TIMEOUT, DEFAULT_SESSION_IDLE_TIMEOUT, DEFAULT_KEEPALIVE_IDLE,
+                   DEFAULT_KEEPALIVE_INTERVAL, DEFAULT_KEEPALIVE_COUNT)
+from worker_pool import WorkerSupervisor, merge_reports, reuse_port_supported
+from admission import AdmissionController, OVERLOAD_QUEUE, DEFAULT_OVERLOAD_TIMEOUT, reset_connection
+from metrics import MetricsRegistry, MetricsShard, BYTES_IN, BYTES_OUT
+from metrics_exporter import MetricsExporter
+from upstream_pool import UpstreamPoolManager, DEFAULT_IDLE_TIMEOUT
+from balancer import UpstreamTarget, LoadBalancer, HealthChecker, STRATEGY_ROUND_ROBIN
+from port_inventory import PortInventory, DEFAULT_PORT_RANGE_START, DEFAULT_PORT_RANGE_END
+from rate_limit import RuleRateLimiter
+from udp_forwarder import UdpForwardEngine, PROTOCOL_TCP, PROTOCOL_UDP, PROTOCOLS
+import dual_stack
+from dual_stack import DEFAULT_LISTEN_ADDRESS
+from dns_cache import DnsCache
+from access_log import AccessLogger, DEFAULT_ACCESS_LOG_RATE, REASON_CLOSED, REASON_IDLE_TIMEOUT, REASON_CONNECT_FAILED, REASON_RATE_LIMITED, REASON_ERROR, REASON_ABORTED
+
+# 转发引擎类型: thread为每连接线程模式，asyncio为单事件循环模式
+ENGINE_THREAD = 'thread'
+ENGINE_ASYNCIO = 'asyncio'
+
+# 线程模式下中继工作线程池的默认大小
+DEFAULT_MAX_WORKERS = 256
+# 默认监听队列长度
+DEFAULT_LISTEN_BACKLOG = 128
+# 重载或平滑停止时等待已建立会话结束的默认时限（秒）
+DEFAULT_DRAIN_TIMEOUT = 30.0
 
 class PortForwardRule:
     """端口转发规则类"""
     
-    def __init__(self, name: str, local_port: int, target_host: str, target_port: int, enabled: bool = True):
+    def __init__(self, name: str, local_port: int, target_host: str, target_port: int, enabled: bool = True,
+                 max_connections: int = 0, pool_size: int = 0, pool_idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 targets: Optional[List[dict]] = None, balance: str = STRATEGY_ROUND_ROBIN,
+                 health_check_interval: float = 0, bandwidth_limit: float = 0, client_bandwidth_limit: float = 0,
+                 connection_rate_limit: float = 0, client_connection_rate_limit: float = 0,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, idle_timeout: float = DEFAULT_SESSION_IDLE_TIMEOUT,
+                 tcp_nodelay: bool = True, keepalive: bool = True, keepalive_idle: int = DEFAULT_KEEPALIVE_IDLE,
+                 keepalive_interval: int = DEFAULT_KEEPALIVE_INTERVAL, keepalive_count: int = DEFAULT_KEEPALIVE_COUNT,
+                 protocol: str = PROTOCOL_TCP, listen_address: str = DEFAULT_LISTEN_ADDRESS):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"不支持的协议: {protocol}")
         self.name = name
         self.local_port = local_port
-        self.target_host = target_host
-        self.target_port = target_port
         self.enabled = enabled
+        # 转发协议: tcp或udp；UDP规则按客户端地址建立会话，idle_timeout为会话空闲超时（未设置时为60秒），
+        # max_connections为会话数上限（未设置时为4096），带宽限制和预热池对UDP规则不生效
+        self.protocol = protocol
+        # 监听地址: 默认只监听IPv4；::为双栈（同时接受IPv4和IPv6客户端），也可以是具体的本机IPv4/IPv6地址
+        self.listen_address = listen_address
+        # 上游目标列表，未指定时只有target_host:target_port一个目标；target_host/target_port始终为第一个目标
+        if targets:
+            self.targets = [UpstreamTarget.from_dict(target) for target in targets]
+        else:
+            self.targets = [UpstreamTarget(target_host, target_port)]
+        self.target_host = self.targets[0].host
+        self.target_port = self.targets[0].port
+        self.balance = balance
+        self.balancer = LoadBalancer(self.targets, balance)
+        # 主动健康检查间隔（秒），0表示不检查
+        self.health_check_interval = health_check_interval
+        # 本规则的最大并发连接数，0表示不限制
+        self.max_connections = max_connections
+        # 上游预热连接池大小，0表示不启用；池中连接的最长空闲时间（秒）
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        # 令牌桶限速: 规则和单个客户端IP的带宽（字节/秒，双向合计）及新建连接速率（连接/秒），0表示不限制
+        self.bandwidth_limit = bandwidth_limit
+        self.client_bandwidth_limit = client_bandwidth_limit
+        self.connection_rate_limit = connection_rate_limit
+        self.client_connection_rate_limit = client_connection_rate_limit
+        limiter = RuleRateLimiter(bandwidth_limit, client_bandwidth_limit, connection_rate_limit, client_connection_rate_limit)
+        self.rate_limiter = limiter if limiter.enabled else None
+        # 连接上游的超时（秒）；会话两个方向都没有数据超过idle_timeout秒时关闭，0表示不超时
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        # 客户端和上游连接的TCP选项：TCP_NODELAY及keepalive探测（空闲时间、间隔、次数）
+        self.tcp_nodelay = tcp_nodelay
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
         self.is_running = False
         self.server_socket = None
         self.thread = None
         self.connections = []
+        self.connections_lock = threading.Lock()
+        # 本规则对象上正在转发的会话数，重载或平滑停止时据此等待会话排空
+        self.active_sessions = 0
+        self.sessions_changed = threading.Condition(self.connections_lock)
+        # 重载后接替本规则接收新连接的规则
+        self.successor: Optional['PortForwardRule'] = None
+        # 规则停止或排空超时后置位，此后结束的会话在访问日志中记为被强制关闭
+        self.aborted = False
+        
+    def tune_socket(self, sock):
+        """按规则设置连接的TCP选项"""
+        tune_socket(sock, self.tcp_nodelay, self.keepalive, self.keepalive_idle,
+                    self.keepalive_interval, self.keepalive_count)
+        
+    def add_connections(self, *socks: socket.socket):
+        """登记连接套接字"""
+        with self.connections_lock:
+            self.connections.extend(socks)
+    
+    def remove_connection(self, sock: socket.socket):
+        """移除连接套接字"""
+        with self.connections_lock:
+            if sock in self.connections:
+                self.connections.remove(sock)
+    
+    def take_connections(self) -> list:
+        """取出并清空所有连接套接字"""
+        with self.connections_lock:
+            connections = self.connections[:]
+            self.connections.clear()
+        return connections
+    
+    def abort_connections(self):
+        """强制结束所有已建立的连接"""
+        self.aborted = True
+        for conn in self.take_connections():
+            try:
+                # 只shutdown以唤醒阻塞在该连接上的中继线程，由中继线程关闭套接字；
+                # 在这里close会使文件描述符被移出epoll，中继线程将永远等不到事件
+                conn.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+    
+    def session_started(self):
+        """登记开始转发的会话"""
+        with self.connections_lock:
+            self.active_sessions += 1
+    
+    def session_finished(self):
+        """登记结束的会话，最后一个会话结束时唤醒等待排空的线程"""
+        with self.connections_lock:
+            self.active_sessions -= 1
+            if self.active_sessions <= 0:
+                self.sessions_changed.notify_all()
+    
+    def wait_drained(self, timeout: Optional[float]) -> bool:
+        """等待所有会话结束，超时返回False"""
+        with self.connections_lock:
+            return self.sessions_changed.wait_for(lambda: self.active_sessions <= 0, timeout)
+    
+    def current(self) -> 'PortForwardRule':
+        """沿重载链找到当前接收新连接的规则"""
+        rule = self
+        while rule.successor is not None:
+            rule = rule.successor
+        return rule
         
     def to_dict(self) -> dict:
         """转换为字典"""
@@ -31,26 +172,133 @@ class PortForwardRule:
             'local_port': self.local_port,
             'target_host': self.target_host,
             'target_port': self.target_port,
-            'enabled': self.enabled
+            'enabled': self.enabled,
+            'max_connections': self.max_connections,
+            'pool_size': self.pool_size,
+            'pool_idle_timeout': self.pool_idle_timeout,
+            'targets': [target.to_dict() for target in self.targets],
+            'balance': self.balance,
+            'health_check_interval': self.health_check_interval,
+            'bandwidth_limit': self.bandwidth_limit,
+            'client_bandwidth_limit': self.client_bandwidth_limit,
+            'connection_rate_limit': self.connection_rate_limit,
+            'client_connection_rate_limit': self.client_connection_rate_limit,
+            'connect_timeout': self.connect_timeout,
+            'idle_timeout': self.idle_timeout,
+            'tcp_nodelay': self.tcp_nodelay,
+            'keepalive': self.keepalive,
+            'keepalive_idle': self.keepalive_idle,
+            'keepalive_interval': self.keepalive_interval,
+            'keepalive_count': self.keepalive_count,
+            'protocol': self.protocol,
+            'listen_address': self.listen_address
         }
     
     @classmethod
     def from_dict(cls, data: dict):
         """从字典创建规则"""
+        targets = data.get('targets')
         return cls(
             name=data['name'],
             local_port=data['local_port'],
-            target_host=data['target_host'],
-            target_port=data['target_port'],
-            enabled=data.get('enabled', True)
+            target_host=data['target_host'] if 'target_host' in data else targets[0]['host'],
+            target_port=data['target_port'] if 'target_port' in data else targets[0]['port'],
+            enabled=data.get('enabled', True),
+            max_connections=data.get('max_connections', 0),
+            pool_size=data.get('pool_size', 0),
+            pool_idle_timeout=data.get('pool_idle_timeout', DEFAULT_IDLE_TIMEOUT),
+            targets=targets,
+            balance=data.get('balance', STRATEGY_ROUND_ROBIN),
+            health_check_interval=data.get('health_check_interval', 0),
+            bandwidth_limit=data.get('bandwidth_limit', 0),
+            client_bandwidth_limit=data.get('client_bandwidth_limit', 0),
+            connection_rate_limit=data.get('connection_rate_limit', 0),
+            client_connection_rate_limit=data.get('client_connection_rate_limit', 0),
+            connect_timeout=data.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+            idle_timeout=data.get('idle_timeout', DEFAULT_SESSION_IDLE_TIMEOUT),
+            tcp_nodelay=data.get('tcp_nodelay', True),
+            keepalive=data.get('keepalive', True),
+            keepalive_idle=data.get('keepalive_idle', DEFAULT_KEEPALIVE_IDLE),
+            keepalive_interval=data.get('keepalive_interval', DEFAULT_KEEPALIVE_INTERVAL),
+            keepalive_count=data.get('keepalive_count', DEFAULT_KEEPALIVE_COUNT),
+            protocol=data.get('protocol', PROTOCOL_TCP),
+            listen_address=data.get('listen_address', DEFAULT_LISTEN_ADDRESS)
         )
 
 class PortForwarder:
     """端口转发器"""
     
-    def __init__(self):
+    def __init__(self, engine: str = ENGINE_THREAD, relay: str = RELAY_AUTO, workers: int = 1, reuse_port: bool = False,
+                 max_workers: int = DEFAULT_MAX_WORKERS, max_connections: Optional[int] = None,
+                 listen_backlog: int = DEFAULT_LISTEN_BACKLOG, overload_policy: str = OVERLOAD_QUEUE,
+                 overload_timeout: float = DEFAULT_OVERLOAD_TIMEOUT, metrics_port: Optional[int] = None,
+                 metrics_host: str = '0.0.0.0', access_log: Optional[str] = None, access_log_sample_rate: float = 1.0,
+                 access_log_rate: float = DEFAULT_ACCESS_LOG_RATE):
+        if engine not in (ENGINE_THREAD, ENGINE_ASYNCIO):
+            raise ValueError(f"不支持的转发引擎: {engine}")
+            
         self.rules: Dict[str, PortForwardRule] = {}
         self.logger = self._setup_logger()
+        # 每个连接结束时的JSON访问记录，由后台线程写入文件（access_log为空时不记录）
+        self.access_log = AccessLogger(access_log, sample_rate=access_log_sample_rate, rate=access_log_rate)
+        self.engine = engine
+        self.metrics = MetricsRegistry()
+        # 上游域名的解析缓存，新连接不在建立路径上等待DNS
+        self.dns_cache = DnsCache(logger=self.logger)
+        self.upstream_pools = UpstreamPoolManager(self.logger, resolver=self.dns_cache.resolve)
+        self.health_checkers: Dict[str, HealthChecker] = {}
+        # 可选的OpenMetrics导出端点，随第一条规则启动
+        self.exporter = MetricsExporter(self, metrics_port, metrics_host, logger=self.logger) if metrics_port else None
+        self.listen_backlog = listen_backlog
+        # 监听套接字是否设置SO_REUSEPORT（多进程模式下的工作进程使用）
+        self.reuse_port = reuse_port and reuse_port_supported()
+        self.async_engine = None
+        if engine == ENGINE_ASYNCIO:
+            self.async_engine = AsyncForwardEngine(self.logger, self.metrics, self.upstream_pools, self.health_checkers,
+                                                   backlog=listen_backlog, reuse_port=self.reuse_port,
+                                                   dns_cache=self.dns_cache, access_log=self.access_log)
+        # 线程模式下的数据中继后端（splice零拷贝或预分配缓冲区）
+        self.relay_backend = resolve_relay_backend(relay)
+        # UDP规则由独立的I/O线程转发（两种引擎共用），首条UDP规则启动时才创建线程
+        self.udp_engine = UdpForwardEngine(self.logger, self.metrics, reuse_port=self.reuse_port, dns_cache=self.dns_cache,
+                                           access_log=self.access_log)
+        
+        # 系统监听端口占用表，添加规则时不再逐个端口bind探测
+        self.port_inventory = PortInventory()
+        
+        # 重载后正在排空的旧规则: (旧规则, 截止时间)
+        self.draining: List[Tuple[PortForwardRule, float]] = []
+        self.draining_lock = threading.Lock()
+        
+        # 线程模式下的有界中继线程池和连接准入控制，全局连接上限默认等于线程池大小
+        self.max_workers = max_workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.admission = AdmissionController(
+            max_workers if max_connections is None else max_connections,
+            overload_policy,
+            overload_timeout
+        )
+        
+        # 多进程模式：由监督器管理的工作进程负责实际转发
+        self.supervisor = None
+        if workers > 1:
+            if reuse_port_supported():
+                # 工作进程使用相同的转发配置
+                options = {
+                    'engine': engine,
+                    'relay': relay,
+                    'max_workers': max_workers,
+                    'max_connections': max_connections,
+                    'listen_backlog': listen_backlog,
+                    'overload_policy': overload_policy,
+                    'overload_timeout': overload_timeout,
+                    'access_log': access_log,
+                    'access_log_sample_rate': access_log_sample_rate,
+                    'access_log_rate': access_log_rate
+                }
+                self.supervisor = WorkerSupervisor(workers, options, self.logger)
+            else:
+                self.logger.warning("当前平台不支持SO_REUSEPORT，多进程模式已禁用")
         
     def _setup_logger(self) -> logging.Logger:
         """设置日志"""
@@ -72,12 +320,13 @@ class PortForwarder:
                 self.logger.warning(f"规则 {rule.name} 已存在")
                 return False
                 
-            # 检查端口是否已被使用
-            if self._is_port_in_use(rule.local_port):
-                self.logger.error(f"端口 {rule.local_port} 已被使用")
+            # 检查端口是否已被其他规则或程序使用
+            if not self._port_available(rule):
                 return False
                 
             self.rules[rule.name] = rule
+            if rule.protocol == PROTOCOL_TCP:
+                self.port_inventory.reserve(rule.local_port, rule.name)
             self.logger.info(f"添加规则: {rule.name}")
             
             # 如果规则启用，立即启动
@@ -100,8 +349,14 @@ class PortForwarder:
             # 先停止规则
             self.stop_rule(rule_name)
             
-            # 删除规则
-            del self.rules[rule_name]
+            # 删除规则，释放端口（监听套接字已关闭，不必等占用表刷新）
+            rule = self.rules.pop(rule_name)
+            if rule.protocol == PROTOCOL_TCP:
+                self.port_inventory.release(rule.local_port, rule_name)
+                self.port_inventory.mark_listening(rule.local_port, False)
+            self.metrics.remove(rule_name)
+            if self.supervisor:
+                self.supervisor.remove_rule(rule_name)
             self.logger.info(f"删除规则: {rule_name}")
             return True
             
@@ -109,6 +364,22 @@ class PortForwarder:
             self.logger.error(f"删除规则失败: {str(e)}")
             return False
     
+    def _port_available(self, rule: PortForwardRule) -> bool:
+        """检查规则的本地端口是否已被其他规则或程序使用，被占用时记录错误"""
+        if rule.protocol == PROTOCOL_UDP:
+            # UDP与TCP端口互不影响，只检查其他UDP规则；被其他程序占用时由绑定失败报告
+            owner = next((other.name for other in self.rules.values()
+                          if other.protocol == PROTOCOL_UDP and other.local_port == rule.local_port), None)
+            if owner is None:
+                return True
+        else:
+            # SO_REUSEPORT工作进程之间共享端口，无需检查
+            if self.reuse_port or self.port_inventory.is_free(rule.local_port):
+                return True
+            owner = self.port_inventory.reserved.get(rule.local_port)
+        self.logger.error(f"端口 {rule.local_port} 已被使用" + (f"（规则 {owner}）" if owner else ""))
+        return False
+    
     def start_rule(self, rule_name: str) -> bool:
         """启动转发规则"""
         try:
@@ -121,21 +392,51 @@ class PortForwarder:
             if rule.is_running:
                 self.logger.warning(f"规则 {rule_name} 已在运行")
                 return True
+            rule.aborted = False
+                
+            if self.exporter:
+                self.exporter.start()
+                
+            if self.supervisor:
+                # 由各工作进程分别监听同一端口
+                self.supervisor.start_rule(rule)
+                rule.is_running = True
+                rule.enabled = True
+                self.logger.info(f"启动规则: {rule_name} (本地端口: {rule.local_port} -> {rule.target_host}:{rule.target_port}, {self.supervisor.workers}个工作进程)")
+                return True
+                
+            if rule.protocol == PROTOCOL_UDP:
+                for target in rule.targets:
+                    self.dns_cache.prefetch(target.host, target.port, socket.SOCK_DGRAM)
+                self.udp_engine.start_rule(rule)
+                rule.is_running = True
+                rule.enabled = True
+                self.logger.info(f"启动规则: {rule_name} (本地端口: {rule.local_port} -> {rule.target_host}:{rule.target_port}, UDP)")
+                return True
+                
+            self._start_rule_services(rule)
+                
+            if self.async_engine:
+                # 由事件循环统一监听和转发
+                self.async_engine.start_rule(rule)
+                rule.is_running = True
+                rule.enabled = True
+                self.logger.info(f"启动规则: {rule_name} (本地端口: {rule.local_port} -> {rule.target_host}:{rule.target_port}, asyncio)")
+                return True
                 
-            # 创建服务器套接字
-            rule.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            rule.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            rule.server_socket.bind(('0.0.0.0', rule.local_port))
-            rule.server_socket.listen(5)
+            # 创建服务器套接字（按规则的监听地址选择地址族，::时为双栈）
+            rule.server_socket = dual_stack.create_listener(rule.listen_address, rule.local_port,
+                                                            backlog=self.listen_backlog, reuse_port=self.reuse_port)
+            
+            # 先标记运行状态，避免监听线程启动时检查到未运行而立即退出
+            rule.is_running = True
+            rule.enabled = True
             
             # 启动监听线程
             rule.thread = threading.Thread(target=self._listen_thread, args=(rule,))
             rule.thread.daemon = True
             rule.thread.start()
             
-            rule.is_running = True
-            rule.enabled = True
-            
             self.logger.info(f"启动规则: {rule_name} (本地端口: {rule.local_port} -> {rule.target_host}:{rule.target_port})")
             return True
             
@@ -143,8 +444,49 @@ class PortForwarder:
             self.logger.error(f"启动规则失败: {str(e)}")
             return False
     
-    def stop_rule(self, rule_name: str) -> bool:
-        """停止转发规则"""
+    def _start_rule_services(self, rule: PortForwardRule):
+        """启动规则的域名预解析、预热连接池和上游健康检查"""
+        # 目标为域名时提前在后台解析，第一个连接即可命中缓存
+        for target in rule.targets:
+            self.dns_cache.prefetch(target.host, target.port)
+            
+        # 启用预热池时提前建立上游连接
+        for target in rule.targets:
+            self.upstream_pools.get_pool(rule, target.host, target.port)
+            
+        # 启动上游健康检查
+        if rule.health_check_interval > 0:
+            checker = HealthChecker(rule.name, rule.balancer, rule.health_check_interval, logger=self.logger,
+                                    resolver=self.dns_cache.resolve)
+            checker.start()
+            self.health_checkers[rule.name] = checker
+    
+    def _stop_rule_services(self, rule_name: str):
+        """停止规则的上游健康检查并关闭预热连接池"""
+        checker = self.health_checkers.pop(rule_name, None)
+        if checker:
+            checker.stop()
+        self.upstream_pools.stop_rule(rule_name)
+    
+    def _close_listener(self, rule: PortForwardRule):
+        """停止接受新连接，已建立的连接不受影响（UDP规则没有连接，会话随监听套接字一起关闭）"""
+        if rule.protocol == PROTOCOL_UDP:
+            self.udp_engine.stop_rule(rule)
+            
+        if self.async_engine:
+            self.async_engine.stop_listening(rule)
+            
+        # 关闭服务器套接字（先shutdown以唤醒阻塞在accept上的监听线程）
+        if rule.server_socket:
+            try:
+                rule.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            rule.server_socket.close()
+            rule.server_socket = None
+    
+    def stop_rule(self, rule_name: str, graceful: bool = False, drain_timeout: float = DEFAULT_DRAIN_TIMEOUT) -> bool:
+        """停止转发规则；graceful为True时先停止接受新连接，等待已建立的会话结束（最多drain_timeout秒）"""
         try:
             if rule_name not in self.rules:
                 self.logger.error(f"规则 {rule_name} 不存在")
@@ -156,18 +498,25 @@ class PortForwarder:
                 self.logger.warning(f"规则 {rule_name} 未在运行")
                 return True
                 
-            # 关闭服务器套接字
-            if rule.server_socket:
-                rule.server_socket.close()
-                rule.server_socket = None
+            if self.supervisor:
+                self.supervisor.stop_rule(rule_name, drain_timeout if graceful else None)
+            elif graceful:
+                self._close_listener(rule)
+                self.logger.info(f"规则 {rule_name} 正在排空 {rule.active_sessions} 个会话")
+                if not rule.wait_drained(drain_timeout):
+                    self.logger.warning(f"规则 {rule_name} 排空超时，强制关闭剩余的 {rule.active_sessions} 个会话")
                 
-            # 关闭所有连接
-            for conn in rule.connections[:]:
-                try:
-                    conn.close()
-                except:
-                    pass
-            rule.connections.clear()
+            # 此后被关闭的会话记为aborted
+            rule.aborted = True
+            if self.async_engine:
+                self.async_engine.stop_rule(rule)
+                
+            self._close_listener(rule)
+            self._stop_rule_services(rule_name)
+                
+            # 关闭等待准入的连接和所有已建立的连接
+            self.admission.discard_rule(rule_name)
+            rule.abort_connections()
             
             rule.is_running = False
             rule.enabled = False
@@ -179,21 +528,143 @@ class PortForwarder:
             self.logger.error(f"停止规则失败: {str(e)}")
             return False
     
+    def reload_rule(self, rule_name: str, new_rule: PortForwardRule, drain_timeout: float = DEFAULT_DRAIN_TIMEOUT) -> bool:
+        """
+        重载规则（可修改名称、目标、本地端口和其他配置）：新连接立即使用新配置，已建立的会话继续按旧配置转发，
+        最多排空drain_timeout秒后强制关闭。本地端口不变时监听套接字直接交给新规则，监听不中断
+        """
+        try:
+            old_rule = self.rules.get(rule_name)
+            if old_rule is None:
+                self.logger.error(f"规则 {rule_name} 不存在")
+                return False
+                
+            if new_rule.name != rule_name and new_rule.name in self.rules:
+                self.logger.warning(f"规则 {new_rule.name} 已存在")
+                return False
+                
+            rebind = new_rule.local_port != old_rule.local_port or new_rule.protocol != old_rule.protocol
+            if rebind and not self._port_available(new_rule):
+                return False
+                
+            # 新规则接替旧规则的登记和端口保留
+            del self.rules[rule_name]
+            self.rules[new_rule.name] = new_rule
+            if old_rule.protocol == PROTOCOL_TCP:
+                self.port_inventory.release(old_rule.local_port, rule_name)
+            if new_rule.protocol == PROTOCOL_TCP:
+                self.port_inventory.reserve(new_rule.local_port, new_rule.name)
+            
+            if not old_rule.is_running:
+                self.logger.info(f"重载规则: {rule_name} -> {new_rule.name}")
+                return self.start_rule(new_rule.name) if new_rule.enabled else True
+                
+            if self.supervisor:
+                # 由各工作进程分别交接监听并排空旧会话
+                self.supervisor.reload_rule(rule_name, new_rule, drain_timeout)
+                old_rule.is_running = False
+                new_rule.is_running = new_rule.enabled
+                self.logger.info(f"重载规则: {rule_name} -> {new_rule.name} ({self.supervisor.workers}个工作进程)")
+                return True
+                
+            self._stop_rule_services(rule_name)
+            started = True
+            # UDP规则的会话随监听套接字关闭，客户端的下一个数据报在新规则上建立会话
+            if new_rule.enabled and not rebind and new_rule.protocol == PROTOCOL_TCP:
+                self._start_rule_services(new_rule)
+                self._handoff_listener(old_rule, new_rule)
+            else:
+                self._close_listener(old_rule)
+                old_rule.successor = new_rule
+                if rebind and old_rule.protocol == PROTOCOL_TCP:
+                    self.port_inventory.mark_listening(old_rule.local_port, False)
+                if new_rule.enabled:
+                    started = self.start_rule(new_rule.name)
+            old_rule.is_running = False
+            
+            self.logger.info(f"重载规则: {rule_name} -> {new_rule.name} (本地端口: {new_rule.local_port} -> "
+                             f"{new_rule.target_host}:{new_rule.target_port})，排空 {old_rule.active_sessions} 个旧会话")
+            self._drain(old_rule, drain_timeout)
+            return started
+            
+        except Exception as e:
+            self.logger.error(f"重载规则失败: {str(e)}")
+            return False
+    
+    def _handoff_listener(self, old_rule: PortForwardRule, new_rule: PortForwardRule):
+        """把监听交给新规则：监听套接字不关闭，之后接受的连接按新规则转发"""
+        new_rule.server_socket = old_rule.server_socket
+        new_rule.thread = old_rule.thread
+        new_rule.is_running = True
+        new_rule.enabled = True
+        # 先设置接替关系再清除旧规则的套接字，监听线程始终能找到当前规则
+        old_rule.successor = new_rule
+        old_rule.server_socket = None
+        if self.async_engine:
+            self.async_engine.handoff_rule(old_rule, new_rule)
+    
+    def _drain(self, rule: PortForwardRule, drain_timeout: float):
+        """在后台等待旧规则的会话结束，超过时限后强制关闭"""
+        deadline = time.monotonic() + drain_timeout
+        with self.draining_lock:
+            self.draining.append((rule, deadline))
+        thread = threading.Thread(target=self._drain_thread, args=(rule, deadline), name=f'Drain-{rule.name}')
+        thread.daemon = True
+        thread.start()
+    
+    def _drain_thread(self, rule: PortForwardRule, deadline: float):
+        """排空线程"""
+        if rule.wait_drained(max(deadline - time.monotonic(), 0)):
+            self.logger.info(f"规则 {rule.name} 的旧会话已全部结束")
+        else:
+            self.logger.warning(f"规则 {rule.name} 的旧会话排空超时，强制关闭剩余的 {rule.active_sessions} 个会话")
+            rule.abort_connections()
+            
+        with self.draining_lock:
+            self.draining = [item for item in self.draining if item[0] is not rule]
+        # 规则改名后旧名称的统计不再需要
+        if rule.name not in self.rules:
+            self.metrics.remove(rule.name)
+    
+    def get_drain_status(self, rule_name: Optional[str] = None) -> List[dict]:
+        """获取正在排空的旧规则（可按接替它的当前规则名筛选）：剩余会话数和距强制关闭的秒数"""
+        now = time.monotonic()
+        with self.draining_lock:
+            draining = list(self.draining)
+        return [
+            {
+                'name': rule.name,
+                'successor': rule.current().name,
+                'local_port': rule.local_port,
+                'target_host': rule.target_host,
+                'target_port': rule.target_port,
+                'active_sessions': rule.active_sessions,
+                'remaining': round(max(deadline - now, 0), 3)
+            }
+            for rule, deadline in draining
+            if rule_name is None or rule.current().name == rule_name
+        ]
+    
     def _listen_thread(self, rule: PortForwardRule):
-        """监听线程"""
+        """监听线程；规则重载后监听套接字交给接替的规则，新连接按新配置转发"""
+        listener = rule.server_socket
         try:
-            while rule.is_running and rule.server_socket:
+            while True:
+                rule = rule.current()
+                if not rule.is_running or rule.server_socket is not listener:
+                    break
                 try:
-                    client_socket, addr = rule.server_socket.accept()
-                    self.logger.info(f"新连接来自 {addr} -> {rule.name}")
+                    client_socket, addr = listener.accept()
+                    rule = rule.current()
                     
-                    # 创建转发线程
-                    forward_thread = threading.Thread(
-                        target=self._forward_connection,
-                        args=(client_socket, rule)
-                    )
-                    forward_thread.daemon = True
-                    forward_thread.start()
+                    # 超过新建连接速率的连接直接重置
+                    if rule.rate_limiter and not rule.rate_limiter.allow_connection(addr[0]):
+                        reset_connection(client_socket)
+                        self.access_log.log(rule.name, addr, reason=REASON_RATE_LIMITED)
+                        continue
+                    
+                    # 经准入控制后交给中继线程池处理
+                    self.admission.admit(rule, client_socket, addr, self._dispatch_connection)
                     
                 except socket.error:
                     break
@@ -201,61 +672,290 @@ class PortForwarder:
         except Exception as e:
             self.logger.error(f"监听线程错误: {str(e)}")
     
-    def _forward_connection(self, client_socket: socket.socket, rule: PortForwardRule):
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """获取中继线程池（首次使用时创建）"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='RelayWorker')
+        return self.executor
+    
+    def _dispatch_connection(self, rule: PortForwardRule, client_socket: socket.socket, addr: tuple):
+        """把已准入的连接提交到中继线程池"""
+        self._get_executor().submit(self._run_connection, rule, client_socket, addr)
+    
+    def _run_connection(self, rule: PortForwardRule, client_socket: socket.socket, addr: tuple):
+        """在中继线程中处理连接，结束后释放准入名额"""
+        try:
+            self._forward_connection(client_socket, rule, addr)
+        finally:
+            self.admission.release(rule, self._dispatch_connection)
+    
+    def _forward_connection(self, client_socket: socket.socket, rule: PortForwardRule, addr: Optional[tuple] = None):
         """转发连接"""
         target_socket = None
+        metrics = self.metrics.get(rule.name)
+        metrics.connection_opened()
+        rule.session_started()
+        started = time.monotonic()
+        # 按负载均衡策略选择上游目标
+        target = rule.balancer.select(addr[0] if addr else None)
+        rule.balancer.acquire(target)
+        # 本连接的收发字节数和关闭原因，结束时写入访问日志
+        transferred = {BYTES_IN: 0, BYTES_OUT: 0}
+        reason = REASON_CLOSED
+        error = None
         try:
             # 连接到目标服务器
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_socket.connect((rule.target_host, rule.target_port))
-            
-            rule.connections.extend([client_socket, target_socket])
+            try:
+                target_socket = self._open_upstream(rule, target.host, target.port)
+            except Exception:
+                metrics.connect_failed()
+                self._report_connect_failure(rule, target)
+                reason = REASON_CONNECT_FAILED
+                raise
+            metrics.connect_succeeded(time.monotonic() - started)
             
-            # 创建双向转发线程
-            t1 = threading.Thread(target=self._transfer_data, args=(client_socket, target_socket))
-            t2 = threading.Thread(target=self._transfer_data, args=(target_socket, client_socket))
+            rule.add_connections(client_socket, target_socket)
+            for sock in (client_socket, target_socket):
+                rule.tune_socket(sock)
             
-            t1.daemon = True
-            t2.daemon = True
-            
-            t1.start()
-            t2.start()
-            
-            t1.join()
-            t2.join()
+            # 在当前线程中双向转发，每个连接只占用一个中继线程（对端不再接收超过空闲超时也会结束）
+            if not self._relay_connection(client_socket, target_socket, metrics.shard(), rule.rate_limiter,
+                                          addr[0] if addr else None, rule.idle_timeout, transferred):
+                metrics.idle_timed_out()
+                reason = REASON_IDLE_TIMEOUT
             
         except Exception as e:
             self.logger.error(f"转发连接错误: {str(e)}")
+            if reason == REASON_CLOSED:
+                reason = REASON_ERROR
+            error = str(e) or type(e).__name__
         finally:
+            rule.balancer.release(target)
+            duration = time.monotonic() - started
+            metrics.connection_closed(duration)
+            if rule.aborted and reason in (REASON_CLOSED, REASON_ERROR):
+                reason = REASON_ABORTED
+            self.access_log.log(rule.name, addr, target, transferred[BYTES_IN], transferred[BYTES_OUT],
+                                duration, reason, error)
             # 清理连接
             for sock in [client_socket, target_socket]:
                 if sock:
                     try:
                         sock.close()
-                        if sock in rule.connections:
-                            rule.connections.remove(sock)
+                        rule.remove_connection(sock)
                     except:
                         pass
+            rule.session_finished()
+    
+    def _report_connect_failure(self, rule: PortForwardRule, target: UpstreamTarget):
+        """上游连接失败计入健康检查（被动检查）"""
+        checker = self.health_checkers.get(rule.name)
+        if checker:
+            checker.record(target, False)
     
-    def _transfer_data(self, source: socket.socket, destination: socket.socket):
-        """传输数据"""
+    def _open_upstream(self, rule: PortForwardRule, host: str, port: int) -> socket.socket:
+        """获取上游连接：优先使用预热池中已就绪的连接，否则新建"""
+        pool = self.upstream_pools.get_pool(rule, host, port)
+        if pool:
+            sock = pool.acquire()
+            if sock:
+                return sock
+        
+        # 解析出多个地址（如IPv6和IPv4）时并行尝试，取最先建立的连接
+        return dual_stack.connect(host, port, rule.connect_timeout or None, resolver=self.dns_cache.resolve)
+    
+    def _relay_connection(self, client_socket: socket.socket, target_socket: socket.socket, shard: MetricsShard,
+                          rate_limiter: Optional[RuleRateLimiter] = None, client_ip: Optional[str] = None,
+                          idle_timeout: float = 0, transferred: Optional[dict] = None) -> bool:
+        """
+        在一个线程中用非阻塞套接字双向传输数据，两个方向互不等待：
+        某个方向的目标暂时不能接收时，数据留在该方向的通道中并等待目标可写，期间暂停读取该方向的源端，另一方向照常转发。
+        一方发送FIN时向另一方半关闭（shutdown写方向），两个方向都结束时结束转发。
+        有带宽限制时按令牌桶欠额暂停读取该方向的源端直到欠额还清，另一方向照常转发。
+        两个方向都没有数据超过idle_timeout秒时返回False，否则返回True。
+        transferred（字节计数器下标 -> 字节数）用于累计本连接的收发字节数
+        """
+        if transferred is None:
+            transferred = {BYTES_IN: 0, BYTES_OUT: 0}
+        # 转发方向: [源, 目标, 中继通道, 字节计数器下标, 源端是否已关闭, 限速后恢复读取的时间]
+        directions = [
+            [client_socket, target_socket, create_relay_channel(self.relay_backend), BYTES_IN, False, 0.0],
+            [target_socket, client_socket, create_relay_channel(self.relay_backend), BYTES_OUT, False, 0.0]
+        ]
+        # 套接字 -> (以它为源的方向, 以它为目标的方向)
+        roles = {
+            client_socket: (directions[0], directions[1]),
+            target_socket: (directions[1], directions[0])
+        }
+        counters = shard.counters
+        selector = selectors.DefaultSelector()
         try:
+            for sock in roles:
+                sock.setblocking(False)
+                selector.register(sock, selectors.EVENT_READ)
+            
             while True:
-                data = source.recv(4096)
-                if not data:
+                now = time.monotonic()
+                # 被限速暂停的方向到期后恢复读取，等待时间不超过最近的恢复时间
+                resume = [direction[5] for direction in directions if direction[5] > now]
+                if not selector.get_map() and not resume:
                     break
-                destination.send(data)
-        except:
+                timeout = idle_timeout or None
+                if resume:
+                    timeout = min(min(resume) - now, timeout) if timeout else min(resume) - now
+                if selector.get_map():
+                    events = selector.select(timeout)
+                else:
+                    # 两个方向都在等待限速（Windows上select不接受空的套接字集合）
+                    time.sleep(timeout)
+                    events = []
+                if not events and not resume:
+                    return False
+                for key, mask in events:
+                    outgoing, incoming = roles[key.fileobj]
+                    if mask & selectors.EVENT_WRITE:
+                        incoming[2].send(incoming[1])
+                    if mask & selectors.EVENT_READ and not outgoing[4] and not outgoing[2].pending:
+                        try:
+                            relayed = outgoing[2].receive(outgoing[0])
+                        except BlockingIOError:
+                            continue
+                        if not relayed:
+                            outgoing[4] = True
+                            continue
+                        counters[outgoing[3]] += relayed
+                        transferred[outgoing[3]] += relayed
+                        outgoing[2].send(outgoing[1])
+                        if rate_limiter:
+                            delay = rate_limiter.consume(client_ip, relayed)
+                            if delay:
+                                outgoing[5] = time.monotonic() + delay
+                
+                now = time.monotonic()
+                for sock, (outgoing, incoming) in roles.items():
+                    # 源端已关闭且数据已全部送出：转告对端，另一个方向继续转发直到对端也关闭
+                    if outgoing[4] and not outgoing[2].pending and outgoing[1] is not None:
+                        shutdown_write(outgoing[1])
+                        outgoing[1] = None
+                    mask = 0
+                    if not outgoing[4] and not outgoing[2].pending and outgoing[5] <= now:
+                        mask |= selectors.EVENT_READ
+                    if incoming[1] is not None and incoming[2].pending:
+                        mask |= selectors.EVENT_WRITE
+                    self._update_interest(selector, sock, mask)
+        except ConnectionError:
+            # 任一方重置或中止连接，会话结束
             pass
+        finally:
+            selector.close()
+            for direction in directions:
+                direction[2].close()
+        return True
     
-    def _is_port_in_use(self, port: int) -> bool:
-        """检查端口是否被使用"""
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.bind(('0.0.0.0', port))
-                return False
-        except socket.error:
-            return True
+    @staticmethod
+    def _update_interest(selector: selectors.BaseSelector, sock: socket.socket, mask: int):
+        """按需要的事件注册、修改或注销套接字"""
+        registered = selector.get_map().get(sock)
+        if not mask:
+            if registered:
+                selector.unregister(sock)
+        elif registered is None:
+            selector.register(sock, mask)
+        elif registered.events != mask:
+            selector.modify(sock, mask)
+    
+    def get_admission_stats(self, rule_name: Optional[str] = None) -> dict:
+        """获取连接准入统计（并发数、排队数、拒绝次数）"""
+        stats = self.admission.get_stats(rule_name)
+        if rule_name is None:
+            stats['max_workers'] = self.max_workers
+        return stats
+    
+    def get_free_ports(self, count: int = 1, start: int = DEFAULT_PORT_RANGE_START,
+                       end: int = DEFAULT_PORT_RANGE_END) -> List[int]:
+        """建议区间内未被规则或其他程序使用的端口"""
+        return self.port_inventory.next_free(count, start, end)
+    
+    def check_conflicts(self, rules: List[PortForwardRule]) -> List[dict]:
+        """检查待添加规则之间以及与现有规则、其他程序的端口冲突"""
+        # 占用表只记录TCP监听，UDP规则不参与检查
+        current = [rule for rule in self.rules.values() if rule.protocol == PROTOCOL_TCP]
+        conflicts = self.port_inventory.conflicts(current + [rule for rule in rules if rule.protocol == PROTOCOL_TCP],
+                                                  owned_ports=[rule.local_port for rule in current])
+        names = {rule.name for rule in rules}
+        return [conflict for conflict in conflicts if names.intersection(conflict['rules'])]
+    
+    def get_relay_task_count(self) -> int:
+        """获取正在转发的连接任务数（asyncio任务或中继线程占用数）"""
+        if self.async_engine:
+            return self.async_engine.active_tasks
+        return self.admission.active
+    
+    def get_metrics_report(self) -> dict:
+        """获取指标导出所需的统计：各规则快照、准入拒绝数、转发任务数、线程数和解析缓存统计；
+        多进程模式下汇总各工作进程的报告"""
+        if self.supervisor:
+            return merge_reports(self.supervisor.collect_metrics())
+        return {
+            'rules': self.metrics.snapshot_all(),
+            'rejected_by_rule': self.admission.get_stats()['rejected_by_rule'],
+            'relay_tasks': self.get_relay_task_count(),
+            'threads': threading.active_count(),
+            'dns': self.get_dns_stats()
+        }
+    
+    def get_rule_status(self, rule_name: str, snapshots: Optional[Dict[str, dict]] = None) -> Dict[str, any]:
+        """获取规则状态及实时流量统计；多进程模式下流量统计为各工作进程的汇总（可传入已汇总的snapshots）"""
+        rule = self.rules.get(rule_name)
+        if not rule:
+            return {}
+        
+        if snapshots is None and self.supervisor:
+            snapshots = self.get_metrics_report()['rules']
+        stats = snapshots.get(rule_name) if snapshots is not None else self.metrics.snapshot(rule_name)
+        stats = stats or self.metrics.get(rule_name).snapshot()
+        status = {
+            'name': rule.name,
+            'local_port': rule.local_port,
+            'target_host': rule.target_host,
+            'target_port': rule.target_port,
+            'enabled': rule.enabled,
+            'is_running': rule.is_running,
+            'connections': stats['active_connections']
+        }
+        status.update(stats)
+        if len(rule.targets) > 1:
+            status['balance'] = rule.balance
+            status['targets'] = rule.balancer.get_stats()
+        if rule.pool_size:
+            status['upstream_pools'] = self.upstream_pools.get_stats(rule_name)
+        if rule.rate_limiter:
+            status['rate_limits'] = rule.rate_limiter.get_stats()
+        if rule.protocol == PROTOCOL_UDP:
+            status['protocol'] = PROTOCOL_UDP
+            status['udp_sessions'] = self.udp_engine.get_stats(rule_name)
+        draining = self.get_drain_status(rule_name)
+        if draining:
+            status['draining'] = draining
+        return status
+    
+    def get_all_status(self) -> List[Dict[str, any]]:
+        """获取所有规则状态"""
+        # 多进程模式下只向工作进程请求一次汇总
+        snapshots = self.get_metrics_report()['rules'] if self.supervisor else None
+        return [self.get_rule_status(rule_name, snapshots) for rule_name in list(self.rules.keys())]
+    
+    def get_access_log_stats(self) -> dict:
+        """获取访问日志的写入、采样和限速跳过、丢弃计数"""
+        return self.access_log.get_stats()
+    
+    def get_dns_stats(self) -> dict:
+        """获取上游域名解析缓存的命中率等统计"""
+        return self.dns_cache.get_stats()
+    
+    def get_udp_sessions(self, rule_name: str, limit: int = 100) -> List[dict]:
+        """获取UDP规则最近活动的会话及其收发计数"""
+        return self.udp_engine.get_sessions(rule_name, limit)
     
     def get_rules(self) -> List[PortForwardRule]:
         """获取所有规则"""
@@ -265,7 +965,58 @@ class PortForwarder:
         """获取指定规则"""
         return self.rules.get(rule_name)
     
-    def stop_all(self):
-        """停止所有规则"""
+    def _drain_all(self, drain_timeout: float):
+        """停止所有规则的监听，等待所有会话（包括重载后仍在排空的旧会话）结束"""
+        deadline = time.monotonic() + drain_timeout
+        rules = [rule for rule in self.rules.values() if rule.is_running]
+        for rule in rules:
+            self._close_listener(rule)
+        with self.draining_lock:
+            rules.extend(rule for rule, _ in self.draining)
+            
+        self.logger.info(f"正在排空 {sum(rule.active_sessions for rule in rules)} 个会话")
+        for rule in rules:
+            if not rule.wait_drained(max(deadline - time.monotonic(), 0)):
+                self.logger.warning("排空超时，强制关闭剩余的会话")
+                break
+    
+    def stop_all(self, graceful: bool = False, drain_timeout: float = DEFAULT_DRAIN_TIMEOUT):
+        """停止所有规则；graceful为True时先停止所有监听，再等待已建立的会话结束（共用drain_timeout时限）"""
+        if graceful:
+            if self.supervisor:
+                # 各工作进程分别停止监听并排空会话
+                self.supervisor.shutdown(drain_timeout=drain_timeout)
+            else:
+                self._drain_all(drain_timeout)
+                
         for rule_name in list(self.rules.keys()):
-            self.stop_rule(rule_name)
\ No newline at end of file
+            self.stop_rule(rule_name)
+            
+        # 强制结束仍在排空的旧规则的会话
+        with self.draining_lock:
+            for rule, _ in self.draining:
+                rule.abort_connections()
+            
+        if self.async_engine:
+            self.async_engine.shutdown()
+        self.udp_engine.shutdown()
+        self.dns_cache.stop()
+            
+        for checker in list(self.health_checkers.values()):
+            checker.stop()
+        self.health_checkers.clear()
+            
+        self.upstream_pools.stop_all()
+            
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            
+        if self.supervisor:
+            self.supervisor.shutdown()
+            
+        if self.exporter:
+            self.exporter.stop()
+            
+        # 写完队列中剩余的访问记录
+        self.access_log.close()
\ No newline at end of file
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+端口占用清单模块
+一次性读取系统的TCP监听表（Linux为/proc/net/tcp{,6}，Windows为GetExtendedTcpTable），
+建立65536位的占用表，"端口是否空闲"与"区间内的下N个空闲端口"查询不再逐个端口尝试bind。
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+PORT_COUNT = 65536
+# 占用表的默认有效期（秒）
+DEFAULT_INVENTORY_TTL = 1.0
+# 建议空闲端口时的默认区间（避开系统保留端口）
+DEFAULT_PORT_RANGE_START = 1024
+DEFAULT_PORT_RANGE_END = 65535
+
+# /proc/net/tcp中LISTEN状态的编码
+_PROC_LISTEN_STATE = '0A'
+_PROC_TCP_FILES = ('/proc/net/tcp', '/proc/net/tcp6')
+
+# GetExtendedTcpTable参数
+_TCP_TABLE_OWNER_PID_LISTENER = 3
+_ERROR_INSUFFICIENT_BUFFER = 122
+# (地址族, 行大小, 本地端口在行内的偏移)：MIB_TCPROW_OWNER_PID / MIB_TCP6ROW_OWNER_PID
+_WINDOWS_TABLE_LAYOUTS = ((socket.AF_INET, 24, 8), (getattr(socket, 'AF_INET6', 23), 56, 20))
+
+# 读取函数: 返回正在监听的TCP端口集合
+ListenerReader = Callable[[], Set[int]]
+
+
+def _read_proc_listeners() -> Set[int]:
+    """解析/proc/net/tcp和/proc/net/tcp6中处于LISTEN状态的本地端口"""
+    ports = set()
+    for path in _PROC_TCP_FILES:
+        try:
+            with open(path, 'r') as f:
+                next(f, None)  # 表头
+                for line in f:
+                    fields = line.split(None, 4)
+                    if len(fields) > 3 and fields[3] == _PROC_LISTEN_STATE:
+                        ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+        except FileNotFoundError:
+            # 未启用IPv6时没有tcp6
+            continue
+    return ports
+
+
+def _read_windows_listeners() -> Set[int]:
+    """通过GetExtendedTcpTable读取IPv4和IPv6的监听端口"""
+    import ctypes
+    from ctypes import wintypes
+
+    iphlpapi = ctypes.WinDLL('iphlpapi')
+    ports = set()
+    for family, row_size, port_offset in _WINDOWS_TABLE_LAYOUTS:
+        size = wintypes.DWORD(0)
+        buffer = None
+        while True:
+            result = iphlpapi.GetExtendedTcpTable(buffer, ctypes.byref(size), False, family,
+                                                  _TCP_TABLE_OWNER_PID_LISTENER, 0)
+            if result == 0:
+                break
+            if result != _ERROR_INSUFFICIENT_BUFFER:
+                raise ctypes.WinError(result)
+            # 两次调用之间监听表可能增长，按返回的大小重新分配
+            buffer = ctypes.create_string_buffer(size.value)
+
+        if buffer is not None:
+            ports.update(_parse_tcp_table(buffer.raw, row_size, port_offset))
+    return ports
+
+
+def _parse_tcp_table(data: bytes, row_size: int, port_offset: int) -> Set[int]:
+    """解析GetExtendedTcpTable返回的表：dwNumEntries后跟定长的行"""
+    view = memoryview(data)
+    count = int.from_bytes(view[0:4], sys.byteorder)
+    ports = set()
+    for index in range(count):
+        offset = 4 + index * row_size + port_offset
+        # dwLocalPort低16位为网络字节序的端口
+        ports.add(int.from_bytes(view[offset:offset + 2], 'big'))
+    return ports
+
+
+def default_listener_reader() -> Optional[ListenerReader]:
+    """当前平台读取监听表的函数，不支持时返回None"""
+    if sys.platform == 'win32':
+        return _read_windows_listeners
+    if os.path.exists(_PROC_TCP_FILES[0]):
+        return _read_proc_listeners
+    return None
+
+
+def bind_probe(port: int) -> bool:
+    """尝试bind判断端口是否空闲（仅在无法读取监听表时使用）"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('0.0.0.0', port))
+            return True
+    except socket.error:
+        return False
+
+
+class PortInventory:
+    """TCP端口占用表"""
+
+    def __init__(self, reader: Optional[ListenerReader] = None, ttl: float = DEFAULT_INVENTORY_TTL):
+        self.reader = reader or default_listener_reader()
+        self.ttl = ttl
+        # 每个端口一个字节，非0表示被其他程序监听
+        self._occupied = bytearray(PORT_COUNT)
+        # 本工具的规则保留的端口 -> 规则名称
+        self.reserved: Dict[int, str] = {}
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        """是否能读取系统监听表"""
+        return self.reader is not None
+
+    def refresh(self, force: bool = False):
+        """重新读取监听表（有效期内且未强制时跳过）"""
+        if self.reader is None:
+            return
+        if not force and time.monotonic() - self._refreshed_at < self.ttl:
+            return
+
+        with self._lock:
+            if not force and time.monotonic() - self._refreshed_at < self.ttl:
+                return
+            occupied = bytearray(PORT_COUNT)
+            for port in self.reader():
+                occupied[port] = 1
+            self._occupied = occupied
+            self._refreshed_at = time.monotonic()
+
+    def mark_listening(self, port: int, listening: bool = True):
+        """记录本进程开始或停止监听的端口，不必等下一次刷新"""
+        self._occupied[port] = 1 if listening else 0
+
+    def reserve(self, port: int, owner: str):
+        """为规则保留端口"""
+        self.reserved[port] = owner
+
+    def release(self, port: int, owner: Optional[str] = None):
+        """释放规则保留的端口"""
+        if owner is None or self.reserved.get(port) == owner:
+            self.reserved.pop(port, None)
+
+    def is_listening(self, port: int, refresh: bool = True) -> bool:
+        """端口是否被某个程序监听"""
+        if self.reader is None:
+            return not bind_probe(port)
+        if refresh:
+            self.refresh()
+        return bool(self._occupied[port])
+
+    def is_free(self, port: int, refresh: bool = True) -> bool:
+        """端口既没有被监听，也没有被规则保留"""
+        return port not in self.reserved and not self.is_listening(port, refresh)
+
+    def next_free(self, count: int = 1, start: int = DEFAULT_PORT_RANGE_START,
+                  end: int = DEFAULT_PORT_RANGE_END, exclude: Iterable[int] = ()) -> List[int]:
+        """返回区间[start, end]内的前count个空闲端口"""
+        self.refresh()
+        excluded = set(exclude)
+        excluded.update(self.reserved)
+        occupied = self._occupied
+        ports = []
+        position = max(start, 1)
+        while len(ports) < count and position <= end:
+            if self.reader is None:
+                free = bind_probe(position)
+            else:
+                # bytearray.find在C层跳过连续的占用端口
+                position = occupied.find(0, position, end + 1)
+                if position < 0:
+                    break
+                free = True
+            if free and position not in excluded:
+                ports.append(position)
+            position += 1
+        return ports
+
+    def conflicts(self, rules: Iterable, owned_ports: Iterable[int] = ()) -> List[dict]:
+        """
+        检查规则的本地端口冲突：多条启用的规则使用同一端口，或端口已被其他程序监听
+        owned_ports为已经由这些规则自身占用的端口（例如已在运行的规则），不视为被其他程序占用
+        """
+        self.refresh()
+        owned = set(owned_ports)
+        by_port: Dict[int, List[str]] = {}
+        for rule in rules:
+            if getattr(rule, 'enabled', True):
+                by_port.setdefault(rule.local_port, []).append(rule.name)
+
+        result = []
+        for port, names in sorted(by_port.items()):
+            if len(names) > 1:
+                result.append({'port': port, 'rules': names, 'reason': 'duplicate'})
+            elif port not in owned and self.is_listening(port, refresh=False):
+                result.append({'port': port, 'rules': names, 'reason': 'in_use'})
+        return result
+
+    def get_stats(self) -> dict:
+        """获取占用表统计"""
+        return {
+            'source': getattr(self.reader, '__name__', None),
+            'listening': self._occupied.count(1) if self.reader else None,
+            'reserved': len(self.reserved),
+            'age': time.monotonic() - self._refreshed_at if self._refreshed_at else None
+        }
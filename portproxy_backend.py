@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Portproxy注册表存储后端模块
+netsh portproxy规则保存在 HKLM\\SYSTEM\\CurrentControlSet\\Services\\PortProxy\\<表>\\tcp 下，
+值名为"监听地址/监听端口"，数据为"连接地址/连接端口"。本模块直接读写这些注册表值，
+不启动netsh子进程、也不解析本地化的文本输出。
+"""
+
+import sys
+import threading
+from typing import Dict, List, Optional, Tuple
+
+PORTPROXY_KEY = r'SYSTEM\CurrentControlSet\Services\PortProxy'
+DEFAULT_TABLE = 'v4tov4'
+# portproxy的四张表: 监听协议to连接协议
+TABLES = ('v4tov4', 'v4tov6', 'v6tov4', 'v6tov6')
+
+# RegNotifyChangeKeyValue过滤条件：值的增删改及子键增删
+REG_NOTIFY_CHANGE_NAME = 0x00000001
+REG_NOTIFY_CHANGE_LAST_SET = 0x00000004
+WAIT_OBJECT_0 = 0
+
+# (监听地址, 监听端口, 连接地址, 连接端口)
+PortproxyEntry = Tuple[str, int, str, int]
+
+
+def table_key(table: str = DEFAULT_TABLE) -> str:
+    """portproxy表对应的注册表路径"""
+    return f'{PORTPROXY_KEY}\\{table}\\tcp'
+
+
+def parse_value(name: str, data: str) -> Optional[PortproxyEntry]:
+    """解析注册表值，格式错误时返回None"""
+    try:
+        listen_address, listen_port = name.rsplit('/', 1)
+        connect_address, connect_port = data.rsplit('/', 1)
+        return listen_address, int(listen_port), connect_address, int(connect_port)
+    except (AttributeError, ValueError):
+        return None
+
+
+class MemoryRegistry:
+    """内存中的注册表实现，用于非Windows环境下的测试和演练"""
+
+    def __init__(self):
+        self.keys: Dict[str, Dict[str, str]] = {}
+        # 每次修改递增，供wait_for_change判断是否有变化
+        self.version = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def read_values(self, path: str) -> Dict[str, str]:
+        """读取键下的所有字符串值"""
+        with self._lock:
+            return dict(self.keys.get(path, {}))
+
+    def set_value(self, path: str, name: str, data: str):
+        """写入字符串值（键不存在时创建）"""
+        with self._lock:
+            self.keys.setdefault(path, {})[name] = data
+            self._touch()
+
+    def delete_value(self, path: str, name: str) -> bool:
+        """删除值，返回值是否存在"""
+        with self._lock:
+            existed = self.keys.get(path, {}).pop(name, None) is not None
+            if existed:
+                self._touch()
+            return existed
+
+    def delete_all(self, path: str):
+        """删除键下的所有值"""
+        with self._lock:
+            if self.keys.pop(path, None):
+                self._touch()
+
+    def _touch(self):
+        """记录一次修改并唤醒等待者（调用方持有锁）"""
+        self.version += 1
+        self._changed.notify_all()
+
+    def wait_for_change(self, timeout: float) -> bool:
+        """等待任意值被修改，超时返回False"""
+        with self._lock:
+            version = self.version
+            return self._changed.wait_for(lambda: self.version != version, timeout)
+
+    def close_watch(self):
+        """内存实现无需释放资源"""
+
+    def notify_change(self):
+        """内存实现无需通知服务"""
+
+
+class WindowsRegistry:
+    """基于winreg的HKLM注册表实现"""
+
+    def __init__(self):
+        import winreg
+        self.winreg = winreg
+        # (KEY_NOTIFY句柄, 事件句柄)，首次wait_for_change时创建
+        self._watch = None
+
+    def read_values(self, path: str) -> Dict[str, str]:
+        """读取键下的所有字符串值"""
+        winreg = self.winreg
+        values = {}
+        try:
+            with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_READ) as key:
+                index = 0
+                while True:
+                    try:
+                        name, data, value_type = winreg.EnumValue(key, index)
+                    except OSError:
+                        break
+                    if value_type == winreg.REG_SZ:
+                        values[name] = data
+                    index += 1
+        except FileNotFoundError:
+            pass
+        return values
+
+    def set_value(self, path: str, name: str, data: str):
+        """写入字符串值（键不存在时创建）"""
+        winreg = self.winreg
+        with winreg.CreateKeyEx(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_SET_VALUE) as key:
+            winreg.SetValueEx(key, name, 0, winreg.REG_SZ, data)
+
+    def delete_value(self, path: str, name: str) -> bool:
+        """删除值，返回值是否存在"""
+        winreg = self.winreg
+        try:
+            with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_SET_VALUE) as key:
+                winreg.DeleteValue(key, name)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def delete_all(self, path: str):
+        """删除键下的所有值"""
+        for name in self.read_values(path):
+            self.delete_value(path, name)
+
+    def wait_for_change(self, timeout: float) -> bool:
+        """通过RegNotifyChangeKeyValue等待PortProxy键（含子键）被修改，超时返回False"""
+        import ctypes
+        from ctypes import wintypes
+
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.CreateEventW.restype = wintypes.HANDLE
+        if self._watch is None:
+            winreg = self.winreg
+            key = winreg.CreateKeyEx(winreg.HKEY_LOCAL_MACHINE, PORTPROXY_KEY, 0, winreg.KEY_NOTIFY)
+            event = kernel32.CreateEventW(None, False, False, None)
+            if not event:
+                key.Close()
+                raise ctypes.WinError(ctypes.get_last_error())
+            self._watch = (key, event)
+            self._arm_watch()
+
+        _, event = self._watch
+        if kernel32.WaitForSingleObject(wintypes.HANDLE(event), int(timeout * 1000)) != WAIT_OBJECT_0:
+            return False
+        # 通知是一次性的，每次触发后重新注册
+        self._arm_watch()
+        return True
+
+    def _arm_watch(self):
+        """注册一次异步修改通知"""
+        import ctypes
+        from ctypes import wintypes
+
+        key, event = self._watch
+        advapi32 = ctypes.WinDLL('advapi32', use_last_error=True)
+        status = advapi32.RegNotifyChangeKeyValue(
+            wintypes.HANDLE(key.handle), True, REG_NOTIFY_CHANGE_NAME | REG_NOTIFY_CHANGE_LAST_SET,
+            wintypes.HANDLE(event), True)
+        if status != 0:
+            raise ctypes.WinError(status)
+
+    def close_watch(self):
+        """释放修改通知使用的句柄"""
+        import ctypes
+
+        if self._watch is None:
+            return
+        key, event = self._watch
+        self._watch = None
+        key.Close()
+        ctypes.WinDLL('kernel32').CloseHandle(ctypes.c_void_p(event))
+
+    def notify_change(self):
+        """通知IP Helper服务重新加载portproxy配置（SERVICE_CONTROL_PARAMCHANGE）"""
+        import ctypes
+        from ctypes import wintypes
+
+        advapi32 = ctypes.WinDLL('advapi32', use_last_error=True)
+        advapi32.OpenSCManagerW.restype = wintypes.HANDLE
+        advapi32.OpenServiceW.restype = wintypes.HANDLE
+        SC_MANAGER_CONNECT = 0x0001
+        SERVICE_PAUSE_CONTINUE = 0x0040
+        SERVICE_CONTROL_PARAMCHANGE = 0x00000006
+
+        class SERVICE_STATUS(ctypes.Structure):
+            _fields_ = [(name, wintypes.DWORD) for name in (
+                'dwServiceType', 'dwCurrentState', 'dwControlsAccepted', 'dwWin32ExitCode',
+                'dwServiceSpecificExitCode', 'dwCheckPoint', 'dwWaitHint')]
+
+        manager = advapi32.OpenSCManagerW(None, None, SC_MANAGER_CONNECT)
+        if not manager:
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            service = advapi32.OpenServiceW(manager, 'iphlpsvc', SERVICE_PAUSE_CONTINUE)
+            if not service:
+                raise ctypes.WinError(ctypes.get_last_error())
+            try:
+                status = SERVICE_STATUS()
+                if not advapi32.ControlService(service, SERVICE_CONTROL_PARAMCHANGE, ctypes.byref(status)):
+                    raise ctypes.WinError(ctypes.get_last_error())
+            finally:
+                advapi32.CloseServiceHandle(service)
+        finally:
+            advapi32.CloseServiceHandle(manager)
+
+
+def registry_available() -> bool:
+    """当前平台是否可以直接访问Windows注册表"""
+    if sys.platform != 'win32':
+        return False
+    try:
+        import winreg  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class RegistryPortproxyBackend:
+    """直接读写注册表的portproxy存储后端"""
+
+    name = 'registry'
+
+    def __init__(self, registry=None, table: str = DEFAULT_TABLE):
+        self.registry = registry if registry is not None else WindowsRegistry()
+        self.table = table
+        self.path = table_key(table)
+
+    def list_entries(self, table: Optional[str] = None) -> List[PortproxyEntry]:
+        """读取一张表的所有规则，默认为后端的表"""
+        entries = []
+        path = table_key(table) if table else self.path
+        for name, data in self.registry.read_values(path).items():
+            entry = parse_value(name, data)
+            if entry:
+                entries.append(entry)
+        entries.sort(key=lambda entry: (entry[1], entry[0]))
+        return entries
+
+    def fingerprint(self) -> tuple:
+        """所有规则表的原始内容，用于廉价地判断是否有变化"""
+        return tuple(tuple(sorted(self.registry.read_values(table_key(table)).items())) for table in TABLES)
+
+    def wait_for_change(self, timeout: float) -> bool:
+        """等待注册表中的portproxy配置被修改"""
+        return self.registry.wait_for_change(timeout)
+
+    def close_watch(self):
+        """停止等待修改通知"""
+        self.registry.close_watch()
+
+    def add(self, listen_port: int, connect_address: str, connect_port: int, listen_address: str = "*",
+            notify: bool = True, table: Optional[str] = None):
+        """添加或覆盖规则，默认写入后端的表"""
+        path = table_key(table) if table else self.path
+        self.registry.set_value(path, f'{listen_address}/{listen_port}', f'{connect_address}/{connect_port}')
+        if notify:
+            self.registry.notify_change()
+
+    def delete(self, listen_port: int, listen_address: str = "*", notify: bool = True,
+               table: Optional[str] = None) -> bool:
+        """删除规则，返回规则是否存在；默认删除后端的表中的规则"""
+        path = table_key(table) if table else self.path
+        # 通配监听地址可能以*或0.0.0.0（v6开头的表为::）保存
+        addresses = ('*', '0.0.0.0', '::') if listen_address in ('*', '0.0.0.0', '::') else (listen_address,)
+        existed = False
+        for address in addresses:
+            existed = self.registry.delete_value(path, f'{address}/{listen_port}') or existed
+        if existed and notify:
+            self.registry.notify_change()
+        return existed
+
+    def reset(self):
+        """删除所有规则"""
+        self.registry.delete_all(self.path)
+        self.registry.notify_change()
+
+    def notify(self):
+        """批量修改完成后统一通知服务"""
+        self.registry.notify_change()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Portproxy规则变化监视模块
+后台线程发现本工具以外对portproxy规则的修改，只把新增、删除和修改的差异推送给订阅者；
+通过NetshManager进行的修改在写入前登记，出现在规则表中时不推送。
+注册表后端使用RegNotifyChangeKeyValue等待修改通知；netsh后端按间隔比较show输出的哈希，
+只有内容变化时才重新解析。监视器运行期间NetshManager的快照不再按时间过期。
+"""
+
+import threading
+import time
+import logging
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from netsh_manager import NetshManager, NetshPortproxyRule, PortproxyKey, portproxy_key
+
+CHANGE_ADDED = 'added'
+CHANGE_REMOVED = 'removed'
+CHANGE_MODIFIED = 'modified'
+
+# 轮询间隔；注册表通知模式下为单次等待的最长时间（秒）
+DEFAULT_WATCH_INTERVAL = 2.0
+# 本工具的写入在多久内出现在规则表中时视为自身修改（秒），超过后同样的变化按外部修改推送
+OWN_WRITE_TTL = 30.0
+
+
+class PortproxyChange:
+    """一条规则的变化"""
+
+    def __init__(self, kind: str, rule: NetshPortproxyRule, previous: Optional[NetshPortproxyRule] = None):
+        self.kind = kind
+        # 删除事件中为被删除的规则
+        self.rule = rule
+        # 修改事件中为修改前的规则
+        self.previous = previous
+
+    def to_dict(self) -> dict:
+        """转换为字典"""
+        data = {'kind': self.kind, 'rule': self.rule.to_dict()}
+        if self.previous is not None:
+            data['previous'] = self.previous.to_dict()
+        return data
+
+    def __str__(self):
+        if self.kind == CHANGE_MODIFIED:
+            return f"{self.kind}: {self.previous} => {self.rule}"
+        return f"{self.kind}: {self.rule}"
+
+
+ChangeCallback = Callable[[List[PortproxyChange]], None]
+
+
+def _rule_key(rule: NetshPortproxyRule) -> PortproxyKey:
+    """规则的唯一标识: (表, 监听地址, 监听端口)"""
+    return portproxy_key(rule.table, rule.listen_address, rule.listen_port)
+
+
+def diff_rules(old_rules: List[NetshPortproxyRule], new_rules: List[NetshPortproxyRule]) -> List[PortproxyChange]:
+    """比较两份规则表，返回变化列表"""
+    old = {_rule_key(rule): rule for rule in old_rules}
+    new = {_rule_key(rule): rule for rule in new_rules}
+
+    changes = []
+    for key, rule in new.items():
+        previous = old.get(key)
+        if previous is None:
+            changes.append(PortproxyChange(CHANGE_ADDED, rule))
+        elif (previous.connect_address, previous.connect_port) != (rule.connect_address, rule.connect_port):
+            changes.append(PortproxyChange(CHANGE_MODIFIED, rule, previous))
+    for key, rule in old.items():
+        if key not in new:
+            changes.append(PortproxyChange(CHANGE_REMOVED, rule))
+    return changes
+
+
+class PortproxyWatcher:
+    """监视portproxy规则表并推送差异"""
+
+    def __init__(self, netsh_manager: NetshManager, interval: float = DEFAULT_WATCH_INTERVAL,
+                 logger: Optional[logging.Logger] = None):
+        self.netsh_manager = netsh_manager
+        self.interval = interval
+        self.logger = logger or netsh_manager.logger
+        self.rules: Dict[PortproxyKey, NetshPortproxyRule] = {}
+        # 本工具写入的规则状态: 规则标识 -> (写入后的目标，删除时为None；写入时间)
+        self._own_writes: Dict[PortproxyKey, Tuple[Optional[Tuple[str, int]], float]] = {}
+        self._fingerprint: Optional[Hashable] = None
+        self._subscribers: List[ChangeCallback] = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # 注册表通知不可用时退回到轮询
+        self._notify = netsh_manager.registry_backend is not None
+
+    def subscribe(self, callback: ChangeCallback) -> ChangeCallback:
+        """订阅变化，回调参数为一次检查发现的全部变化"""
+        with self._lock:
+            self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback: ChangeCallback):
+        """取消订阅"""
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def start(self):
+        """读取初始规则表并启动监视线程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._fingerprint, snapshot = self.netsh_manager.refresh_if_changed(None)
+        snapshot = snapshot or self.netsh_manager.get_snapshot()
+        self.rules = {_rule_key(rule): rule for rule in snapshot.rules}
+
+        self._stopping.clear()
+        self.netsh_manager.watched = True
+        if self._expect_writes not in self.netsh_manager.write_observers:
+            self.netsh_manager.write_observers.append(self._expect_writes)
+        self._thread = threading.Thread(target=self._watch_thread, name='PortproxyWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """停止监视，快照恢复按cache_ttl过期"""
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+        self.netsh_manager.watched = False
+        if self._expect_writes in self.netsh_manager.write_observers:
+            self.netsh_manager.write_observers.remove(self._expect_writes)
+        if self._notify:
+            try:
+                self.netsh_manager.registry_backend.close_watch()
+            except Exception:
+                pass
+
+    def check(self) -> List[PortproxyChange]:
+        """检查一次规则表，有变化时通知订阅者并返回变化列表"""
+        self._fingerprint, snapshot = self.netsh_manager.refresh_if_changed(self._fingerprint)
+        if snapshot is None:
+            return []
+
+        changes = self._drop_own_writes(diff_rules(list(self.rules.values()), snapshot.rules))
+        self.rules = {_rule_key(rule): rule for rule in snapshot.rules}
+        if changes:
+            self.logger.info(f"检测到 {len(changes)} 个portproxy规则变化")
+            self._publish(changes)
+        return changes
+
+    def _expect_writes(self, writes: List[Tuple[PortproxyKey, Optional[Tuple[str, int]]]]):
+        """记录本工具即将写入的规则状态（NetshManager在修改前调用），同一规则以最后一次写入为准"""
+        now = time.monotonic()
+        with self._lock:
+            for key, target in writes:
+                self._own_writes[key] = (target, now)
+
+    def _drop_own_writes(self, changes: List[PortproxyChange]) -> List[PortproxyChange]:
+        """去掉与本工具写入的状态一致的变化，只保留外部修改"""
+        now = time.monotonic()
+        external = []
+        with self._lock:
+            for key, (_, written_at) in list(self._own_writes.items()):
+                if now - written_at > OWN_WRITE_TTL:
+                    del self._own_writes[key]
+            for change in changes:
+                key = _rule_key(change.rule)
+                state = None if change.kind == CHANGE_REMOVED else (change.rule.connect_address, change.rule.connect_port)
+                own = self._own_writes.get(key)
+                if own is not None and own[0] == state:
+                    del self._own_writes[key]
+                else:
+                    external.append(change)
+        return external
+
+    def _publish(self, changes: List[PortproxyChange]):
+        """通知所有订阅者，单个回调出错不影响其他订阅者"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(changes)
+            except Exception as e:
+                self.logger.error(f"处理portproxy规则变化回调失败: {str(e)}")
+
+    def _wait(self):
+        """等待下一次检查：优先等待注册表修改通知，否则按间隔轮询"""
+        if self._notify:
+            try:
+                self.netsh_manager.registry_backend.wait_for_change(self.interval)
+                return
+            except Exception as e:
+                self.logger.warning(f"注册表修改通知不可用，改为轮询: {str(e)}")
+                self._notify = False
+        self._stopping.wait(self.interval)
+
+    def _watch_thread(self):
+        """监视线程"""
+        while not self._stopping.is_set():
+            self._wait()
+            if self._stopping.is_set():
+                break
+            try:
+                self.check()
+            except Exception as e:
+                self.logger.error(f"检查portproxy规则变化失败: {str(e)}")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+令牌桶限速模块
+按规则和按客户端IP限制转发带宽（字节/秒，双向合计）和新建连接速率（连接/秒）。
+带宽按"先转发后扣减"计算欠额，中继按欠额暂停读取对应方向，不需要轮询等待。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# 每条规则最多保留的客户端令牌桶数，超过后淘汰最久未使用的桶
+MAX_CLIENT_BUCKETS = 4096
+# 客户端令牌桶空闲多久后可以淘汰（秒）
+CLIENT_BUCKET_IDLE = 60.0
+
+
+class TokenBucket:
+    """令牌桶：rate为每秒补充的令牌数，burst为桶容量（默认为1秒的令牌）"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst else self.rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        """按经过的时间补充令牌（now可能略早于桶的创建时间，此时不补充）"""
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def consume(self, amount: float, now: float) -> float:
+        """扣减令牌（允许欠额），返回需要等待多久才能还清欠额"""
+        self._refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def try_consume(self, amount: float, now: float) -> bool:
+        """令牌足够时扣减并返回True，否则不扣减"""
+        self._refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def idle_since(self, now: float) -> float:
+        """桶已补满且未被使用的时间"""
+        return now - self.updated if self.tokens >= self.capacity else 0.0
+
+
+class RuleRateLimiter:
+    """单条规则的限速器，0表示不限制"""
+
+    def __init__(self, bandwidth: float = 0, client_bandwidth: float = 0,
+                 connection_rate: float = 0, client_connection_rate: float = 0):
+        self.bandwidth = bandwidth
+        self.client_bandwidth = client_bandwidth
+        self.connection_rate = connection_rate
+        self.client_connection_rate = client_connection_rate
+        self._bandwidth_bucket = TokenBucket(bandwidth) if bandwidth else None
+        self._connection_bucket = TokenBucket(connection_rate) if connection_rate else None
+        # 客户端IP -> (带宽桶, 连接速率桶)，按最近使用顺序排列
+        self._clients: 'OrderedDict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected_connections = 0
+        self.throttled_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.bandwidth or self.client_bandwidth or self.connection_rate or self.client_connection_rate)
+
+    @property
+    def limits_bandwidth(self) -> bool:
+        return bool(self.bandwidth or self.client_bandwidth)
+
+    def _client_buckets(self, client_ip: Optional[str], now: float) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        """获取客户端的令牌桶（调用方持有锁）"""
+        if client_ip is None or not (self.client_bandwidth or self.client_connection_rate):
+            return None, None
+        buckets = self._clients.get(client_ip)
+        if buckets is None:
+            if len(self._clients) >= MAX_CLIENT_BUCKETS:
+                self._evict_clients(now)
+            buckets = (
+                TokenBucket(self.client_bandwidth) if self.client_bandwidth else None,
+                TokenBucket(self.client_connection_rate) if self.client_connection_rate else None
+            )
+            self._clients[client_ip] = buckets
+        else:
+            self._clients.move_to_end(client_ip)
+        return buckets
+
+    def _evict_clients(self, now: float):
+        """
+        从最久未使用的一端淘汰客户端令牌桶（调用方持有锁）：
+        先淘汰已补满且长时间未使用的桶，仍然满时淘汰最久未使用的桶，保证桶数不超过MAX_CLIENT_BUCKETS
+        """
+        clients = self._clients
+        while clients:
+            buckets = next(iter(clients.values()))
+            if not all(bucket is None or bucket.idle_since(now) >= CLIENT_BUCKET_IDLE for bucket in buckets):
+                break
+            clients.popitem(last=False)
+        while len(clients) >= MAX_CLIENT_BUCKETS:
+            clients.popitem(last=False)
+
+    def allow_connection(self, client_ip: Optional[str]) -> bool:
+        """新建连接是否在速率限制内"""
+        if not (self.connection_rate or self.client_connection_rate):
+            return True
+        now = time.monotonic()
+        with self._lock:
+            _, client_bucket = self._client_buckets(client_ip, now)
+            # 先检查客户端桶，避免被拒绝的客户端消耗规则的连接配额
+            if client_bucket and not client_bucket.try_consume(1, now):
+                self.rejected_connections += 1
+                return False
+            if self._connection_bucket and not self._connection_bucket.try_consume(1, now):
+                self.rejected_connections += 1
+                return False
+            return True
+
+    def consume(self, client_ip: Optional[str], amount: int) -> float:
+        """记录已转发的字节数，返回该方向应暂停读取的秒数"""
+        if not amount or not self.limits_bandwidth:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            client_bucket, _ = self._client_buckets(client_ip, now)
+            delay = 0.0
+            if self._bandwidth_bucket:
+                delay = self._bandwidth_bucket.consume(amount, now)
+            if client_bucket:
+                delay = max(delay, client_bucket.consume(amount, now))
+            self.throttled_seconds += delay
+            return delay
+
+    def to_dict(self) -> dict:
+        """限速配置"""
+        return {
+            'bandwidth_limit': self.bandwidth,
+            'client_bandwidth_limit': self.client_bandwidth,
+            'connection_rate_limit': self.connection_rate,
+            'client_connection_rate_limit': self.client_connection_rate
+        }
+
+    def get_stats(self) -> dict:
+        """限速配置及统计"""
+        stats = self.to_dict()
+        stats.update({
+            'rate_limited_connections': self.rejected_connections,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+            'tracked_clients': len(self._clients)
+        })
+        return stats
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+规则对齐模块
+比较期望的规则集合与实时的portproxy规则表，生成最小的新增/删除/修改计划，
+可以只输出计划（演练），也可以通过一次netsh批处理只执行差异部分。
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from port_forwarder import PortForwardRule
+from netsh_manager import NetshManager, NetshPortproxyRule, NetshBatchOperation, _normalize_listen_address
+from portproxy_backend import DEFAULT_TABLE
+from udp_forwarder import PROTOCOL_TCP
+
+ACTION_ADD = 'add'
+ACTION_DELETE = 'delete'
+ACTION_MODIFY = 'modify'
+
+# 本工具添加规则时使用的通配监听地址
+WILDCARD_ADDRESS = '*'
+
+
+def _command_address(key: Tuple[str, int]) -> str:
+    """show输出把*显示为0.0.0.0，写回时仍使用*，避免在注册表中产生第二条规则"""
+    return WILDCARD_ADDRESS if key[0] == _normalize_listen_address(WILDCARD_ADDRESS) else key[0]
+
+
+class ReconcileChange:
+    """计划中的一项变更"""
+
+    def __init__(self, action: str, listen_address: str, listen_port: int,
+                 rule: Optional[PortForwardRule] = None, current: Optional[NetshPortproxyRule] = None):
+        self.action = action
+        self.listen_address = listen_address
+        self.listen_port = listen_port
+        # 期望的规则（删除时为None）
+        self.rule = rule
+        # 当前表中的规则（新增时为None）
+        self.current = current
+        self.operation: Optional[NetshBatchOperation] = None
+
+    @property
+    def success(self) -> bool:
+        """执行结果，未执行时为False"""
+        return self.operation is not None and self.operation.success
+
+    def to_dict(self) -> dict:
+        """转换为字典"""
+        data = {
+            'action': self.action,
+            'listen_address': self.listen_address,
+            'listen_port': self.listen_port
+        }
+        if self.rule is not None:
+            data.update({'name': self.rule.name, 'target_host': self.rule.target_host, 'target_port': self.rule.target_port})
+        if self.current is not None:
+            data.update({'current_host': self.current.connect_address, 'current_port': self.current.connect_port})
+        if self.operation is not None:
+            data.update({'success': self.operation.success, 'message': self.operation.message})
+        return data
+
+    def __str__(self):
+        listen = f"{self.listen_address}:{self.listen_port}"
+        if self.action == ACTION_ADD:
+            return f"+ {listen} -> {self.rule.target_host}:{self.rule.target_port} ({self.rule.name})"
+        if self.action == ACTION_DELETE:
+            return f"- {listen} -> {self.current.connect_address}:{self.current.connect_port}"
+        return (f"~ {listen} -> {self.current.connect_address}:{self.current.connect_port}"
+                f" => {self.rule.target_host}:{self.rule.target_port} ({self.rule.name})")
+
+
+class ReconcilePlan:
+    """对齐计划"""
+
+    def __init__(self, changes: List[ReconcileChange], unchanged: int):
+        self.changes = changes
+        self.unchanged = unchanged
+
+    def by_action(self, action: str) -> List[ReconcileChange]:
+        """按动作筛选变更"""
+        return [change for change in self.changes if change.action == action]
+
+    @property
+    def empty(self) -> bool:
+        return not self.changes
+
+    def summary(self) -> Dict[str, int]:
+        """各类变更的数量"""
+        return {
+            ACTION_ADD: len(self.by_action(ACTION_ADD)),
+            ACTION_DELETE: len(self.by_action(ACTION_DELETE)),
+            ACTION_MODIFY: len(self.by_action(ACTION_MODIFY)),
+            'unchanged': self.unchanged
+        }
+
+    def to_dict(self) -> dict:
+        """转换为字典"""
+        return {'summary': self.summary(), 'changes': [change.to_dict() for change in self.changes]}
+
+    def format(self) -> str:
+        """生成演练输出"""
+        summary = self.summary()
+        lines = [str(change) for change in self.changes]
+        lines.append(f"新增 {summary[ACTION_ADD]}，删除 {summary[ACTION_DELETE]}，"
+                     f"修改 {summary[ACTION_MODIFY]}，不变 {summary['unchanged']}")
+        return '\n'.join(lines)
+
+
+class Reconciler:
+    """期望状态对齐器"""
+
+    def __init__(self, netsh_manager: NetshManager):
+        self.netsh_manager = netsh_manager
+
+    def plan(self, desired_rules: List[PortForwardRule], prune: bool = False) -> ReconcilePlan:
+        """
+        计算期望规则与实时规则表的差异
+        只考虑已启用的期望规则；prune为True时删除表中不在期望集合里的规则
+        """
+        desired: Dict[Tuple[str, int], PortForwardRule] = {}
+        for rule in desired_rules:
+            # netsh portproxy只支持TCP，UDP规则由本地转发引擎处理
+            if rule.enabled and rule.protocol == PROTOCOL_TCP:
+                # 同一监听地址出现多次时以最后一条为准，与逐条添加的结果一致
+                desired[(_normalize_listen_address(WILDCARD_ADDRESS), rule.local_port)] = rule
+
+        live: Dict[Tuple[str, int], NetshPortproxyRule] = {
+            (_normalize_listen_address(rule.listen_address), rule.listen_port): rule
+            for rule in self.netsh_manager.get_snapshot().rules
+            if rule.table == DEFAULT_TABLE
+        }
+
+        changes = []
+        unchanged = 0
+        for key, rule in desired.items():
+            current = live.get(key)
+            if current is None:
+                changes.append(ReconcileChange(ACTION_ADD, WILDCARD_ADDRESS, rule.local_port, rule=rule))
+            elif (current.connect_address, current.connect_port) != (rule.target_host, rule.target_port):
+                changes.append(ReconcileChange(ACTION_MODIFY, _command_address(key), rule.local_port,
+                                               rule=rule, current=current))
+            else:
+                unchanged += 1
+
+        for key, current in live.items():
+            if key in desired:
+                continue
+            if prune:
+                changes.append(ReconcileChange(ACTION_DELETE, _command_address(key), current.listen_port,
+                                               current=current))
+            else:
+                unchanged += 1
+
+        return ReconcilePlan(changes, unchanged)
+
+    def apply(self, plan: ReconcilePlan) -> bool:
+        """通过一次批处理执行计划，计划为空时不调用netsh"""
+        if plan.empty:
+            return True
+
+        with self.netsh_manager.batch() as batch:
+            # 先删除再新增，释放的端口可以被新规则使用
+            for change in plan.by_action(ACTION_DELETE):
+                change.operation = batch.delete(change.listen_port, change.listen_address)
+            for change in plan.changes:
+                if change.action != ACTION_DELETE:
+                    # add会直接覆盖同一监听地址上的现有规则，修改不需要先删除，避免短暂中断
+                    change.operation = batch.add(change.rule.local_port, change.rule.target_host,
+                                                 change.rule.target_port, change.listen_address)
+
+        return all(change.success for change in plan.changes)
+
+    def reconcile(self, desired_rules: List[PortForwardRule], prune: bool = False,
+                  dry_run: bool = False) -> ReconcilePlan:
+        """计算并（非演练时）执行计划"""
+        plan = self.plan(desired_rules, prune)
+        if not dry_run:
+            self.apply(plan)
+        return plan
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据中继后端模块
+提供单方向转发数据的可插拔实现：
+- splice: Linux上通过管道对在内核中直接搬运数据，不经过用户态拷贝
+- buffer: recv_into到预分配缓冲区，按sendall语义循环发送
+以及中继连接的TCP选项（TCP_NODELAY、keepalive）设置。
+通道用于非阻塞套接字：receive收取一块数据，send尽量发出待发送的数据，对端暂时不能接收时保留在通道中，
+两个转发方向互不等待，由调用方按待发送数据量注册可读/可写事件。
+"""
+
+import os
+import sys
+import socket
+
+RELAY_AUTO = 'auto'
+RELAY_SPLICE = 'splice'
+RELAY_BUFFER = 'buffer'
+RELAY_BACKENDS = (RELAY_AUTO, RELAY_SPLICE, RELAY_BUFFER)
+
+# 每次搬运的最大字节数
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# 连接上游的默认超时（秒）
+DEFAULT_CONNECT_TIMEOUT = 10.0
+# 会话空闲超时（秒），0表示不超时
+DEFAULT_SESSION_IDLE_TIMEOUT = 0
+# TCP keepalive默认参数: 空闲多久开始探测、探测间隔（秒）和探测次数
+DEFAULT_KEEPALIVE_IDLE = 60
+DEFAULT_KEEPALIVE_INTERVAL = 10
+DEFAULT_KEEPALIVE_COUNT = 5
+
+
+def splice_supported() -> bool:
+    """当前平台是否支持splice"""
+    return sys.platform.startswith('linux') and hasattr(os, 'splice')
+
+
+def tune_socket(sock, nodelay: bool = True, keepalive: bool = True, keepalive_idle: int = DEFAULT_KEEPALIVE_IDLE,
+                keepalive_interval: int = DEFAULT_KEEPALIVE_INTERVAL, keepalive_count: int = DEFAULT_KEEPALIVE_COUNT):
+    """
+    设置中继连接的TCP选项：TCP_NODELAY关闭Nagle算法；keepalive探测失效的对端，
+    平台不支持的keepalive参数会被跳过（macOS用TCP_KEEPALIVE表示空闲时间）
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if nodelay else 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 if keepalive else 0)
+        if not keepalive:
+            return
+        idle_option = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+        for option, value in ((idle_option, keepalive_idle),
+                              (getattr(socket, 'TCP_KEEPINTVL', None), keepalive_interval),
+                              (getattr(socket, 'TCP_KEEPCNT', None), keepalive_count)):
+            if option is not None and value:
+                sock.setsockopt(socket.IPPROTO_TCP, option, int(value))
+    except OSError:
+        # 非TCP套接字或连接已被重置
+        pass
+
+
+def shutdown_write(sock: socket.socket):
+    """半关闭：向对端发送FIN，仍可继续接收对端的数据"""
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+class BufferRelayChannel:
+    """基于预分配缓冲区的中继通道，每个转发方向一个实例"""
+
+    name = RELAY_BUFFER
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.buffer = bytearray(chunk_size)
+        self.view = memoryview(self.buffer)
+        # 缓冲区中待发送数据的范围
+        self.start = 0
+        self.end = 0
+
+    @property
+    def pending(self) -> int:
+        """尚未发出的字节数"""
+        return self.end - self.start
+
+    def receive(self, source: socket.socket) -> int:
+        """在待发送数据发完后收取一块数据，返回字节数，0表示源端已关闭；没有数据时抛出BlockingIOError"""
+        received = source.recv_into(self.buffer)
+        self.start = 0
+        self.end = received
+        return received
+
+    def send(self, destination: socket.socket) -> bool:
+        """发送待发送的数据，全部发出时返回True，目标暂时不能接收时返回False"""
+        while self.start < self.end:
+            try:
+                self.start += destination.send(self.view[self.start:self.end])
+            except BlockingIOError:
+                return False
+        return True
+
+    def close(self):
+        """释放缓冲区"""
+        self.view.release()
+
+
+class SpliceRelayChannel:
+    """基于os.splice的零拷贝中继通道，每个转发方向持有一个管道对"""
+
+    name = RELAY_SPLICE
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.read_fd, self.write_fd = os.pipe()
+        # 管道一端也不阻塞，数据留在管道中等待目标可写
+        self.flags = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+        # 管道中尚未送往目标的字节数
+        self.pending = 0
+
+    def receive(self, source: socket.socket) -> int:
+        """在管道清空后收取一块数据，返回字节数，0表示源端已关闭；没有数据时抛出BlockingIOError"""
+        received = os.splice(source.fileno(), self.write_fd, self.chunk_size, flags=self.flags)
+        self.pending = received
+        return received
+
+    def send(self, destination: socket.socket) -> bool:
+        """把管道中的数据送往目标，全部送出时返回True，目标暂时不能接收时返回False"""
+        while self.pending > 0:
+            try:
+                self.pending -= os.splice(self.read_fd, destination.fileno(), self.pending, flags=self.flags)
+            except BlockingIOError:
+                return False
+        return True
+
+    def close(self):
+        """关闭管道"""
+        for fd in (self.read_fd, self.write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def resolve_relay_backend(backend: str = RELAY_AUTO) -> str:
+    """解析实际使用的中继后端"""
+    if backend not in RELAY_BACKENDS:
+        raise ValueError(f"不支持的中继后端: {backend}")
+
+    if backend == RELAY_AUTO:
+        return RELAY_SPLICE if splice_supported() else RELAY_BUFFER
+
+    if backend == RELAY_SPLICE and not splice_supported():
+        raise ValueError("当前平台不支持splice中继后端")
+
+    return backend
+
+
+def create_relay_channel(backend: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """创建中继通道"""
+    if backend == RELAY_SPLICE:
+        try:
+            return SpliceRelayChannel(chunk_size)
+        except OSError:
+            # 文件描述符耗尽等情况下退回到缓冲区方式
+            pass
+    return BufferRelayChannel(chunk_size)
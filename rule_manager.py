@@ -8,18 +8,63 @@ import json
 import os
 from typing import List, Dict, Optional
 from port_forwarder import PortForwardRule, PortForwarder
-from netsh_manager import NetshManager
+from netsh_manager import (BACKEND_NETSH, DEFAULT_BATCH_PARALLELISM, CommandRunner, NetshManager,
+                           _command_listen_address)
+from portproxy_watcher import PortproxyWatcher, ChangeCallback
+from rule_store import DEFAULT_METADATA_FILE, RuleMetadataStore, RuleRecord
+from reconciler import Reconciler, ReconcilePlan
+from port_inventory import PortInventory, DEFAULT_PORT_RANGE_START, DEFAULT_PORT_RANGE_END
+from portproxy_backend import DEFAULT_TABLE
+
+# 本工具添加的规则所在的portproxy表，其他表中的规则不按端口或名称匹配到元数据
+MANAGED_TABLE = DEFAULT_TABLE
+
+class BatchResults(dict):
+    """批量操作结果：规则名 -> 是否成功，另带失败原因和耗时"""
+    
+    def __init__(self, rule_names: List[str]):
+        super().__init__((name, False) for name in rule_names)
+        self.errors: Dict[str, str] = {}
+        self.timings: Dict[str, float] = {}
+    
+    def record(self, name: str, success: bool, error: str = '', elapsed: float = 0.0):
+        """记录一条规则的结果"""
+        self[name] = success
+        self.timings[name] = elapsed
+        if success:
+            self.errors.pop(name, None)
+        else:
+            self.errors[name] = error or '操作失败'
+    
+    def record_operation(self, name: str, operation):
+        """按netsh批处理操作记录结果"""
+        self.record(name, operation.success, operation.message, operation.elapsed)
+
 
 class RuleManager:
     """规则管理器 - 直接基于netsh portproxy规则"""
     
-    def __init__(self, config_file: str = "rules.json"):
+    def __init__(self, config_file: str = "rules.json", forwarder: Optional[PortForwarder] = None,
+                 metadata_file: str = DEFAULT_METADATA_FILE, batch_parallelism: int = DEFAULT_BATCH_PARALLELISM,
+                 command_runner: Optional[CommandRunner] = None, backend: str = BACKEND_NETSH, registry=None):
         self.config_file = config_file  # 保留用于兼容性，但不再使用
-        self.netsh_manager = NetshManager()
-        # 不再使用内部PortForwarder，所有操作直接基于netsh
+        # 大批量操作拆分为多个netsh脚本，最多batch_parallelism个并行执行；command_runner可替换netsh子进程
+        # backend为registry或auto时直接读写portproxy注册表（registry可传入MemoryRegistry用于测试和演练）
+        self.netsh_manager = NetshManager(command_runner=command_runner, backend=backend, registry=registry,
+                                          parallelism=batch_parallelism)
+        # 规则名称、启用状态、标签等netsh不保存的信息
+        self.store = RuleMetadataStore(metadata_file)
+        self.reconciler = Reconciler(self.netsh_manager)
+        # 系统监听端口占用表，用于导入前的冲突检查和空闲端口建议
+        self.port_inventory = forwarder.port_inventory if forwarder else PortInventory()
+        # 规则操作直接基于netsh；可选的PortForwarder仅用于提供本进程转发的实时流量统计
+        self.forwarder = forwarder
+        # 外部修改监视器，首次订阅时启动
+        self.watcher: Optional[PortproxyWatcher] = None
         self.load_rules_from_netsh()
     
-    def add_rule(self, name: str, local_port: int, target_host: str, target_port: int, enabled: bool = True) -> bool:
+    def add_rule(self, name: str, local_port: int, target_host: str, target_port: int, enabled: bool = True,
+                 tags: Optional[List[str]] = None) -> bool:
         """添加规则到netsh portproxy"""
         try:
             rule = PortForwardRule(name, local_port, target_host, target_port, enabled)
@@ -27,8 +72,12 @@ class RuleManager:
                 # 直接添加到netsh
                 success = self.netsh_manager.add_portproxy_rule(local_port, target_host, target_port)
             else:
-                # 如果不启用，只是记录规则信息（可以通过注释或其他方式）
+                # 停用的规则只保存元数据
                 success = True
+            if success:
+                if enabled:
+                    self._release_port(rule)
+                self.store.upsert(rule, tags)
             return success
         except Exception as e:
             print(f"添加规则失败: {str(e)}")
@@ -37,29 +86,44 @@ class RuleManager:
     def remove_rule(self, rule_name: str) -> bool:
         """从netsh portproxy删除规则"""
         try:
-            # 根据规则名称找到对应的netsh规则
-            netsh_rules = self.netsh_manager.get_all_portproxy_rules()
-            target_rule = None
-            
-            # 通过规则名称匹配查找规则
-            # 规则名称格式通常是 "Rule_端口号"
-            for rule in netsh_rules:
-                # 生成规则名称用于匹配
-                generated_name = f"Rule_{rule.listen_port}"
-                if generated_name == rule_name:
-                    target_rule = rule
-                    break
-            
-            if target_rule:
-                success = self.netsh_manager.delete_portproxy_rule(target_rule.listen_port)
-            else:
-                # 如果找不到规则，可能已经被删除
-                success = True
+            success = self._remove_from_netsh(rule_name)
+            if success:
+                self.store.delete([rule_name])
             return success
         except Exception as e:
             print(f"删除规则失败: {str(e)}")
             return False
     
+    def _release_port(self, rule: PortForwardRule):
+        """netsh同一端口只保留一条规则，启用新规则后同端口的其他规则标记为停用"""
+        others = [record.name for record in self.store.find_by_port(rule.local_port)
+                  if record.enabled and record.name != rule.name]
+        if others:
+            self.store.set_enabled(others, False)
+    
+    def _find_netsh_rule(self, rule_name: str):
+        """
+        按名称找到netsh中对应的规则：先查元数据中的端口，再按默认名称（Rule_端口号）查找。
+        本工具的规则都添加在v4tov4表中，其他表中同端口的规则不属于本工具
+        """
+        record = self.store.get(rule_name)
+        if record is not None:
+            if not record.enabled:
+                return None
+            rules = self.netsh_manager.find_rules_by_port(record.rule.local_port, MANAGED_TABLE)
+            return rules[0] if rules else None
+        return self.netsh_manager.find_rule_by_name(rule_name, MANAGED_TABLE)
+    
+    def _remove_from_netsh(self, rule_name: str) -> bool:
+        """从netsh删除规则，规则不在netsh中时视为成功"""
+        target_rule = self._find_netsh_rule(rule_name)
+        if target_rule:
+            return self.netsh_manager.delete_portproxy_rule(
+                target_rule.listen_port, _command_listen_address(target_rule.listen_address, target_rule.table),
+                target_rule.table)
+        # 如果找不到规则，可能已经被删除
+        return True
+    
     def update_rule(self, old_name: str, new_name: str, local_port: int, target_host: str, target_port: int, enabled: bool = True) -> bool:
         """更新netsh portproxy规则"""
         try:
@@ -67,14 +131,16 @@ class RuleManager:
             old_rule = self.get_rule(old_name)
             if not old_rule:
                 return False
+            record = self.store.get(old_name)
+            tags = record.tags if record else None
             
             # 从netsh删除旧规则
             success = self.remove_rule(old_name)
             if not success:
                 return False
             
-            # 添加新规则
-            success = self.add_rule(new_name, local_port, target_host, target_port, enabled)
+            # 添加新规则，保留原有标签
+            success = self.add_rule(new_name, local_port, target_host, target_port, enabled, tags)
             return success
             
         except Exception as e:
@@ -84,18 +150,18 @@ class RuleManager:
     def enable_rule(self, rule_name: str) -> bool:
         """启用规则（添加到netsh portproxy）"""
         try:
-            # 从存储的规则信息中获取规则详情（需要实现规则信息存储）
-            # 这里暂时通过netsh规则查找，实际可能需要额外的元数据存储
-            netsh_rules = self.netsh_manager.get_all_portproxy_rules()
-            for rule in netsh_rules:
-                if hasattr(rule, 'name') and rule.name == rule_name:
-                    # 规则已存在于netsh中，认为已启用
-                    return True
+            record = self.store.get(rule_name)
+            if record is None:
+                # 没有元数据的规则只可能来自netsh，存在即为启用
+                return self.netsh_manager.find_rule_by_name(rule_name, MANAGED_TABLE) is not None
             
-            # 如果规则不在netsh中，需要从某处获取规则信息并添加
-            # 这里需要额外的逻辑来存储和检索规则元数据
-            print(f"规则 {rule_name} 的详细信息需要从元数据中获取")
-            return False
+            rule = record.rule
+            if not record.enabled or not self.netsh_manager.find_rules_by_port(rule.local_port, MANAGED_TABLE):
+                if not self.netsh_manager.add_portproxy_rule(rule.local_port, rule.target_host, rule.target_port):
+                    return False
+            self._release_port(rule)
+            self.store.set_enabled([rule_name], True)
+            return True
             
         except Exception as e:
             print(f"启用规则失败: {str(e)}")
@@ -104,69 +170,154 @@ class RuleManager:
     def disable_rule(self, rule_name: str) -> bool:
         """停用规则（从netsh portproxy移除）"""
         try:
-            # 直接调用remove_rule方法
-            return self.remove_rule(rule_name)
+            # 从netsh移除，保留元数据以便重新启用
+            success = self._remove_from_netsh(rule_name)
+            if success:
+                self.store.set_enabled([rule_name], False)
+            return success
             
         except Exception as e:
             print(f"停用规则失败: {str(e)}")
             return False
     
-    def batch_enable(self, rule_names: List[str]) -> Dict[str, bool]:
+    def batch_enable(self, rule_names: List[str]) -> BatchResults:
         """批量启用规则"""
-        results = {}
-        for name in rule_names:
-            results[name] = self.enable_rule(name)
-        return results
+        results = BatchResults(rule_names)
+        try:
+            snapshot = self.netsh_manager.get_snapshot()
+            
+            operations = {}
+            with self.netsh_manager.batch() as batch:
+                for name in rule_names:
+                    record = self.store.get(name)
+                    if record is None:
+                        results.record(name, snapshot.rule_named(name, MANAGED_TABLE) is not None, '规则不存在')
+                    elif record.enabled and snapshot.rules_on_port(record.rule.local_port, MANAGED_TABLE):
+                        results.record(name, True)
+                    else:
+                        rule = record.rule
+                        operations[name] = batch.add(rule.local_port, rule.target_host, rule.target_port)
+            
+            # 同一端口以最后添加的规则为准（netsh中后添加的覆盖先添加的）
+            enabled: Dict[int, str] = {}
+            for name, operation in operations.items():
+                results.record_operation(name, operation)
+                if operation.success:
+                    enabled[operation.listen_port] = name
+            for name in enabled.values():
+                # 与enable_rule一致：同端口的其他规则已被覆盖，标记为停用
+                self._release_port(self.store.get(name).rule)
+            self.store.set_enabled(list(enabled.values()), True)
+            return results
+            
+        except Exception as e:
+            print(f"批量启用规则失败: {str(e)}")
+            for name in rule_names:
+                results.record(name, False, str(e))
+            return results
     
-    def batch_disable(self, rule_names: List[str]) -> Dict[str, bool]:
+    def batch_disable(self, rule_names: List[str]) -> BatchResults:
         """批量停用规则"""
-        results = {}
-        for name in rule_names:
-            results[name] = self.disable_rule(name)
-        return results
+        return self._batch_remove(rule_names, delete_metadata=False)
     
-    def batch_delete(self, rule_names: List[str]) -> Dict[str, bool]:
+    def batch_delete(self, rule_names: List[str]) -> BatchResults:
         """批量删除规则"""
-        results = {}
-        for name in rule_names:
-            results[name] = self.remove_rule(name)
-        return results
+        return self._batch_remove(rule_names, delete_metadata=True)
     
-    def get_all_rules(self) -> List[PortForwardRule]:
-        """获取所有netsh portproxy规则"""
+    def _batch_remove(self, rule_names: List[str], delete_metadata: bool) -> BatchResults:
+        """基于一份规则表快照，通过netsh批处理删除多条规则"""
+        results = BatchResults(rule_names)
         try:
-            netsh_rules = self.netsh_manager.get_all_portproxy_rules()
-            port_forward_rules = []
+            snapshot = self.netsh_manager.get_snapshot()
+            
+            operations = {}
+            with self.netsh_manager.batch() as batch:
+                for name in rule_names:
+                    record = self.store.get(name)
+                    if record is not None:
+                        rules = snapshot.rules_on_port(record.rule.local_port, MANAGED_TABLE) if record.enabled else None
+                        rule = rules[0] if rules else None
+                    else:
+                        rule = snapshot.rule_named(name, MANAGED_TABLE)
+                    if rule:
+                        # 按快照中规则的监听地址和表删除，否则只会删除通配地址上的规则
+                        operations[name] = batch.delete(
+                            rule.listen_port, _command_listen_address(rule.listen_address, rule.table), rule.table)
+                    else:
+                        # 如果找不到规则，可能已经被删除
+                        results.record(name, True)
             
-            for rule in netsh_rules:
-                # 将netsh规则转换为PortForwardRule格式
-                name = getattr(rule, 'name', f"Rule_{rule.listen_port}")
-                port_rule = PortForwardRule(
-                    name=name,
-                    local_port=rule.listen_port,
-                    target_host=rule.connect_address,
-                    target_port=rule.connect_port,
-                    enabled=True  # netsh中的规则都是启用状态
-                )
-                port_forward_rules.append(port_rule)
+            for name, operation in operations.items():
+                results.record_operation(name, operation)
+            succeeded = [name for name in rule_names if results[name]]
+            if delete_metadata:
+                self.store.delete(succeeded)
+            else:
+                self.store.set_enabled(succeeded, False)
+            return results
             
-            return port_forward_rules
+        except Exception as e:
+            print(f"批量删除规则失败: {str(e)}")
+            for name in rule_names:
+                results.record(name, False, str(e))
+            return results
+    
+    def get_all_rules(self) -> List[PortForwardRule]:
+        """获取所有规则：netsh中（v4tov4表）的规则加上元数据中停用的规则"""
+        try:
+            netsh_rules = self.netsh_manager.get_all_portproxy_rules(MANAGED_TABLE)
+            rules = [self._to_port_forward_rule(rule) for rule in netsh_rules]
+            rules.extend(record.rule for record in self.store.get_all() if not record.enabled)
+            return rules
         except Exception as e:
             print(f"获取规则失败: {str(e)}")
             return []
     
+    def _to_port_forward_rule(self, rule) -> PortForwardRule:
+        """将netsh规则转换为PortForwardRule格式，有元数据时使用保存的名称和配置"""
+        record = self.store.find_enabled_by_port(rule.listen_port)
+        if record is not None:
+            return record.rule
+        return PortForwardRule(
+            name=rule.name,
+            local_port=rule.listen_port,
+            target_host=rule.connect_address,
+            target_port=rule.connect_port,
+            enabled=True  # netsh中的规则都是启用状态
+        )
+    
     def get_rule(self, rule_name: str) -> Optional[PortForwardRule]:
         """获取指定规则"""
-        all_rules = self.get_all_rules()
-        for rule in all_rules:
-            if rule.name == rule_name:
-                return rule
-        return None
+        try:
+            record = self.store.get(rule_name)
+            if record is not None:
+                return record.rule
+            rule = self.netsh_manager.find_rule_by_name(rule_name, MANAGED_TABLE)
+            return self._to_port_forward_rule(rule) if rule else None
+        except Exception as e:
+            print(f"获取规则失败: {str(e)}")
+            return None
+    
+    def get_rules_by_tag(self, tag: str) -> List[PortForwardRule]:
+        """获取带有指定标签的规则"""
+        return [record.rule for record in self.store.find_by_tag(tag)]
+    
+    def get_rule_metadata(self, rule_name: str) -> Optional[RuleRecord]:
+        """获取规则的元数据（标签、创建和修改时间）"""
+        return self.store.get(rule_name)
+    
+    def set_rule_tags(self, rule_name: str, tags: List[str]) -> bool:
+        """设置规则标签"""
+        return self.store.set_tags(rule_name, tags)
     
     def load_rules_from_netsh(self) -> bool:
-        """从netsh加载规则（替代原来的load_rules）"""
+        """从netsh加载规则（替代原来的load_rules），并与元数据对齐；只登记v4tov4表中的规则"""
         try:
-            # 直接从netsh读取，不需要额外操作
+            live_rules = [
+                PortForwardRule(rule.name, rule.listen_port, rule.connect_address, rule.connect_port)
+                for rule in self.netsh_manager.get_all_portproxy_rules(MANAGED_TABLE)
+            ]
+            self.store.reconcile(live_rules)
             return True
         except Exception as e:
             print(f"从netsh加载规则失败: {str(e)}")
@@ -197,66 +348,136 @@ class RuleManager:
             print(f"导出规则失败: {str(e)}")
             return False
     
+    def _load_rules_file(self, file_path: str) -> Optional[List[PortForwardRule]]:
+        """读取规则文件"""
+        if not os.path.exists(file_path):
+            return None
+        
+        with open(file_path, 'r', encoding='utf-8') as f:
+            rules_data = json.load(f)
+        return [PortForwardRule.from_dict(rule_data) for rule_data in rules_data]
+    
+    def plan_import(self, file_path: str, replace: bool = False) -> Optional[ReconcilePlan]:
+        """演练导入：返回需要执行的变更计划，不修改netsh"""
+        try:
+            rules = self._load_rules_file(file_path)
+            if rules is None:
+                return None
+            return self.reconciler.plan(rules, prune=replace)
+        except Exception as e:
+            print(f"生成导入计划失败: {str(e)}")
+            return None
+    
+    def find_port_conflicts(self, rules: List[PortForwardRule]) -> List[dict]:
+        """
+        检查规则的本地端口冲突：规则之间重复使用同一端口，或端口已被其他程序监听
+        已在netsh中的端口由iphlpsvc监听，不视为冲突
+        """
+        netsh_ports = self.netsh_manager.get_snapshot().by_port.keys()
+        return self.port_inventory.conflicts(rules, owned_ports=netsh_ports)
+    
+    def suggest_free_ports(self, count: int = 1, start: int = DEFAULT_PORT_RANGE_START,
+                           end: int = DEFAULT_PORT_RANGE_END) -> List[int]:
+        """建议未被netsh规则、已保存的规则和其他程序使用的端口"""
+        used = set(self.netsh_manager.get_snapshot().by_port.keys())
+        used.update(self.store.by_port.keys())
+        return self.port_inventory.next_free(count, start, end, exclude=used)
+    
     def import_rules(self, file_path: str, replace: bool = False) -> bool:
-        """导入规则到netsh"""
+        """导入规则到netsh，只执行与当前规则表的差异；replace为True时删除文件中没有的规则"""
         try:
-            if not os.path.exists(file_path):
+            rules = self._load_rules_file(file_path)
+            if rules is None:
                 return False
             
-            with open(file_path, 'r', encoding='utf-8') as f:
-                rules_data = json.load(f)
+            # 导入前一次性检查端口冲突，有冲突时不做任何修改
+            conflicts = self.find_port_conflicts(rules)
+            if conflicts:
+                for conflict in conflicts:
+                    reason = '重复' if conflict['reason'] == 'duplicate' else '已被其他程序占用'
+                    print(f"端口 {conflict['port']} {reason}: {', '.join(conflict['rules'])}")
+                return False
             
-            if replace:
-                # 清空现有netsh规则
-                self.netsh_manager.clear_all_portproxy_rules()
+            # 差异通过一次netsh批处理执行，未变化的规则不受影响
+            plan = self.reconciler.reconcile(rules, prune=replace)
             
-            for rule_data in rules_data:
-                rule = PortForwardRule.from_dict(rule_data)
+            if replace:
+                names = {rule.name for rule in rules}
+                self.store.delete([record.name for record in self.store.get_all() if record.name not in names])
+            for rule in rules:
                 if rule.enabled:
-                    self.netsh_manager.add_portproxy_rule(
-                        rule.local_port, rule.target_host, rule.target_port
-                    )
+                    self._release_port(rule)
+            self.store.upsert_many(rules)
             
-            return True
+            return all(change.success for change in plan.changes)
             
         except Exception as e:
             print(f"导入规则失败: {str(e)}")
             return False
     
+    def _get_live_stats(self, rule: PortForwardRule) -> Dict[str, any]:
+        """从关联的PortForwarder获取规则的实时流量统计（按名称或本地端口匹配）"""
+        if not self.forwarder:
+            return {}
+        
+        live_rule = self.forwarder.get_rule(rule.name)
+        if live_rule is None:
+            for candidate in self.forwarder.get_rules():
+                if candidate.local_port == rule.local_port:
+                    live_rule = candidate
+                    break
+        if live_rule is None:
+            return {}
+        
+        stats = self.forwarder.get_rule_status(live_rule.name)
+        for key in ('name', 'local_port', 'target_host', 'target_port', 'enabled', 'is_running'):
+            stats.pop(key, None)
+        return stats
+    
     def get_rule_status(self, rule_name: str) -> Dict[str, any]:
         """获取规则状态"""
         rule = self.get_rule(rule_name)
         if not rule:
             return {}
-        
-        return {
+        return self._build_status(rule)
+    
+    def _build_status(self, rule: PortForwardRule) -> Dict[str, any]:
+        """生成规则状态"""
+        status = {
             'name': rule.name,
             'local_port': rule.local_port,
             'target_host': rule.target_host,
             'target_port': rule.target_port,
             'enabled': rule.enabled,
             'is_running': rule.enabled,  # netsh中的规则都是运行状态
-            'connections': 0  # netsh无法直接获取连接数
+            'connections': 0  # netsh无法直接获取连接数，由关联的PortForwarder统计覆盖
         }
+        status.update(self._get_live_stats(rule))
+        return status
     
     def get_all_status(self) -> List[Dict[str, any]]:
         """获取所有规则状态"""
-        status_list = []
-        for rule in self.get_all_rules():
-            status_list.append(self.get_rule_status(rule.name))
-        return status_list
+        # 所有规则共用同一份快照，不再逐条重新读取netsh
+        return [self._build_status(rule) for rule in self.get_all_rules()]
     
     def set_netsh_sync(self, enabled: bool) -> bool:
         """设置是否同步到netsh（基于netsh的实现中此方法保留兼容性）"""
         # 基于netsh的实现中，所有操作都直接作用于netsh
         return True
     
+    def plan_sync(self) -> ReconcilePlan:
+        """演练同步：列出元数据中已启用、但netsh中缺失或目标不一致的规则"""
+        return self.reconciler.plan([record.rule for record in self.store.get_all() if record.enabled])
+    
     def sync_all_to_netsh(self) -> Dict[str, bool]:
-        """同步所有规则到netsh（基于netsh的实现中规则已在netsh中）"""
-        results = {}
+        """将元数据中已启用的规则同步到netsh，只补齐缺失或目标不一致的规则"""
         try:
-            for rule in self.get_all_rules():
-                results[rule.name] = True  # 规则已在netsh中
+            rules = [record.rule for record in self.store.get_all() if record.enabled]
+            plan = self.reconciler.reconcile(rules)
+            
+            results = {rule.name: True for rule in rules}
+            for change in plan.changes:
+                results[change.rule.name] = change.success
             return results
         except Exception as e:
             print(f"同步所有规则到netsh失败: {str(e)}")
@@ -279,7 +500,22 @@ class RuleManager:
             print(f"获取netsh规则失败: {str(e)}")
             return []
     
+    def watch_netsh_changes(self, callback: ChangeCallback) -> ChangeCallback:
+        """订阅其他程序对netsh规则的修改，代替定时全量刷新"""
+        if self.watcher is None:
+            self.watcher = PortproxyWatcher(self.netsh_manager)
+            self.watcher.start()
+        return self.watcher.subscribe(callback)
+    
+    def unwatch_netsh_changes(self, callback: ChangeCallback):
+        """取消订阅netsh规则修改"""
+        if self.watcher:
+            self.watcher.unsubscribe(callback)
+    
     def cleanup(self):
         """清理资源"""
-        # 基于netsh的实现不需要额外清理
-        pass
\ No newline at end of file
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        self.store.close()
+        self.netsh_manager.close()
\ No newline at end of file
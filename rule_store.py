@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+规则元数据存储模块
+netsh portproxy只保存监听地址和目标地址，规则名称、启用状态、标签和完整配置保存在SQLite中；
+启动时全部载入内存并建立按名称、端口和标签的索引，查询不再扫描规则表。
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from port_forwarder import PortForwardRule
+
+DEFAULT_METADATA_FILE = 'rules.db'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rules (
+    name TEXT PRIMARY KEY,
+    local_port INTEGER NOT NULL,
+    enabled INTEGER NOT NULL,
+    tags TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+'''
+
+
+class RuleRecord:
+    """一条规则的元数据"""
+
+    def __init__(self, rule: PortForwardRule, tags: Optional[Iterable[str]] = None,
+                 created_at: Optional[float] = None, updated_at: Optional[float] = None):
+        now = time.time()
+        self.rule = rule
+        self.tags: List[str] = sorted(set(tags or []))
+        self.created_at = created_at or now
+        self.updated_at = updated_at or now
+
+    @property
+    def name(self) -> str:
+        return self.rule.name
+
+    @property
+    def enabled(self) -> bool:
+        return self.rule.enabled
+
+    def to_dict(self) -> dict:
+        """转换为字典"""
+        data = self.rule.to_dict()
+        data.update({
+            'tags': list(self.tags),
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        })
+        return data
+
+
+class RuleMetadataStore:
+    """SQLite规则元数据存储，带内存索引"""
+
+    def __init__(self, path: str = DEFAULT_METADATA_FILE):
+        self.path = path
+        self.records: Dict[str, RuleRecord] = {}
+        self.by_port: Dict[int, Set[str]] = {}
+        self.by_tag: Dict[str, Set[str]] = {}
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        """载入全部记录并建立索引"""
+        rows = self._conn.execute('SELECT data, tags, created_at, updated_at FROM rules').fetchall()
+        for data, tags, created_at, updated_at in rows:
+            record = RuleRecord(PortForwardRule.from_dict(json.loads(data)), json.loads(tags), created_at, updated_at)
+            self._index(record)
+
+    def _index(self, record: RuleRecord):
+        """加入内存索引"""
+        self.records[record.name] = record
+        self.by_port.setdefault(record.rule.local_port, set()).add(record.name)
+        for tag in record.tags:
+            self.by_tag.setdefault(tag, set()).add(record.name)
+
+    def _unindex(self, record: RuleRecord):
+        """移出内存索引"""
+        self.records.pop(record.name, None)
+        names = self.by_port.get(record.rule.local_port)
+        if names is not None:
+            names.discard(record.name)
+            if not names:
+                del self.by_port[record.rule.local_port]
+        for tag in record.tags:
+            names = self.by_tag.get(tag)
+            if names is not None:
+                names.discard(record.name)
+                if not names:
+                    del self.by_tag[tag]
+
+    def _write(self, records: List[RuleRecord]):
+        """写入数据库（调用方持有锁）"""
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO rules (name, local_port, enabled, tags, data, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (record.name, record.rule.local_port, int(record.enabled), json.dumps(record.tags),
+                 json.dumps(record.rule.to_dict(), ensure_ascii=False), record.created_at, record.updated_at)
+                for record in records
+            ]
+        )
+        self._conn.commit()
+
+    def get(self, name: str) -> Optional[RuleRecord]:
+        """按名称获取记录"""
+        return self.records.get(name)
+
+    def find_by_port(self, local_port: int) -> List[RuleRecord]:
+        """按本地端口获取记录"""
+        return [self.records[name] for name in sorted(self.by_port.get(local_port, ()))]
+
+    def find_enabled_by_port(self, local_port: int) -> Optional[RuleRecord]:
+        """获取端口上已启用的记录（同一端口在netsh中只能有一条规则）"""
+        for record in self.find_by_port(local_port):
+            if record.enabled:
+                return record
+        return None
+
+    def find_by_tag(self, tag: str) -> List[RuleRecord]:
+        """按标签获取记录"""
+        return [self.records[name] for name in sorted(self.by_tag.get(tag, ()))]
+
+    def get_all(self) -> List[RuleRecord]:
+        """获取所有记录"""
+        return list(self.records.values())
+
+    def upsert(self, rule: PortForwardRule, tags: Optional[Iterable[str]] = None) -> RuleRecord:
+        """添加或更新记录；tags为None时保留原有标签"""
+        return self.upsert_many([rule], tags)[0]
+
+    def upsert_many(self, rules: List[PortForwardRule], tags: Optional[Iterable[str]] = None) -> List[RuleRecord]:
+        """在一个事务中添加或更新多条记录"""
+        now = time.time()
+        with self._lock:
+            records = []
+            for rule in rules:
+                existing = self.records.get(rule.name)
+                if existing:
+                    self._unindex(existing)
+                    record = RuleRecord(rule, existing.tags if tags is None else tags, existing.created_at, now)
+                else:
+                    record = RuleRecord(rule, tags, now, now)
+                self._index(record)
+                records.append(record)
+            self._write(records)
+            return records
+
+    def set_enabled(self, names: Iterable[str], enabled: bool) -> List[str]:
+        """修改启用状态，返回存在的规则名称"""
+        now = time.time()
+        with self._lock:
+            records = []
+            for name in names:
+                record = self.records.get(name)
+                if record is None:
+                    continue
+                record.rule.enabled = enabled
+                record.updated_at = now
+                records.append(record)
+            self._write(records)
+            return [record.name for record in records]
+
+    def set_tags(self, name: str, tags: Iterable[str]) -> bool:
+        """替换规则的标签"""
+        with self._lock:
+            record = self.records.get(name)
+            if record is None:
+                return False
+            self._unindex(record)
+            record.tags = sorted(set(tags))
+            record.updated_at = time.time()
+            self._index(record)
+            self._write([record])
+            return True
+
+    def delete(self, names: Iterable[str]) -> List[str]:
+        """删除记录，返回存在的规则名称"""
+        with self._lock:
+            deleted = []
+            for name in names:
+                record = self.records.get(name)
+                if record is not None:
+                    self._unindex(record)
+                    deleted.append(name)
+            self._conn.executemany('DELETE FROM rules WHERE name = ?', [(name,) for name in deleted])
+            self._conn.commit()
+            return deleted
+
+    def reconcile(self, live_rules: List[PortForwardRule]) -> Dict[str, int]:
+        """
+        与实时的portproxy规则表对齐:
+        表中有、元数据中没有的规则按默认名称登记为启用；元数据中已启用、表中却不存在的规则标记为停用
+        （保留元数据以便重新启用）；目标地址被外部修改的规则同步为表中的目标。
+        live_rules只应包含本工具管理的v4tov4表中的规则，其他表的同端口规则会被误认为本工具的规则
+        """
+        adopted: List[PortForwardRule] = []
+        updated: List[PortForwardRule] = []
+        live_ports = set()
+        with self._lock:
+            for live in live_rules:
+                live_ports.add(live.local_port)
+                record = self.find_enabled_by_port(live.local_port)
+                if record is None:
+                    adopted.append(live)
+                elif (record.rule.target_host, record.rule.target_port) != (live.target_host, live.target_port):
+                    data = record.rule.to_dict()
+                    data.update({'target_host': live.target_host, 'target_port': live.target_port, 'targets': None})
+                    updated.append(PortForwardRule.from_dict(data))
+
+            missing = [record.name for record in self.records.values()
+                       if record.enabled and record.rule.local_port not in live_ports]
+
+            if adopted or updated:
+                self.upsert_many(adopted + updated)
+            if missing:
+                self.set_enabled(missing, False)
+
+        return {'adopted': len(adopted), 'updated': len(updated), 'disabled': len(missing)}
+
+    def close(self):
+        """关闭数据库"""
+        with self._lock:
+            self._conn.close()
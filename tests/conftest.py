@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试公共设施：把项目根目录加入导入路径，提供在内存中模拟netsh portproxy的命令执行器，
+以及转发测试用的本地回显服务、空闲端口和PortForwarder
+"""
+
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from portproxy_backend import TABLES  # noqa: E402
+
+# 模拟netsh的错误输出
+NOT_FOUND_OUTPUT = '系统找不到指定的文件。'
+ACCESS_DENIED_OUTPUT = '请求的操作需要提升。'
+
+
+class FakeNetsh:
+    """模拟netsh interface portproxy的CommandRunner，支持单条命令、netsh -f脚本和show all"""
+
+    def __init__(self):
+        # 表 -> {(监听地址, 监听端口): (连接地址, 连接端口)}
+        self.tables = {table: {} for table in TABLES}
+        # 对这些监听端口的修改失败（模拟权限不足或被其他程序占用）
+        self.fail_ports = set()
+        self.commands = []
+
+    def __call__(self, command: str):
+        self.commands.append(command)
+        if command == 'netsh interface portproxy show all':
+            return True, self.render()
+        script = re.match(r'netsh -f "(.+)"$', command)
+        if script:
+            with open(script.group(1), encoding='utf-8') as f:
+                outputs = [self.execute(line) for line in f.read().splitlines() if line.strip()]
+            return True, '\n'.join(output for output in outputs if output)
+        output = self.execute(command[len('netsh '):])
+        return not output, output
+
+    def execute(self, line: str) -> str:
+        """执行一行portproxy add/delete命令，成功时返回空字符串"""
+        words = line.split()
+        action, table = words[2], words[3]
+        params = dict(word.split('=', 1) for word in words[4:])
+        address, port = params['listenaddress'], int(params['listenport'])
+        if port in self.fail_ports:
+            return ACCESS_DENIED_OUTPUT
+        entries = self.tables[table]
+        if action == 'add':
+            entries[(address, port)] = (params['connectaddress'], int(params['connectport']))
+            return ''
+        # netsh把*与通配地址视为同一个监听地址
+        wildcards = ('*', '0.0.0.0', '::')
+        for candidate in (wildcards if address in wildcards else (address,)):
+            if entries.pop((candidate, port), None):
+                return ''
+        return NOT_FOUND_OUTPUT
+
+    def render(self) -> str:
+        """生成show all的英文输出"""
+        blocks = []
+        for table, entries in self.tables.items():
+            if not entries:
+                continue
+            lines = [f'Listen on ipv{table[1]}:             Connect to ipv{table[-1]}:', '',
+                     'Address         Port        Address         Port',
+                     '--------------- ----------  --------------- ----------']
+            for (address, port), (connect_address, connect_port) in sorted(entries.items(), key=lambda item: item[0][1]):
+                lines.append(f'{address:<15} {port:<11} {connect_address:<15} {connect_port}')
+            blocks.append('\n'.join(lines))
+        return '\n\n'.join(blocks) + '\n'
+
+    def script_calls(self) -> int:
+        """netsh -f脚本调用次数"""
+        return sum(1 for command in self.commands if command.startswith('netsh -f '))
+
+
+@pytest.fixture
+def fake_netsh():
+    return FakeNetsh()
+
+
+@pytest.fixture
+def unused_port():
+    """返回一个函数，每次调用得到一个当前未被占用的本地TCP端口"""
+    def pick() -> int:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+    return pick
+
+
+@pytest.fixture
+def echo_server():
+    """本地TCP回显服务（读到EOF后关闭连接），返回其端口"""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(64)
+
+    def handle(conn: socket.socket):
+        with conn:
+            try:
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    conn.sendall(data)
+            except OSError:
+                pass
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield server.getsockname()[1]
+    try:
+        server.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    server.close()
+
+
+@pytest.fixture
+def make_forwarder():
+    """创建PortForwarder（只输出WARNING以上日志），测试结束时停止所有规则"""
+    from port_forwarder import PortForwarder
+
+    forwarders = []
+
+    def make(**kwargs):
+        forwarder = PortForwarder(**kwargs)
+        forwarder.logger.setLevel('WARNING')
+        forwarders.append(forwarder)
+        return forwarder
+
+    yield make
+    for forwarder in forwarders:
+        forwarder.stop_all()
+
+
+@pytest.fixture
+def wait_until():
+    """返回一个函数：在timeout秒内轮询predicate，成立时返回True"""
+    def wait(predicate, timeout: float = 5) -> bool:
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.02)
+        return True
+    return wait
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""AccessLogger计数测试"""
+
+import queue
+import threading
+
+from access_log import AccessLogger, REASON_ABORTED
+
+
+def _log_concurrently(logger: AccessLogger, threads: int = 8, count: int = 1000):
+    def worker():
+        for _ in range(count):
+            logger.log('r', ('127.0.0.1', 1), reason=REASON_ABORTED)
+            logger.log('r', ('127.0.0.1', 1))
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+
+def test_counters_are_consistent_across_threads(tmp_path):
+    logger = AccessLogger(str(tmp_path / 'access.log'), sample_rate=0.5, rate=0)
+    _log_concurrently(logger)
+    stats = logger.get_stats()
+    logger.close()
+
+    # 异常关闭的记录不参与采样
+    assert stats['logged'] + stats['dropped'] >= 8000
+    assert stats['logged'] + stats['sampled_out'] + stats['dropped'] == 16000
+    with open(tmp_path / 'access.log', encoding='utf-8') as f:
+        assert sum(1 for _ in f) == stats['logged']
+
+
+def test_full_queue_counts_dropped_records(tmp_path):
+    logger = AccessLogger(str(tmp_path / 'access.log'), rate=0)
+    # 换成已满的队列，后台线程不再消费新记录
+    full = queue.Queue(1)
+    full.put(None)
+    logger.handler.queue = full
+    _log_concurrently(logger, count=100)
+    stats = logger.get_stats()
+    logger.close()
+
+    assert (stats['logged'], stats['dropped']) == (0, 1600)
+
+
+def test_disabled_without_path():
+    before = threading.active_count()
+    logger = AccessLogger()
+    logger.log('r', ('127.0.0.1', 1))
+
+    # 未配置日志文件时不启动后台线程，也不计数
+    assert not logger.enabled
+    assert threading.active_count() == before
+    assert logger.get_stats()['logged'] == 0
+    logger.close()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""连接准入控制测试"""
+
+import socket
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from admission import OVERLOAD_QUEUE, OVERLOAD_REJECT, OVERLOAD_WAIT, AdmissionController
+
+
+def _rule(name: str = 'r', max_connections: int = 0):
+    return SimpleNamespace(name=name, max_connections=max_connections, is_running=True)
+
+
+@pytest.fixture
+def connections():
+    """返回一个函数，每次调用得到(服务端套接字, 客户端套接字)"""
+    created = []
+
+    def make():
+        pair = socket.socketpair()
+        created.append(pair)
+        return pair
+
+    yield make
+    for pair in created:
+        for sock in pair:
+            sock.close()
+
+
+def _peer_reset(peer: socket.socket) -> bool:
+    peer.settimeout(2)
+    try:
+        return peer.recv(1) == b''
+    except ConnectionResetError:
+        return True
+
+
+def test_queue_hands_off_released_slot(connections):
+    controller = AdmissionController(1, OVERLOAD_QUEUE)
+    rule = _rule()
+    dispatched = []
+    dispatch = lambda rule, sock, addr: dispatched.append(addr)
+
+    assert controller.admit(rule, connections()[0], 'a', dispatch)
+    assert not controller.admit(rule, connections()[0], 'b', dispatch)
+    assert not controller.admit(rule, connections()[0], 'c', dispatch)
+    assert dispatched == ['a'] and controller.get_stats('r')['queued'] == 2
+
+    # 释放名额时按入队顺序放行
+    controller.release(rule, dispatch)
+    assert dispatched == ['a', 'b']
+    assert controller.get_stats('r') == {'active': 1, 'queued': 1, 'rejected': 0}
+
+
+def test_queue_does_not_block_other_rules(connections):
+    controller = AdmissionController(10, OVERLOAD_QUEUE)
+    busy, idle = _rule('busy', max_connections=1), _rule('idle')
+    dispatched = []
+    dispatch = lambda rule, sock, addr: dispatched.append(addr)
+
+    assert controller.admit(busy, connections()[0], 'a', dispatch)
+    assert not controller.admit(busy, connections()[0], 'b', dispatch)
+    assert controller.admit(idle, connections()[0], 'c', dispatch)
+    assert dispatched == ['a', 'c']
+
+
+def test_queued_connection_expires(connections):
+    controller = AdmissionController(1, OVERLOAD_QUEUE, overload_timeout=0.1)
+    rule = _rule()
+    dispatch = lambda rule, sock, addr: None
+    assert controller.admit(rule, connections()[0], 'a', dispatch)
+    sock, peer = connections()
+
+    # 没有名额释放时也按时拒绝
+    assert not controller.admit(rule, sock, 'b', dispatch)
+    assert _peer_reset(peer)
+    assert controller.get_stats('r') == {'active': 1, 'queued': 0, 'rejected': 1}
+
+
+def test_reject_policy_resets_connection(connections):
+    controller = AdmissionController(1, OVERLOAD_REJECT)
+    rule = _rule()
+    dispatch = lambda rule, sock, addr: None
+    assert controller.admit(rule, connections()[0], 'a', dispatch)
+    sock, peer = connections()
+
+    assert not controller.admit(rule, sock, 'b', dispatch)
+    assert _peer_reset(peer)
+    assert controller.get_stats()['rejected_by_rule'] == {'r': 1}
+
+
+def test_wait_policy(connections):
+    controller = AdmissionController(1, OVERLOAD_WAIT, overload_timeout=5)
+    rule = _rule()
+    dispatched = []
+    dispatch = lambda rule, sock, addr: dispatched.append(addr)
+    assert controller.admit(rule, connections()[0], 'a', dispatch)
+
+    waiter = threading.Thread(target=controller.admit, args=(rule, connections()[0], 'b', dispatch))
+    waiter.start()
+    controller.release(rule, dispatch)
+    waiter.join(5)
+    assert dispatched == ['a', 'b']
+
+    # 等待超时后拒绝
+    controller.overload_timeout = 0.1
+    assert not controller.admit(rule, connections()[0], 'c', dispatch)
+    assert controller.get_stats('r')['rejected'] == 1
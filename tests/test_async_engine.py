@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""asyncio转发引擎测试"""
+
+import socket
+
+from port_forwarder import ENGINE_ASYNCIO, PortForwardRule
+
+
+def _recv_all(sock: socket.socket) -> bytes:
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+def test_relays_with_half_close(make_forwarder, echo_server, unused_port, wait_until):
+    forwarder = make_forwarder(engine=ENGINE_ASYNCIO)
+    port = unused_port()
+    assert forwarder.add_rule(PortForwardRule('r', port, '127.0.0.1', echo_server))
+
+    payload = b'x' * 300000
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+        client.sendall(payload)
+        # 客户端半关闭后仍能收到上游的全部回显
+        client.shutdown(socket.SHUT_WR)
+        assert _recv_all(client) == payload
+
+    assert wait_until(lambda: forwarder.get_relay_task_count() == 0)
+    status = forwarder.get_rule_status('r')
+    assert (status['total_connections'], status['active_connections']) == (1, 0)
+    assert status['bytes_in'] == status['bytes_out'] == len(payload)
+
+
+def test_idle_session_is_closed(make_forwarder, echo_server, unused_port, wait_until):
+    forwarder = make_forwarder(engine=ENGINE_ASYNCIO)
+    port = unused_port()
+    assert forwarder.add_rule(PortForwardRule('r', port, '127.0.0.1', echo_server, idle_timeout=0.3))
+
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+        assert client.recv(1) == b''
+
+    assert wait_until(lambda: forwarder.get_rule_status('r')['idle_timeouts'] == 1)
+
+
+def test_upstream_connect_failure(make_forwarder, unused_port, wait_until):
+    forwarder = make_forwarder(engine=ENGINE_ASYNCIO)
+    port = unused_port()
+    assert forwarder.add_rule(PortForwardRule('r', port, '127.0.0.1', unused_port(), connect_timeout=1))
+
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+        try:
+            assert client.recv(1) == b''
+        except ConnectionResetError:
+            pass
+
+    assert wait_until(lambda: forwarder.get_rule_status('r')['connect_failures'] == 1)
+    assert forwarder.get_relay_task_count() == 0
+
+
+def test_stop_rule_closes_listener_and_sessions(make_forwarder, echo_server, unused_port, wait_until):
+    forwarder = make_forwarder(engine=ENGINE_ASYNCIO)
+    port = unused_port()
+    assert forwarder.add_rule(PortForwardRule('r', port, '127.0.0.1', echo_server))
+
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+        client.sendall(b'ping')
+        assert client.recv(4) == b'ping'
+        assert wait_until(lambda: forwarder.get_relay_task_count() == 1)
+
+        assert forwarder.stop_rule('r')
+        try:
+            assert client.recv(1) == b''
+        except ConnectionResetError:
+            pass
+
+    assert wait_until(lambda: forwarder.get_relay_task_count() == 0)
+    try:
+        socket.create_connection(('127.0.0.1', port), timeout=1).close()
+        refused = False
+    except OSError:
+        refused = True
+    assert refused
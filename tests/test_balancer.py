@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""负载均衡与健康检查测试"""
+
+import logging
+import threading
+
+import pytest
+
+from balancer import HealthChecker, LoadBalancer, UpstreamTarget
+
+
+class _Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@pytest.fixture
+def checker():
+    """两个目标的轮询均衡器及其健康检查器（fall=3, rise=2），返回(检查器, 日志记录)"""
+    balancer = LoadBalancer([UpstreamTarget('10.0.0.1', 80), UpstreamTarget('10.0.0.2', 80)])
+    logger = logging.getLogger('test_balancer')
+    logger.setLevel(logging.INFO)
+    records = _Records()
+    logger.addHandler(records)
+    yield HealthChecker('r', balancer, interval=0, fall=3, rise=2, logger=logger), records
+    logger.removeHandler(records)
+
+
+def test_ejects_after_fall_failures(checker):
+    checker, records = checker
+    first, second = checker.balancer.targets
+
+    for _ in range(2):
+        checker.record(first, False)
+    assert first.healthy
+    checker.record(first, False)
+    assert not first.healthy
+
+    # 摘除后只选择健康的目标
+    assert {checker.balancer.select() for _ in range(4)} == {second}
+    assert len(records.messages) == 1
+
+
+def test_recovers_after_rise_successes(checker):
+    checker, records = checker
+    first, _ = checker.balancer.targets
+    for _ in range(3):
+        checker.record(first, False)
+
+    checker.record(first, True)
+    assert not first.healthy
+    # 中间的失败重新开始计数
+    checker.record(first, False)
+    checker.record(first, True)
+    assert not first.healthy
+    checker.record(first, True)
+    assert first.healthy
+    assert len(records.messages) == 2
+
+
+def test_concurrent_records_log_one_transition(checker):
+    checker, records = checker
+    first, _ = checker.balancer.targets
+
+    def fail():
+        for _ in range(1000):
+            checker.record(first, False)
+
+    threads = [threading.Thread(target=fail) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert first.consecutive_failures == 8000
+    assert not first.healthy
+    assert len(records.messages) == 1
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""上游域名解析缓存测试（模拟的解析函数和时钟）"""
+
+import socket
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import dns_cache
+from dns_cache import DnsCache
+
+ADDRESSES = [(socket.AF_INET, ('10.0.0.1', 80))]
+NEW_ADDRESSES = [(socket.AF_INET, ('10.0.0.2', 80))]
+
+
+class FakeResolver:
+    """按设定返回结果或抛出解析错误，记录调用次数"""
+
+    def __init__(self):
+        self.result = ADDRESSES
+        self.calls = 0
+        # 设置后解析阻塞到该事件置位
+        self.gate = None
+
+    def __call__(self, host, port, sock_type):
+        self.calls += 1
+        if self.gate:
+            self.gate.wait(5)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def _wait_refresh(cache: DnsCache):
+    """等待后台刷新完成"""
+    for future in list(cache._pending.values()):
+        try:
+            future.result(5)
+        except OSError:
+            pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(dns_cache, 'time', SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+@pytest.fixture
+def resolver():
+    return FakeResolver()
+
+
+@pytest.fixture
+def cache(resolver, clock):
+    cache = DnsCache(ttl=10, max_stale=100, negative_ttl=5, resolver=resolver)
+    yield cache
+    cache.stop()
+
+
+def test_hit_after_first_resolution(cache, resolver):
+    assert cache.resolve('upstream', 80) == ADDRESSES
+    assert cache.lookup('upstream', 80).result() == ADDRESSES
+    assert resolver.calls == 1
+
+    # IP地址不经过缓存
+    resolver.result = NEW_ADDRESSES
+    assert cache.resolve('10.0.0.2', 80) == NEW_ADDRESSES
+    stats = cache.get_stats()
+    assert (stats['entries'], stats['hits'], stats['misses'], stats['hit_rate']) == (1, 1, 1, 0.5)
+
+
+def test_stale_result_served_while_refresh_fails(cache, resolver, clock):
+    cache.resolve('upstream', 80)
+    resolver.result = socket.gaierror('temporary failure')
+    clock.value += 11
+
+    # 过期后立即返回旧结果，后台刷新失败时保留旧结果
+    future = cache.lookup('upstream', 80)
+    assert future.done() and future.result() == ADDRESSES
+    _wait_refresh(cache)
+    assert resolver.calls == 2
+    assert cache.resolve('upstream', 80) == ADDRESSES
+    stats = cache.get_stats()
+    assert (stats['stale_hits'], stats['failures']) == (2, 1)
+
+    # 刷新成功后使用新结果
+    resolver.result = NEW_ADDRESSES
+    clock.value += 5
+    cache.lookup('upstream', 80)
+    _wait_refresh(cache)
+    assert cache.resolve('upstream', 80) == NEW_ADDRESSES
+
+    # 超过最长过期使用时间后不再返回旧结果
+    resolver.result = socket.gaierror('still failing')
+    clock.value += 111
+    with pytest.raises(socket.gaierror):
+        cache.resolve('upstream', 80)
+
+
+def test_negative_result_is_cached(cache, resolver, clock):
+    resolver.result = socket.gaierror('no such host')
+    with pytest.raises(socket.gaierror):
+        cache.resolve('missing', 80)
+
+    # negative_ttl内直接返回失败，不再调用解析函数
+    future = cache.lookup('missing', 80)
+    assert future.done() and isinstance(future.exception(), socket.gaierror)
+    assert resolver.calls == 1 and cache.get_stats()['negative_hits'] == 1
+
+    resolver.result = ADDRESSES
+    clock.value += 5
+    assert cache.resolve('missing', 80) == ADDRESSES
+    assert resolver.calls == 2
+
+
+def test_concurrent_lookups_are_coalesced(cache, resolver):
+    resolver.gate = threading.Event()
+    first = cache.lookup('upstream', 80)
+    second = cache.lookup('upstream', 80)
+    assert second is first and not first.done()
+
+    resolver.gate.set()
+    assert first.result(5) == ADDRESSES
+    assert resolver.calls == 1
+    assert cache.get_stats()['coalesced'] == 1
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""规则重载与优雅停止的排空测试"""
+
+import socket
+import threading
+
+from port_forwarder import PortForwardRule
+
+
+def _echo(client: socket.socket, data: bytes) -> bytes:
+    client.sendall(data)
+    received = b''
+    while len(received) < len(data):
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        received += chunk
+    return received
+
+
+def _closed_by_peer(client: socket.socket) -> bool:
+    try:
+        return client.recv(1) == b''
+    except ConnectionResetError:
+        return True
+
+
+def test_reload_keeps_listener_and_drains_old_sessions(make_forwarder, echo_server, unused_port, wait_until):
+    forwarder = make_forwarder()
+    port = unused_port()
+    assert forwarder.add_rule(PortForwardRule('old', port, '127.0.0.1', echo_server))
+
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as old_client:
+        assert _echo(old_client, b'before') == b'before'
+        assert forwarder.reload_rule('old', PortForwardRule('new', port, '127.0.0.1', echo_server), drain_timeout=10)
+
+        draining = forwarder.get_drain_status('new')
+        assert [(item['name'], item['successor'], item['active_sessions']) for item in draining] == [('old', 'new', 1)]
+
+        # 监听不中断：新连接按新规则转发，旧会话继续工作
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as new_client:
+            assert _echo(new_client, b'fresh') == b'fresh'
+        assert _echo(old_client, b'after') == b'after'
+        assert forwarder.get_rule_status('new')['total_connections'] == 1
+
+    # 旧会话结束后不必等到排空时限
+    assert wait_until(lambda: forwarder.get_drain_status() == [])
+    assert 'old' not in forwarder.rules
+
+
+def test_drain_timeout_aborts_old_sessions(make_forwarder, echo_server, unused_port, wait_until):
+    forwarder = make_forwarder()
+    port = unused_port()
+    assert forwarder.add_rule(PortForwardRule('r', port, '127.0.0.1', echo_server))
+
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+        assert _echo(client, b'ping') == b'ping'
+        assert forwarder.reload_rule('r', PortForwardRule('r', port, '127.0.0.1', echo_server), drain_timeout=0.3)
+        assert forwarder.get_drain_status()[0]['remaining'] <= 0.3
+
+        # 超过排空时限后旧会话被强制关闭
+        assert _closed_by_peer(client)
+    assert wait_until(lambda: forwarder.get_drain_status() == [])
+
+
+def test_graceful_stop_waits_for_sessions(make_forwarder, echo_server, unused_port, wait_until):
+    forwarder = make_forwarder()
+    port = unused_port()
+    assert forwarder.add_rule(PortForwardRule('r', port, '127.0.0.1', echo_server))
+    rule = forwarder.rules['r']
+    client = socket.create_connection(('127.0.0.1', port), timeout=5)
+    assert _echo(client, b'ping') == b'ping'
+
+    result = []
+    stopper = threading.Thread(target=lambda: result.append(forwarder.stop_rule('r', graceful=True, drain_timeout=10)))
+    stopper.start()
+    try:
+        # 先停止接受新连接，已建立的会话不受影响
+        assert wait_until(lambda: rule.server_socket is None)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            refused = False
+        except OSError:
+            refused = True
+        assert refused
+        assert _echo(client, b'still here') == b'still here'
+        assert stopper.is_alive()
+    finally:
+        client.close()
+
+    stopper.join(5)
+    assert result == [True]
+    assert not rule.is_running and rule.active_sessions == 0
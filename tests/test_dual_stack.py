@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""双栈监听与happy eyeballs上游连接测试"""
+
+import socket
+import time
+
+import pytest
+
+import dual_stack
+from dual_stack import DUAL_STACK_ADDRESS, create_listener, format_address, interleave_addresses
+from port_forwarder import PortForwardRule
+
+
+def _ipv6_available() -> bool:
+    if not socket.has_ipv6:
+        return False
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as sock:
+            sock.bind(('::1', 0))
+        return True
+    except OSError:
+        return False
+
+
+requires_ipv6 = pytest.mark.skipif(not _ipv6_available(), reason='本机不支持IPv6')
+
+
+def test_format_and_interleave():
+    assert format_address('10.0.0.1', 80) == '10.0.0.1:80'
+    assert format_address('fd00::1', 80) == '[fd00::1]:80'
+
+    v6 = [(socket.AF_INET6, ('fd00::1', 80, 0, 0)), (socket.AF_INET6, ('fd00::2', 80, 0, 0))]
+    v4 = [(socket.AF_INET, ('10.0.0.1', 80)), (socket.AF_INET, ('10.0.0.2', 80))]
+    # 第一个地址族保持在最前，之后两个地址族交替
+    assert interleave_addresses(v6 + v4) == [v6[0], v4[0], v6[1], v4[1]]
+    assert interleave_addresses([v4[0]] + v6) == [v4[0], v6[0], v6[1]]
+    assert interleave_addresses([]) == []
+
+
+def test_connect_falls_back_to_next_address(echo_server, unused_port):
+    closed = unused_port()
+    addresses = [(socket.AF_INET, ('127.0.0.1', closed)), (socket.AF_INET, ('127.0.0.1', echo_server))]
+
+    started = time.monotonic()
+    sock = dual_stack.connect('upstream', 0, timeout=5, attempt_delay=2, resolver=lambda host, port: addresses)
+    with sock:
+        # 第一个地址被拒绝后立即尝试下一个，不必等待attempt_delay
+        assert time.monotonic() - started < 1
+        assert sock.getpeername()[1] == echo_server and sock.gettimeout() is None
+        sock.sendall(b'ping')
+        assert sock.recv(4) == b'ping'
+
+
+def test_connect_reports_last_error(unused_port):
+    addresses = [(socket.AF_INET, ('127.0.0.1', unused_port())), (socket.AF_INET, ('127.0.0.1', unused_port()))]
+    with pytest.raises(OSError):
+        dual_stack.connect('upstream', 0, timeout=5, resolver=lambda host, port: addresses)
+    # 只有一个地址时直接连接
+    with pytest.raises(OSError):
+        dual_stack.connect('upstream', 0, timeout=5, resolver=lambda host, port: addresses[:1])
+
+
+@requires_ipv6
+def test_dual_stack_listener_accepts_both_families():
+    with create_listener(DUAL_STACK_ADDRESS, 0) as listener:
+        assert listener.family == socket.AF_INET6
+        port = listener.getsockname()[1]
+        for host in ('127.0.0.1', '::1'):
+            with socket.create_connection((host, port), timeout=5):
+                conn, addr = listener.accept()
+                conn.close()
+                # IPv4客户端以映射地址出现
+                assert addr[0] in ('::ffff:127.0.0.1', '::1')
+
+
+@requires_ipv6
+def test_rule_listening_on_dual_stack(make_forwarder, echo_server, unused_port, wait_until):
+    forwarder = make_forwarder()
+    port = unused_port()
+    assert forwarder.add_rule(PortForwardRule('r', port, '127.0.0.1', echo_server, listen_address=DUAL_STACK_ADDRESS))
+
+    for host in ('127.0.0.1', '::1'):
+        with socket.create_connection((host, port), timeout=5) as client:
+            client.sendall(host.encode())
+            assert client.recv(64) == host.encode()
+    assert wait_until(lambda: forwarder.get_rule_status('r')['total_connections'] == 2)
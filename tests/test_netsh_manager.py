@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""NetshManager批处理（模拟的netsh命令执行器）和show all输出解析测试"""
+
+from netsh_manager import COMMAND_TIMEOUT_OUTPUT, NetshManager, parse_show_output
+from portproxy_backend import MemoryRegistry, table_key
+
+
+def test_apply_batch_success(fake_netsh):
+    fake_netsh.tables['v4tov4'][('*', 9000)] = ('10.0.0.1', 80)
+    manager = NetshManager(command_runner=fake_netsh)
+    with manager.batch() as batch:
+        first = batch.add(9001, '10.0.0.1', 81)
+        second = batch.add(9002, '10.0.0.2', 82, listen_address='192.168.1.10')
+        removed = batch.delete(9000)
+
+    assert first.success and second.success and removed.success
+    assert fake_netsh.tables['v4tov4'] == {('*', 9001): ('10.0.0.1', 81), ('192.168.1.10', 9002): ('10.0.0.2', 82)}
+    assert fake_netsh.script_calls() == 1
+
+
+def test_apply_batch_partial_failure(fake_netsh):
+    fake_netsh.fail_ports.add(9002)
+    manager = NetshManager(command_runner=fake_netsh)
+    batch = manager.batch()
+    ok = batch.add(9001, '10.0.0.1', 81)
+    failed = batch.add(9002, '10.0.0.1', 82)
+
+    assert manager.apply_batch(batch.operations) is False
+    assert ok.success and ok.message == ''
+    assert not failed.success and failed.message
+
+
+def test_apply_batch_verifies_deletes(fake_netsh):
+    fake_netsh.tables['v4tov4'][('192.168.1.10', 9000)] = ('10.0.0.1', 80)
+    fake_netsh.tables['v4tov4'][('*', 9001)] = ('10.0.0.1', 81)
+    fake_netsh.fail_ports.add(9001)
+    manager = NetshManager(command_runner=fake_netsh)
+    with manager.batch() as batch:
+        # 规则在指定地址上，删除通配地址不应报告成功
+        wrong_address = batch.delete(9000)
+        missing = batch.delete(9100)
+        refused = batch.delete(9001)
+        added_then_deleted = [batch.add(9200, '10.0.0.1', 82), batch.delete(9200)]
+
+    assert not wrong_address.success and wrong_address.message == '规则不存在'
+    assert not missing.success and missing.message == '规则不存在'
+    assert not refused.success
+    assert all(operation.success for operation in added_then_deleted)
+    assert ('192.168.1.10', 9000) in fake_netsh.tables['v4tov4']
+
+
+def test_apply_batch_is_table_aware(fake_netsh):
+    fake_netsh.tables['v4tov4'][('*', 9000)] = ('10.0.0.1', 80)
+    fake_netsh.tables['v4tov6'][('*', 9000)] = ('fd00::1', 80)
+    manager = NetshManager(command_runner=fake_netsh)
+    with manager.batch() as batch:
+        operation = batch.delete(9000, table='v4tov6')
+
+    assert operation.success
+    assert fake_netsh.tables['v4tov4'] == {('*', 9000): ('10.0.0.1', 80)}
+    assert fake_netsh.tables['v4tov6'] == {}
+
+
+def test_registry_batch_reports_missing_rule():
+    registry = MemoryRegistry()
+    manager = NetshManager(backend='registry', registry=registry)
+    manager.add_portproxy_rule(9000, '10.0.0.1', 80, listen_address='192.168.1.10')
+    with manager.batch() as batch:
+        wrong_address = batch.delete(9000)
+        removed = batch.delete(9000, listen_address='192.168.1.10')
+
+    assert not wrong_address.success and wrong_address.message == '规则不存在'
+    assert removed.success
+    assert registry.read_values(table_key()) == {}
+
+
+def test_parallel_batch_verifies_each_operation(fake_netsh):
+    for port in range(9000, 9010):
+        fake_netsh.tables['v4tov4'][('192.168.1.10', port)] = ('10.0.0.1', port)
+    manager = NetshManager(command_runner=fake_netsh, parallelism=4, chunk_size=3)
+    with manager.batch() as batch:
+        specific = [batch.delete(port, listen_address='192.168.1.10') for port in range(9000, 9005)]
+        wildcard = [batch.delete(port) for port in range(9005, 9010)]
+    manager.close()
+
+    assert fake_netsh.script_calls() == 4
+    assert all(operation.success for operation in specific)
+    assert all(not operation.success and operation.message == '规则不存在' for operation in wildcard)
+    assert sorted(port for _, port in fake_netsh.tables['v4tov4']) == list(range(9005, 9010))
+
+
+def test_script_timeout_reported_per_operation(fake_netsh):
+    manager = NetshManager(command_runner=fake_netsh, chunk_size=2, parallelism=1)
+    runner = fake_netsh.__call__
+
+    def timing_out(command: str):
+        if command.startswith('netsh -f ') and not fake_netsh.tables['v4tov4']:
+            # 第一个脚本只执行了第一行就超时
+            with open(command[len('netsh -f "'):-1], encoding='utf-8') as f:
+                fake_netsh.execute(f.readline())
+            return False, COMMAND_TIMEOUT_OUTPUT
+        return runner(command)
+
+    manager.command_runner = timing_out
+    with manager.batch() as batch:
+        first, second, third = (batch.add(port, '10.0.0.1', 80) for port in (9001, 9002, 9003))
+
+    assert first.success and first.message == ''
+    assert not second.success and '超时' in second.message and '2个操作' in second.message
+    assert third.success
+    assert manager._script_timeout(50) > manager._script_timeout(1)
+
+
+ENGLISH_SHOW_OUTPUT = '''
+Listen on ipv4:             Connect to ipv4:
+
+Address         Port        Address         Port
+--------------- ----------  --------------- ----------
+*               8080        192.168.1.20    80
+192.168.1.10    8443        backend.local   443
+
+Listen on ipv4:             Connect to ipv6:
+
+Address         Port        Address         Port
+--------------- ----------  --------------- ----------
+*               9000        fd00::10        9000
+
+Listen on ipv6:             Connect to ipv4:
+
+Address         Port        Address         Port
+--------------- ----------  --------------- ----------
+*               9001        10.0.0.1        9001
+fe80::1%12      9002        10.0.0.2        99999
+'''
+
+CHINESE_SHOW_OUTPUT = '''
+侦听 ipv4:                 连接到 ipv4:
+
+地址            端口        地址            端口
+--------------- ----------  --------------- ----------
+*               3389        10.0.0.5        3389
+
+侦听 ipv6：                 连接到 ipv6：
+
+地址            端口        地址            端口
+--------------- ----------  --------------- ----------
+::1             5000        fd00::20        5000
+'''
+
+
+def _parsed(output: str):
+    return [(rule.table, rule.listen_address, rule.listen_port, rule.connect_address, rule.connect_port)
+            for rule in parse_show_output(output)]
+
+
+def test_parse_show_output_tables():
+    assert _parsed(ENGLISH_SHOW_OUTPUT) == [
+        ('v4tov4', '0.0.0.0', 8080, '192.168.1.20', 80),
+        ('v4tov4', '192.168.1.10', 8443, 'backend.local', 443),
+        ('v4tov6', '0.0.0.0', 9000, 'fd00::10', 9000),
+        # 超出范围的端口忽略
+        ('v6tov4', '::', 9001, '10.0.0.1', 9001),
+    ]
+
+
+def test_parse_show_output_chinese_and_crlf():
+    assert _parsed(CHINESE_SHOW_OUTPUT.replace('\n', '\r\n')) == [
+        ('v4tov4', '0.0.0.0', 3389, '10.0.0.5', 3389),
+        ('v6tov6', '::1', 5000, 'fd00::20', 5000),
+    ]
+
+
+def test_parse_show_output_ignores_rows_before_header():
+    assert _parsed('1.2.3.4 80 5.6.7.8 80\n') == []
+    assert _parsed('') == []
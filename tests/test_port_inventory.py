@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""端口占用表测试"""
+
+import socket
+import struct
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import port_inventory
+from port_inventory import PortInventory, _parse_tcp_table, _read_proc_listeners, default_listener_reader
+
+PROC_TCP = '''  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 0100007F:1F90 00000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 916 1 0 100 0 0 10 0
+   1: 00000000:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 662 1 0 100 0 0 10 0
+   2: 0100007F:1F90 0100007F:D431 01 00000000:00000000 00:00000000 00000000  1000        0 917 1 0 20 4 30 10 -1
+'''
+
+PROC_TCP6 = '''  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000000000000:01BB 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 700 1 0 100 0 0 10 0
+'''
+
+
+def test_read_proc_listeners(tmp_path, monkeypatch):
+    tcp, tcp6 = tmp_path / 'tcp', tmp_path / 'tcp6'
+    tcp.write_text(PROC_TCP)
+    tcp6.write_text(PROC_TCP6)
+    monkeypatch.setattr(port_inventory, '_PROC_TCP_FILES', (str(tcp), str(tcp6)))
+    # 只统计LISTEN状态的端口，已建立的连接不算
+    assert _read_proc_listeners() == {8080, 22, 443}
+
+    # 没有tcp6时只读取tcp
+    monkeypatch.setattr(port_inventory, '_PROC_TCP_FILES', (str(tcp), str(tmp_path / 'missing')))
+    assert _read_proc_listeners() == {8080, 22}
+
+
+@pytest.mark.parametrize('row_size, port_offset', [(24, 8), (56, 20)])
+def test_parse_tcp_table(row_size, port_offset):
+    rows = b''
+    for port in (3389, 8080):
+        row = bytearray(row_size)
+        # dwLocalPort为网络字节序
+        row[port_offset:port_offset + 2] = struct.pack('!H', port)
+        rows += bytes(row)
+    data = (2).to_bytes(4, sys.byteorder) + rows
+    assert _parse_tcp_table(data, row_size, port_offset) == {3389, 8080}
+    assert _parse_tcp_table((0).to_bytes(4, sys.byteorder), row_size, port_offset) == set()
+
+
+def test_next_free_and_conflicts():
+    listening = {1024, 1025, 1027}
+    inventory = PortInventory(reader=lambda: set(listening), ttl=0)
+    inventory.reserve(1026, 'mine')
+
+    assert inventory.next_free(3) == [1028, 1029, 1030]
+    assert inventory.next_free(2, exclude=[1028]) == [1029, 1030]
+    assert inventory.next_free(5, start=1024, end=1028) == [1028]
+    assert not inventory.is_free(1026) and not inventory.is_free(1025) and inventory.is_free(1028)
+
+    rules = [SimpleNamespace(name='a', local_port=1028), SimpleNamespace(name='b', local_port=1028),
+             SimpleNamespace(name='c', local_port=1027), SimpleNamespace(name='d', local_port=1024)]
+    assert inventory.conflicts(rules, owned_ports=[1024]) == [
+        {'port': 1027, 'rules': ['c'], 'reason': 'in_use'},
+        {'port': 1028, 'rules': ['a', 'b'], 'reason': 'duplicate'},
+    ]
+
+
+@pytest.mark.skipif(default_listener_reader() is None, reason='无法读取系统监听表')
+def test_sees_real_listener():
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        inventory = PortInventory()
+        assert inventory.is_listening(port)
+        assert port not in inventory.next_free(10, start=port, end=port)
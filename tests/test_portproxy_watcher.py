@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""PortproxyWatcher测试（内存注册表）"""
+
+import queue
+import time
+
+import pytest
+
+from netsh_manager import NetshManager
+from portproxy_backend import MemoryRegistry, table_key
+from portproxy_watcher import CHANGE_ADDED, CHANGE_MODIFIED, CHANGE_REMOVED, PortproxyWatcher
+
+
+@pytest.fixture
+def registry():
+    return MemoryRegistry()
+
+
+@pytest.fixture
+def watched(registry):
+    """启动监视器，返回(NetshManager, 变化队列)"""
+    manager = NetshManager(backend='registry', registry=registry)
+    watcher = PortproxyWatcher(manager, interval=0.05)
+    events = queue.Queue()
+    watcher.subscribe(lambda changes: [events.put(change) for change in changes])
+    watcher.start()
+    yield manager, events
+    watcher.stop()
+
+
+def _next(events: queue.Queue):
+    return events.get(timeout=2)
+
+
+def test_publishes_external_changes(registry, watched):
+    _, events = watched
+    path = table_key()
+
+    registry.set_value(path, '*/9090', '10.0.0.1/80')
+    change = _next(events)
+    assert (change.kind, change.rule.listen_port, change.rule.connect_port) == (CHANGE_ADDED, 9090, 80)
+
+    registry.set_value(path, '*/9090', '10.0.0.1/81')
+    change = _next(events)
+    assert (change.kind, change.previous.connect_port, change.rule.connect_port) == (CHANGE_MODIFIED, 80, 81)
+
+    registry.delete_value(path, '*/9090')
+    change = _next(events)
+    assert (change.kind, change.rule.listen_port) == (CHANGE_REMOVED, 9090)
+
+
+def test_suppresses_own_writes(registry, watched):
+    manager, events = watched
+    path = table_key()
+
+    def settle():
+        # 留出时间让监视器看到每次写入后的规则表
+        time.sleep(0.2)
+
+    assert manager.add_portproxy_rule(9090, '10.0.0.1', 80)
+    settle()
+    assert manager.add_portproxy_rule(9090, '10.0.0.1', 81)
+    settle()
+    with manager.batch() as batch:
+        batch.add(9091, '10.0.0.2', 80)
+    settle()
+    assert manager.delete_portproxy_rule(9090)
+    settle()
+    assert events.empty()
+
+    # 随后的外部修改仍然推送
+    registry.delete_value(path, '*/9091')
+    change = _next(events)
+    assert (change.kind, change.rule.listen_port) == (CHANGE_REMOVED, 9091)
+    assert events.empty()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""RuleRateLimiter及中继限速测试"""
+
+import socket
+import time
+
+import rate_limit
+from port_forwarder import PortForwarder, PortForwardRule
+from rate_limit import RuleRateLimiter
+
+
+def test_client_buckets_are_bounded(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'MAX_CLIENT_BUCKETS', 10)
+    limiter = RuleRateLimiter(client_connection_rate=1)
+    for index in range(50):
+        # 每个客户端的桶都刚被使用，没有空闲的桶可以淘汰
+        assert limiter.allow_connection(f'10.0.0.{index}')
+        assert limiter.get_stats()['tracked_clients'] <= 10
+
+    # 最近使用的客户端仍受限，最久未使用的客户端的桶已被淘汰
+    assert not limiter.allow_connection('10.0.0.49')
+    assert limiter.allow_connection('10.0.0.0')
+
+
+def test_throttled_upload_does_not_delay_download():
+    upstream = socket.socket()
+    upstream.bind(('127.0.0.1', 0))
+    upstream.listen(1)
+    upstream.settimeout(5)
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        local_port = probe.getsockname()[1]
+    forwarder = PortForwarder()
+    forwarder.logger.setLevel('WARNING')
+    # 上传20KB后带宽欠额约19秒
+    assert forwarder.add_rule(PortForwardRule('r', local_port, '127.0.0.1', upstream.getsockname()[1],
+                                              bandwidth_limit=1000))
+    try:
+        with socket.create_connection(('127.0.0.1', local_port), timeout=5) as client:
+            client.sendall(b'x' * 20000)
+            peer, _ = upstream.accept()
+            with peer:
+                assert peer.recv(65536)
+                time.sleep(0.2)
+
+                start = time.monotonic()
+                peer.sendall(b'pong')
+                client.settimeout(2)
+                assert client.recv(4) == b'pong'
+                assert time.monotonic() - start < 1
+    finally:
+        forwarder.stop_all()
+        upstream.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""规则对齐测试（模拟的netsh命令执行器）"""
+
+import pytest
+
+from netsh_manager import NetshManager
+from port_forwarder import PortForwardRule
+from reconciler import ACTION_ADD, ACTION_DELETE, ACTION_MODIFY, Reconciler
+from udp_forwarder import PROTOCOL_UDP
+
+
+@pytest.fixture
+def reconciler(fake_netsh):
+    fake_netsh.tables['v4tov4'].update({
+        ('*', 8080): ('10.0.0.1', 80),
+        ('*', 8081): ('10.0.0.1', 80),
+        ('*', 8082): ('10.0.0.1', 82),
+    })
+    # 其他表中的规则不属于本工具
+    fake_netsh.tables['v4tov6'][('*', 8084)] = ('fd00::1', 84)
+    return Reconciler(NetshManager(command_runner=fake_netsh))
+
+
+DESIRED = [
+    PortForwardRule('same', 8080, '10.0.0.1', 80),
+    PortForwardRule('moved', 8081, '10.0.0.1', 81),
+    PortForwardRule('new', 8083, '10.0.0.1', 83),
+    PortForwardRule('off', 8085, '10.0.0.1', 85, enabled=False),
+    PortForwardRule('udp', 8086, '10.0.0.1', 86, protocol=PROTOCOL_UDP),
+]
+
+
+def test_plan_lists_only_differences(reconciler):
+    plan = reconciler.plan(DESIRED)
+    assert plan.summary() == {ACTION_ADD: 1, ACTION_DELETE: 0, ACTION_MODIFY: 1, 'unchanged': 2}
+    assert [(change.action, change.listen_port) for change in plan.changes] == [(ACTION_MODIFY, 8081), (ACTION_ADD, 8083)]
+    assert plan.changes[0].current.connect_port == 80
+
+    pruned = reconciler.plan(DESIRED, prune=True)
+    assert pruned.summary() == {ACTION_ADD: 1, ACTION_DELETE: 1, ACTION_MODIFY: 1, 'unchanged': 1}
+    assert pruned.by_action(ACTION_DELETE)[0].listen_port == 8082
+
+
+def test_apply_runs_one_batch(reconciler, fake_netsh):
+    plan = reconciler.reconcile(DESIRED, prune=True)
+
+    assert all(change.success for change in plan.changes)
+    assert fake_netsh.script_calls() == 1
+    assert fake_netsh.tables['v4tov4'] == {
+        ('*', 8080): ('10.0.0.1', 80),
+        ('*', 8081): ('10.0.0.1', 81),
+        ('*', 8083): ('10.0.0.1', 83),
+    }
+    assert fake_netsh.tables['v4tov6'] == {('*', 8084): ('fd00::1', 84)}
+
+    # 再次对齐时没有差异，不再调用netsh脚本
+    assert reconciler.reconcile(DESIRED, prune=True).empty
+    assert fake_netsh.script_calls() == 1
+
+
+def test_dry_run_does_not_modify(reconciler, fake_netsh):
+    before = dict(fake_netsh.tables['v4tov4'])
+    plan = reconciler.reconcile(DESIRED, prune=True, dry_run=True)
+
+    assert not plan.empty and not any(change.success for change in plan.changes)
+    assert fake_netsh.script_calls() == 0
+    assert fake_netsh.tables['v4tov4'] == before
+    assert plan.format().splitlines()[-1] == '新增 1，删除 1，修改 1，不变 1'
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""中继通道测试（splice和缓冲区后端）"""
+
+import hashlib
+import socket
+
+import pytest
+
+from port_forwarder import PortForwardRule
+from relay import (RELAY_AUTO, RELAY_BUFFER, RELAY_SPLICE, create_relay_channel, resolve_relay_backend,
+                   splice_supported)
+
+BACKENDS = [RELAY_BUFFER, pytest.param(RELAY_SPLICE, marks=pytest.mark.skipif(
+    not splice_supported(), reason='当前平台不支持splice'))]
+
+
+@pytest.fixture
+def pairs():
+    """两对非阻塞的本地连接: (源写端, 源读端), (目标写端, 目标读端)"""
+    created = [socket.socketpair(), socket.socketpair()]
+    for pair in created:
+        for sock in pair:
+            sock.setblocking(False)
+    yield created
+    for pair in created:
+        for sock in pair:
+            sock.close()
+
+
+def test_resolve_relay_backend():
+    assert resolve_relay_backend(RELAY_AUTO) == (RELAY_SPLICE if splice_supported() else RELAY_BUFFER)
+    assert resolve_relay_backend(RELAY_BUFFER) == RELAY_BUFFER
+    with pytest.raises(ValueError):
+        resolve_relay_backend('sendfile')
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_channel_keeps_data_until_destination_drains(backend, pairs):
+    (writer, source), (destination, reader) = pairs
+    destination.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    # 先占满目标的发送缓冲区
+    try:
+        while True:
+            destination.send(b'f' * 4096)
+    except BlockingIOError:
+        pass
+    channel = create_relay_channel(backend, chunk_size=8192)
+    assert channel.name == backend
+
+    writer.sendall(b'a' * 8192)
+    assert channel.receive(source) == 8192
+    assert not channel.send(destination)
+    assert channel.pending
+
+    # 目标读走数据后，通道中剩余的数据全部送出，内容不丢失也不重复
+    received = bytearray()
+    while channel.pending:
+        try:
+            received += reader.recv(65536)
+        except BlockingIOError:
+            pass
+        channel.send(destination)
+    reader.setblocking(True)
+    reader.settimeout(1)
+    while received.count(b'a') < 8192:
+        received += reader.recv(65536)
+    assert received.count(b'a') == 8192 and received.endswith(b'a' * 8192)
+
+    # 源端关闭时receive返回0
+    writer.close()
+    assert channel.receive(source) == 0
+    channel.close()
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_threaded_relay_preserves_stream(backend, make_forwarder, echo_server, unused_port):
+    forwarder = make_forwarder(relay=backend)
+    assert forwarder.relay_backend == backend
+    port = unused_port()
+    assert forwarder.add_rule(PortForwardRule('r', port, '127.0.0.1', echo_server))
+
+    payload = bytes(range(256)) * 1024
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+        client.sendall(payload)
+        client.shutdown(socket.SHUT_WR)
+        digest = hashlib.sha256()
+        total = 0
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            digest.update(data)
+            total += len(data)
+
+    assert total == len(payload)
+    assert digest.digest() == hashlib.sha256(payload).digest()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""RuleManager测试（模拟的netsh命令执行器和内存注册表）"""
+
+import pytest
+
+from portproxy_backend import MemoryRegistry, table_key
+from rule_manager import RuleManager
+
+
+@pytest.fixture
+def make_manager(tmp_path, fake_netsh):
+    managers = []
+
+    def make(**kwargs):
+        manager = RuleManager(metadata_file=str(tmp_path / 'rules_meta.db'), command_runner=fake_netsh, **kwargs)
+        managers.append(manager)
+        return manager
+
+    yield make
+    for manager in managers:
+        manager.cleanup()
+
+
+@pytest.mark.parametrize('chunk_size', [50, 1])
+def test_batch_delete_uses_listen_address(make_manager, fake_netsh, chunk_size):
+    fake_netsh.tables['v4tov4'][('192.168.1.10', 9100)] = ('10.0.0.1', 80)
+    fake_netsh.tables['v4tov4'][('*', 9101)] = ('10.0.0.1', 81)
+    manager = make_manager(batch_parallelism=2)
+    # chunk_size为1时每个操作一个脚本，走并行执行的路径
+    manager.netsh_manager.chunk_size = chunk_size
+
+    results = manager.batch_delete(['Rule_9100', 'Rule_9101'])
+
+    assert results == {'Rule_9100': True, 'Rule_9101': True}
+    assert fake_netsh.tables['v4tov4'] == {}
+
+
+def test_batch_delete_reports_failed_delete(make_manager, fake_netsh):
+    fake_netsh.tables['v4tov4'][('192.168.1.10', 9100)] = ('10.0.0.1', 80)
+    fake_netsh.fail_ports.add(9100)
+    manager = make_manager()
+
+    results = manager.batch_delete(['Rule_9100'])
+
+    assert results == {'Rule_9100': False}
+    assert 'Rule_9100' in results.errors
+    assert manager.get_rule('Rule_9100') is not None
+
+
+@pytest.fixture
+def registry_manager(tmp_path):
+    registry = MemoryRegistry()
+    manager = RuleManager(metadata_file=str(tmp_path / 'rules_meta.db'), backend='registry', registry=registry)
+    yield manager, registry
+    manager.cleanup()
+
+
+def test_registry_backend_add_and_remove(registry_manager):
+    manager, registry = registry_manager
+    assert manager.netsh_manager.backend_name == 'registry'
+
+    assert manager.add_rule('web', 9100, '10.0.0.1', 80)
+    assert registry.read_values(table_key()) == {'*/9100': '10.0.0.1/80'}
+    assert [rule.name for rule in manager.get_all_rules()] == ['web']
+
+    assert manager.remove_rule('web')
+    assert registry.read_values(table_key()) == {}
+    assert manager.get_rule('web') is None
+
+
+def test_registry_backend_batch_operations(registry_manager):
+    manager, registry = registry_manager
+    registry.set_value(table_key(), '192.168.1.10/9100', '10.0.0.1/80')
+    manager.load_rules_from_netsh()
+    assert manager.add_rule('api', 9101, '10.0.0.2', 81)
+
+    assert manager.batch_disable(['Rule_9100', 'api']) == {'Rule_9100': True, 'api': True}
+    assert registry.read_values(table_key()) == {}
+
+    assert manager.batch_enable(['api']) == {'api': True}
+    assert registry.read_values(table_key()) == {'*/9101': '10.0.0.2/81'}
+
+
+def test_rules_in_other_tables_are_not_managed(make_manager, fake_netsh):
+    fake_netsh.tables['v4tov6'][('*', 9200)] = ('fd00::1', 80)
+    fake_netsh.tables['v4tov4'][('*', 9201)] = ('10.0.0.1', 81)
+    fake_netsh.tables['v4tov6'][('*', 9201)] = ('fd00::1', 81)
+    manager = make_manager()
+
+    # 只登记v4tov4表中的规则
+    assert [record.name for record in manager.store.get_all()] == ['Rule_9201']
+    assert manager.get_rule('Rule_9200') is None
+
+    assert manager.disable_rule('Rule_9201')
+    assert manager.batch_delete(['Rule_9200']) == {'Rule_9200': True}
+    assert fake_netsh.tables['v4tov4'] == {}
+    assert fake_netsh.tables['v4tov6'] == {('*', 9200): ('fd00::1', 80), ('*', 9201): ('fd00::1', 81)}
+
+    assert manager.enable_rule('Rule_9201')
+    assert fake_netsh.tables['v4tov4'] == {('*', 9201): ('10.0.0.1', 81)}
+
+
+def test_batch_enable_releases_port(make_manager, fake_netsh):
+    manager = make_manager()
+    assert manager.add_rule('a', 9200, '10.0.0.1', 80)
+    assert manager.add_rule('b', 9200, '10.0.0.2', 81, enabled=False)
+
+    assert manager.batch_enable(['b']) == {'b': True}
+    assert fake_netsh.tables['v4tov4'] == {('*', 9200): ('10.0.0.2', 81)}
+    assert [record.name for record in manager.store.get_all() if record.enabled] == ['b']
+
+    # 停用已被覆盖的规则不影响当前生效的规则
+    assert manager.disable_rule('a')
+    assert fake_netsh.tables['v4tov4'] == {('*', 9200): ('10.0.0.2', 81)}
+
+
+def test_batch_enable_same_port_keeps_last(make_manager, fake_netsh):
+    manager = make_manager()
+    assert manager.add_rule('a', 9200, '10.0.0.1', 80, enabled=False)
+    assert manager.add_rule('b', 9200, '10.0.0.2', 81, enabled=False)
+
+    assert manager.batch_enable(['a', 'b']) == {'a': True, 'b': True}
+    assert fake_netsh.tables['v4tov4'] == {('*', 9200): ('10.0.0.2', 81)}
+    assert [record.name for record in manager.store.get_all() if record.enabled] == ['b']
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""规则元数据存储测试"""
+
+import pytest
+
+from port_forwarder import PortForwardRule
+from rule_store import RuleMetadataStore
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'rules.db')
+
+
+@pytest.fixture
+def store(store_path):
+    store = RuleMetadataStore(store_path)
+    yield store
+    store.close()
+
+
+def _rule(name: str, port: int, enabled: bool = True, target_port: int = 80) -> PortForwardRule:
+    return PortForwardRule(name, port, '10.0.0.1', target_port, enabled)
+
+
+def test_indexes_follow_updates(store):
+    store.upsert(_rule('web', 8080), tags=['prod', 'http'])
+    store.upsert(_rule('web-old', 8080, enabled=False))
+    store.upsert(_rule('db', 5432), tags=['prod'])
+
+    assert [record.name for record in store.find_by_port(8080)] == ['web', 'web-old']
+    assert store.find_enabled_by_port(8080).name == 'web'
+    assert [record.name for record in store.find_by_tag('prod')] == ['db', 'web']
+
+    # 修改端口和标签后旧索引项被移除；tags为None时保留原有标签
+    store.upsert(_rule('web', 8081))
+    assert store.get('web').tags == ['http', 'prod']
+    assert [record.name for record in store.find_by_port(8080)] == ['web-old']
+    assert store.find_enabled_by_port(8080) is None
+    assert store.set_tags('db', ['staging'])
+    assert [record.name for record in store.find_by_tag('prod')] == ['web']
+
+    assert store.delete(['web', 'missing']) == ['web']
+    assert store.find_by_port(8081) == [] and store.find_by_tag('http') == []
+
+
+def test_persists_across_reopen(store, store_path):
+    store.upsert(_rule('web', 8080), tags=['prod'])
+    created_at = store.get('web').created_at
+    store.upsert_many([_rule('a', 9001), _rule('b', 9002)])
+    assert store.set_enabled(['a', 'missing'], False) == ['a']
+    store.delete(['b'])
+    store.close()
+
+    reopened = RuleMetadataStore(store_path)
+    try:
+        assert sorted(record.name for record in reopened.get_all()) == ['a', 'web']
+        assert reopened.get('web').tags == ['prod'] and reopened.get('web').created_at == created_at
+        assert not reopened.get('a').enabled
+        assert reopened.find_by_port(8080)[0].rule.target_host == '10.0.0.1'
+    finally:
+        reopened.close()
+
+
+def test_reconcile_with_live_rules(store):
+    store.upsert(_rule('kept', 8080))
+    store.upsert(_rule('moved', 8081, target_port=80))
+    store.upsert(_rule('gone', 8082))
+    store.upsert(_rule('disabled', 8083, enabled=False))
+
+    result = store.reconcile([_rule('Rule_8080', 8080), _rule('Rule_8081', 8081, target_port=81),
+                              _rule('Rule_9000', 9000)])
+
+    assert result == {'adopted': 1, 'updated': 1, 'disabled': 1}
+    # 表中新增的规则按默认名称登记，外部修改的目标同步到原记录
+    assert store.get('Rule_9000').enabled
+    assert store.get('moved').rule.target_port == 81
+    assert not store.get('gone').enabled
+    assert store.get('Rule_8080') is None and store.get('kept').enabled
+    assert not store.get('disabled').enabled
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""UDP转发引擎测试：按客户端地址的会话、容量淘汰和空闲超时"""
+
+import socket
+import threading
+
+import pytest
+
+import udp_forwarder
+from port_forwarder import PortForwardRule
+from udp_forwarder import PROTOCOL_UDP
+
+
+@pytest.fixture
+def udp_echo_server():
+    """本地UDP回显服务，返回其端口"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+
+    def serve():
+        while True:
+            try:
+                data, addr = server.recvfrom(65535)
+                server.sendto(data, addr)
+            except OSError:
+                return
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield server.getsockname()[1]
+    server.close()
+
+
+@pytest.fixture
+def udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def clients():
+    """返回一个函数，每次调用得到一个新的UDP客户端套接字（不同的源端口）"""
+    created = []
+
+    def make() -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        created.append(sock)
+        return sock
+
+    yield make
+    for sock in created:
+        sock.close()
+
+
+def _echo(client: socket.socket, port: int, data: bytes) -> bytes:
+    client.sendto(data, ('127.0.0.1', port))
+    return client.recvfrom(65535)[0]
+
+
+def _address(sock: socket.socket) -> str:
+    return f'127.0.0.1:{sock.getsockname()[1]}'
+
+
+def _session_clients(forwarder, rule_name: str) -> list:
+    return [session['client'] for session in forwarder.get_udp_sessions(rule_name)]
+
+
+def test_session_per_client_address(make_forwarder, udp_echo_server, udp_port, clients, wait_until):
+    forwarder = make_forwarder()
+    assert forwarder.add_rule(PortForwardRule('r', udp_port, '127.0.0.1', udp_echo_server, protocol=PROTOCOL_UDP))
+    first, second = clients(), clients()
+
+    assert _echo(first, udp_port, b'a1') == b'a1'
+    assert _echo(second, udp_port, b'b1') == b'b1'
+    assert _echo(first, udp_port, b'a2!') == b'a2!'
+
+    # 客户端收到回包时I/O线程可能还没更新计数
+    assert wait_until(lambda: forwarder.get_rule_status('r')['bytes_out'] == 7)
+    # 同一客户端地址复用会话，最近活动的会话排在前面
+    sessions = forwarder.get_udp_sessions('r')
+    assert [session['client'] for session in sessions] == [_address(first), _address(second)]
+    assert (sessions[0]['packets_in'], sessions[0]['packets_out'], sessions[0]['bytes_in']) == (2, 2, 5)
+    status = forwarder.get_rule_status('r')
+    assert status['protocol'] == PROTOCOL_UDP and status['udp_sessions']['sessions'] == 2
+    assert status['bytes_in'] == status['bytes_out'] == 7
+
+    # 停止规则时关闭所有会话
+    assert forwarder.stop_rule('r')
+    assert forwarder.udp_engine.get_session_count('r') == 0
+
+
+def test_full_table_evicts_least_recently_active(make_forwarder, udp_echo_server, udp_port, clients):
+    forwarder = make_forwarder()
+    assert forwarder.add_rule(PortForwardRule('r', udp_port, '127.0.0.1', udp_echo_server, max_connections=2,
+                                              protocol=PROTOCOL_UDP))
+    first, second, third = clients(), clients(), clients()
+
+    assert _echo(first, udp_port, b'1') == b'1'
+    assert _echo(second, udp_port, b'2') == b'2'
+    # first再次活动后，最久未活动的是second
+    assert _echo(first, udp_port, b'1') == b'1'
+    assert _echo(third, udp_port, b'3') == b'3'
+
+    assert _session_clients(forwarder, 'r') == [_address(third), _address(first)]
+    stats = forwarder.get_rule_status('r')['udp_sessions']
+    assert (stats['sessions'], stats['evicted_full'], stats['evicted_idle']) == (2, 1, 0)
+
+    # 被淘汰的客户端再次发送时重新建立会话
+    assert _echo(second, udp_port, b'2') == b'2'
+    assert _session_clients(forwarder, 'r') == [_address(second), _address(third)]
+
+
+def test_idle_sessions_are_evicted(make_forwarder, udp_echo_server, udp_port, clients, wait_until, monkeypatch):
+    monkeypatch.setattr(udp_forwarder, 'SWEEP_INTERVAL', 0.05)
+    forwarder = make_forwarder()
+    assert forwarder.add_rule(PortForwardRule('r', udp_port, '127.0.0.1', udp_echo_server, idle_timeout=0.2,
+                                              protocol=PROTOCOL_UDP))
+    client = clients()
+    assert _echo(client, udp_port, b'ping') == b'ping'
+    assert forwarder.udp_engine.get_session_count('r') == 1
+
+    assert wait_until(lambda: forwarder.udp_engine.get_session_count('r') == 0)
+    assert forwarder.get_rule_status('r')['udp_sessions']['evicted_idle'] == 1
+    assert _echo(client, udp_port, b'again') == b'again'
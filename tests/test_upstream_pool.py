@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""上游连接预热池测试"""
+
+import os
+import socket
+import time
+
+import pytest
+
+from upstream_pool import UpstreamPool, is_socket_healthy
+
+
+@pytest.fixture
+def upstream():
+    """本地监听端口，返回(监听套接字, 已接受的连接列表)"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(16)
+    accepted = []
+    yield server, accepted
+    for sock in accepted:
+        sock.close()
+    server.close()
+
+
+def _wait_idle(pool: UpstreamPool, count: int):
+    deadline = time.monotonic() + 5
+    while pool.get_stats()['idle'] < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pool.get_stats()['idle'] == count
+
+
+def test_detects_closed_upstream(upstream):
+    server, accepted = upstream
+    sock = socket.create_connection(server.getsockname())
+    peer, _ = server.accept()
+    accepted.append(peer)
+    assert is_socket_healthy(sock)
+
+    peer.close()
+    time.sleep(0.05)
+    assert not is_socket_healthy(sock)
+    sock.close()
+
+
+def test_reuses_sockets_above_fd_setsize(upstream):
+    resource = pytest.importorskip('resource')
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 1200:
+        pytest.skip('文件描述符上限不足')
+    server, _ = upstream
+    # 占满前1024个描述符，预建连接的fd超过select的FD_SETSIZE
+    fillers = [os.open(os.devnull, os.O_RDONLY) for _ in range(1100)]
+    pool = UpstreamPool(*server.getsockname(), size=2)
+    try:
+        pool.start()
+        _wait_idle(pool, 2)
+
+        sock = pool.acquire()
+        assert sock is not None and sock.fileno() >= 1024
+        assert (pool.hits, pool.discarded) == (1, 0)
+        sock.close()
+    finally:
+        pool.stop()
+        for fd in fillers:
+            os.close(fd)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""多进程模式下的指标汇总测试"""
+
+import socket
+import time
+
+import pytest
+
+from metrics import MetricsRegistry
+from port_forwarder import PortForwarder, PortForwardRule
+from worker_pool import merge_reports, reuse_port_supported
+
+
+def _report(connections: int, rejected: int) -> dict:
+    metrics = MetricsRegistry()
+    rule = metrics.get('web')
+    for _ in range(connections):
+        rule.connection_opened()
+        rule.connect_succeeded(0.002)
+    rule.connection_closed(0.2)
+    dns = {'entries': 1, 'hits': 2, 'stale_hits': 0, 'negative_hits': 0, 'misses': 1, 'coalesced': 0, 'hit_rate': 0.6667}
+    return {'rules': metrics.snapshot_all(), 'rejected_by_rule': {'web': rejected}, 'relay_tasks': connections,
+            'threads': 3, 'dns': dns}
+
+
+def test_merge_reports_sums_workers():
+    merged = merge_reports([_report(2, 1), _report(3, 0)])
+
+    stats = merged['rules']['web']
+    assert (stats['total_connections'], stats['active_connections']) == (5, 3)
+    assert stats['connect_time']['count'] == 5 and sum(stats['connect_time']['counts']) == 5
+    assert stats['session_duration']['count'] == 2
+    assert merged['rejected_by_rule'] == {'web': 1}
+    assert (merged['relay_tasks'], merged['threads'], merged['dns']['hits']) == (5, 6, 4)
+
+
+def test_merge_reports_without_workers():
+    merged = merge_reports([])
+
+    assert merged['rules'] == {} and merged['relay_tasks'] == 0
+    assert merged['dns']['entries'] == 0
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(predicate, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.1)
+    return predicate()
+
+
+@pytest.mark.skipif(not reuse_port_supported(), reason='当前平台不支持SO_REUSEPORT')
+def test_rule_status_aggregates_workers():
+    upstream = socket.socket()
+    upstream.bind(('127.0.0.1', 0))
+    upstream.listen(16)
+    upstream.settimeout(5)
+    local_port = _free_port()
+    forwarder = PortForwarder(workers=2)
+    try:
+        forwarder.add_rule(PortForwardRule('r', local_port, '127.0.0.1', upstream.getsockname()[1],
+                                           listen_address='127.0.0.1'))
+
+        def send() -> bool:
+            try:
+                with socket.create_connection(('127.0.0.1', local_port), timeout=1) as client:
+                    client.sendall(b'hello')
+                    peer, _ = upstream.accept()
+                    with peer:
+                        return peer.recv(5) == b'hello'
+            except OSError:
+                return False
+
+        # 等待工作进程开始监听
+        assert _wait_for(send)
+        for _ in range(4):
+            assert send()
+
+        # 工作进程异步更新统计，等待汇总结果
+        assert _wait_for(lambda: forwarder.get_rule_status('r')['total_connections'] == 5)
+        assert forwarder.get_rule_status('r')['bytes_in'] == 25
+        assert [s['total_connections'] for s in forwarder.get_all_status()] == [5]
+        assert forwarder.metrics.snapshot_all().get('r', {}).get('total_connections', 0) == 0
+    finally:
+        forwarder.stop_all()
+        upstream.close()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+UDP转发引擎模块
+按客户端地址建立NAT式会话：每个客户端在上游方向使用独立的已连接UDP套接字，上游的回包经监听套接字送回该客户端。
+所有UDP规则共用一个I/O线程，每次可读时最多连续收取一批数据报，减少select唤醒次数；
+会话表按最近活动排序，空闲超时和容量上限淘汰都从最久未活动的一端进行，内存占用有上界。
+"""
+
+import queue
+import socket
+import selectors
+import threading
+import time
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+from metrics import MetricsRegistry, BYTES_IN, BYTES_OUT
+from dual_stack import create_listener, format_address
+from dns_cache import DnsCache
+from access_log import AccessLogger, REASON_ABORTED, REASON_CLOSED, REASON_EVICTED, REASON_IDLE_TIMEOUT, REASON_RATE_LIMITED
+
+PROTOCOL_TCP = 'tcp'
+PROTOCOL_UDP = 'udp'
+PROTOCOLS = (PROTOCOL_TCP, PROTOCOL_UDP)
+
+# 单个数据报的最大长度
+MAX_DATAGRAM_SIZE = 65535
+# 每次可读事件最多连续收取的数据报数
+DEFAULT_BATCH_SIZE = 64
+# 规则未设置idle_timeout时会话的空闲超时（秒）
+DEFAULT_UDP_IDLE_TIMEOUT = 60.0
+# 规则未设置max_connections时每条规则的会话数上限
+DEFAULT_UDP_MAX_SESSIONS = 4096
+# 空闲会话的检查间隔（秒）
+SWEEP_INTERVAL = 1.0
+# 等待I/O线程执行命令的超时（秒）
+COMMAND_TIMEOUT = 10.0
+
+
+class UdpSession:
+    """一个客户端地址对应的会话"""
+
+    __slots__ = ('client_addr', 'target', 'sock', 'created', 'last_active', 'closed',
+                 'packets_in', 'packets_out', 'bytes_in', 'bytes_out')
+
+    def __init__(self, client_addr: Tuple, target, sock: socket.socket, now: float):
+        self.client_addr = client_addr
+        self.target = target
+        self.sock = sock
+        self.created = now
+        self.last_active = now
+        self.closed = False
+        self.packets_in = 0
+        self.packets_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def to_dict(self, now: float) -> dict:
+        """转换为字典"""
+        return {
+            'client': format_address(self.client_addr[0], self.client_addr[1]),
+            'target': str(self.target),
+            'age': round(now - self.created, 3),
+            'idle': round(now - self.last_active, 3),
+            'packets_in': self.packets_in,
+            'packets_out': self.packets_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out
+        }
+
+
+class UdpRuleState:
+    """单条UDP规则的监听套接字和会话表"""
+
+    def __init__(self, rule, sock: socket.socket, metrics):
+        self.rule = rule
+        self.sock = sock
+        self.metrics = metrics
+        # 客户端地址 -> 会话，按最近活动时间排序（最久未活动的在前）
+        self.sessions: 'OrderedDict[Tuple, UdpSession]' = OrderedDict()
+        self.idle_timeout = rule.idle_timeout or DEFAULT_UDP_IDLE_TIMEOUT
+        self.max_sessions = rule.max_connections or DEFAULT_UDP_MAX_SESSIONS
+        self.evicted_idle = 0
+        self.evicted_full = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def get_stats(self) -> dict:
+        """会话表统计"""
+        return {
+            'sessions': len(self.sessions),
+            'max_sessions': self.max_sessions,
+            'idle_timeout': self.idle_timeout,
+            'evicted_idle': self.evicted_idle,
+            'evicted_full': self.evicted_full,
+            'rejected': self.rejected,
+            'dropped': self.dropped
+        }
+
+
+class UdpForwardEngine:
+    """基于单个I/O线程和selectors的UDP转发引擎"""
+
+    def __init__(self, logger: logging.Logger, metrics: MetricsRegistry, batch_size: int = DEFAULT_BATCH_SIZE,
+                 reuse_port: bool = False, dns_cache: Optional[DnsCache] = None, access_log: Optional[AccessLogger] = None):
+        self.logger = logger
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.reuse_port = reuse_port
+        # 上游域名解析缓存，I/O线程不等待DNS
+        self.dns_cache = dns_cache or DnsCache(logger=logger)
+        # 会话结束时的访问记录
+        self.access_log = access_log
+        self.states: Dict[str, UdpRuleState] = {}
+        self.selector: Optional[selectors.BaseSelector] = None
+        self.thread: Optional[threading.Thread] = None
+        # 所有套接字共用的接收缓冲区（只在I/O线程中使用）
+        self.buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self.view = memoryview(self.buffer)
+        # 其他线程提交给I/O线程执行的命令
+        self._commands: 'queue.Queue[Tuple[Callable, threading.Event]]' = queue.Queue()
+        self._wakeup_reader: Optional[socket.socket] = None
+        self._wakeup_writer: Optional[socket.socket] = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """启动I/O线程（已启动时直接返回）"""
+        with self._lock:
+            if self.thread and self.thread.is_alive():
+                return
+
+            self.selector = selectors.DefaultSelector()
+            self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+            self._wakeup_reader.setblocking(False)
+            self.selector.register(self._wakeup_reader, selectors.EVENT_READ, None)
+            self._stopping.clear()
+            self.thread = threading.Thread(target=self._run, name='UdpForwardEngine')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _submit(self, command: Callable):
+        """在I/O线程中执行命令并等待完成"""
+        self.start()
+        done = threading.Event()
+        self._commands.put((command, done))
+        self._wakeup_writer.send(b'\0')
+        if not done.wait(COMMAND_TIMEOUT):
+            raise TimeoutError('UDP转发引擎未响应')
+
+    def start_rule(self, rule) -> bool:
+        """绑定监听套接字（失败时抛出异常）并开始转发"""
+        # 启用SO_REUSEPORT时内核按四元组在工作进程间分配数据报，同一客户端总是落在同一进程的会话表中
+        sock = create_listener(rule.listen_address, rule.local_port, socket.SOCK_DGRAM, reuse_port=self.reuse_port)
+        sock.setblocking(False)
+
+        state = UdpRuleState(rule, sock, self.metrics.get(rule.name))
+        self._submit(lambda: self._add_state(state))
+        return True
+
+    def stop_rule(self, rule) -> bool:
+        """关闭监听套接字和规则的所有会话"""
+        if rule.name in self.states:
+            self._submit(lambda: self._remove_state(rule.name))
+        return True
+
+    def shutdown(self):
+        """关闭所有规则并结束I/O线程"""
+        if not self.thread or not self.thread.is_alive():
+            return
+
+        for name in list(self.states.keys()):
+            self._submit(lambda name=name: self._remove_state(name))
+        self._stopping.set()
+        self._wakeup_writer.send(b'\0')
+        self.thread.join(timeout=5)
+        self.thread = None
+
+    def get_session_count(self, rule_name: str) -> int:
+        """获取规则当前的会话数"""
+        state = self.states.get(rule_name)
+        return len(state.sessions) if state else 0
+
+    def get_stats(self, rule_name: str) -> dict:
+        """获取规则的会话表统计"""
+        state = self.states.get(rule_name)
+        return state.get_stats() if state else {}
+
+    def get_sessions(self, rule_name: str, limit: int = 100) -> List[dict]:
+        """获取最近活动的会话及其计数（最多limit个）"""
+        state = self.states.get(rule_name)
+        if not state:
+            return []
+        now = time.monotonic()
+        # 会话表可能正被I/O线程修改，复制时遇到变化就重试
+        while True:
+            try:
+                sessions = list(state.sessions.values())
+                break
+            except RuntimeError:
+                continue
+        return [session.to_dict(now) for session in reversed(sessions[-limit:])]
+
+    def _add_state(self, state: UdpRuleState):
+        """登记规则（I/O线程）"""
+        self.states[state.rule.name] = state
+        self.selector.register(state.sock, selectors.EVENT_READ, (state, None))
+
+    def _remove_state(self, rule_name: str):
+        """移除规则并关闭其会话（I/O线程）"""
+        state = self.states.pop(rule_name, None)
+        if state is None:
+            return
+        self.selector.unregister(state.sock)
+        state.sock.close()
+        now = time.monotonic()
+        while state.sessions:
+            _, session = state.sessions.popitem(last=False)
+            self._close_session(state, session, now, REASON_ABORTED)
+
+    def _run(self):
+        """I/O线程"""
+        last_sweep = time.monotonic()
+        try:
+            while not self._stopping.is_set():
+                # 单次处理出错只记录日志，不结束整个I/O线程（否则所有UDP规则都会停止转发）
+                try:
+                    for key, _ in self.selector.select(SWEEP_INTERVAL):
+                        if key.data is None:
+                            self._run_commands()
+                            continue
+                        state, session = key.data
+                        if session is None:
+                            self._read_clients(state)
+                        elif not session.closed:
+                            self._read_upstream(state, session)
+
+                    now = time.monotonic()
+                    if now - last_sweep >= SWEEP_INTERVAL:
+                        last_sweep = now
+                        for state in list(self.states.values()):
+                            self._evict_idle(state, now)
+                except Exception as e:
+                    self.logger.error(f"UDP转发线程错误: {str(e)}")
+        finally:
+            self._run_commands()
+            self.selector.close()
+            self._wakeup_reader.close()
+            self._wakeup_writer.close()
+
+    def _run_commands(self):
+        """执行其他线程提交的命令"""
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+        while True:
+            try:
+                command, done = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                command()
+            except Exception as e:
+                self.logger.error(f"UDP转发命令执行失败: {str(e)}")
+            finally:
+                done.set()
+
+    def _read_clients(self, state: UdpRuleState):
+        """收取一批客户端数据报，按客户端地址查找或建立会话后发往上游"""
+        now = time.monotonic()
+        counters = state.metrics.shard().counters
+        sessions = state.sessions
+        for _ in range(self.batch_size):
+            try:
+                size, addr = state.sock.recvfrom_into(self.buffer)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                # Windows上发往客户端的数据报收到ICMP端口不可达时，下一次recvfrom会报告该错误
+                continue
+            except OSError:
+                break
+
+            session = sessions.get(addr)
+            if session is None:
+                session = self._open_session(state, addr, now)
+                if session is None:
+                    continue
+            else:
+                sessions.move_to_end(addr)
+
+            try:
+                session.sock.send(self.view[:size])
+            except OSError:
+                # 发送缓冲区满或上游不可达时丢弃，与UDP语义一致
+                state.dropped += 1
+                continue
+            session.last_active = now
+            session.packets_in += 1
+            session.bytes_in += size
+            counters[BYTES_IN] += size
+
+    def _read_upstream(self, state: UdpRuleState, session: UdpSession):
+        """收取一批上游回包并送回会话的客户端"""
+        now = time.monotonic()
+        counters = state.metrics.shard().counters
+        for _ in range(self.batch_size):
+            try:
+                size = session.sock.recv_into(self.buffer)
+            except BlockingIOError:
+                break
+            except OSError:
+                # 上游端口不可达（ICMP）等错误，会话保留到空闲超时
+                break
+
+            try:
+                state.sock.sendto(self.view[:size], session.client_addr)
+            except OSError:
+                state.dropped += 1
+                continue
+            session.last_active = now
+            session.packets_out += 1
+            session.bytes_out += size
+            counters[BYTES_OUT] += size
+
+        if not session.closed and session.client_addr in state.sessions:
+            state.sessions.move_to_end(session.client_addr)
+
+    def _open_session(self, state: UdpRuleState, addr: Tuple, now: float) -> Optional[UdpSession]:
+        """为新客户端建立会话，会话表已满时在新会话建立成功后淘汰最久未活动的会话"""
+        rule = state.rule
+        if rule.rate_limiter and not rule.rate_limiter.allow_connection(addr[0]):
+            state.rejected += 1
+            if self.access_log:
+                self.access_log.log(rule.name, addr, reason=REASON_RATE_LIMITED, protocol=PROTOCOL_UDP)
+            return None
+
+        target = rule.balancer.select(addr[0])
+        lookup = self.dns_cache.lookup(target.host, target.port, socket.SOCK_DGRAM)
+        if not lookup.done():
+            # 解析在后台进行，丢弃这个数据报，客户端重发时会话即可建立
+            state.dropped += 1
+            return None
+
+        sock = None
+        try:
+            # UDP没有握手，直接使用解析结果中的第一个地址
+            family, sockaddr = lookup.result()[0]
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            # 已连接的UDP套接字只接收该上游地址的回包
+            sock.connect(sockaddr)
+        except OSError as e:
+            if sock:
+                sock.close()
+            state.metrics.connect_failed()
+            state.dropped += 1
+            self.logger.error(f"UDP会话建立失败 {addr} -> {target.host}:{target.port}: {str(e)}")
+            return None
+
+        # 解析或连接失败时不淘汰现有会话
+        if len(state.sessions) >= state.max_sessions:
+            _, oldest = state.sessions.popitem(last=False)
+            self._close_session(state, oldest, now, REASON_EVICTED)
+            state.evicted_full += 1
+
+        rule.balancer.acquire(target)
+        session = UdpSession(addr, target, sock, now)
+        state.sessions[addr] = session
+        self.selector.register(sock, selectors.EVENT_READ, (state, session))
+        state.metrics.connection_opened()
+        return session
+
+    def _close_session(self, state: UdpRuleState, session: UdpSession, now: float, reason: str = REASON_CLOSED):
+        """关闭会话（调用方已将其移出会话表）并写访问记录"""
+        session.closed = True
+        try:
+            self.selector.unregister(session.sock)
+        except (KeyError, ValueError):
+            pass
+        session.sock.close()
+        state.rule.balancer.release(session.target)
+        state.metrics.connection_closed(now - session.created)
+        if self.access_log:
+            self.access_log.log(state.rule.name, session.client_addr, session.target, session.bytes_in,
+                                session.bytes_out, now - session.created, reason, protocol=PROTOCOL_UDP)
+
+    def _evict_idle(self, state: UdpRuleState, now: float):
+        """从最久未活动的一端淘汰空闲超时的会话"""
+        cutoff = now - state.idle_timeout
+        sessions = state.sessions
+        while sessions:
+            addr, session = next(iter(sessions.items()))
+            if session.last_active > cutoff:
+                break
+            del sessions[addr]
+            self._close_session(state, session, now, REASON_IDLE_TIMEOUT)
+            state.evicted_idle += 1
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游连接预热池模块
+为目标地址预先建立一定数量的TCP连接，新客户端到达时直接取用已就绪的连接，
+后台线程负责补充连接、淘汰空闲超时的连接，并在取用前检查连接是否仍然可用。
+"""
+
+import socket
+import threading
+import time
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+import dual_stack
+
+# 连接在池中的最长空闲时间（秒）
+DEFAULT_IDLE_TIMEOUT = 30.0
+# 预建连接的超时时间（秒）
+DEFAULT_CONNECT_TIMEOUT = 5.0
+# 后台维护间隔（秒）
+MAINTENANCE_INTERVAL = 1.0
+
+
+def is_socket_healthy(sock: socket.socket) -> bool:
+    """检查空闲连接是否仍可用：对端未关闭、没有挂起的错误或意外数据"""
+    # 非阻塞地窥探一个字节，不受select的FD_SETSIZE限制
+    timeout = sock.gettimeout()
+    try:
+        sock.setblocking(False)
+        # 空闲的上游连接可读只可能是对端关闭(EOF)、RST或服务端提前发送了数据，都不能复用
+        sock.recv(1, socket.MSG_PEEK)
+        return False
+    except BlockingIOError:
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+    except OSError:
+        return False
+    finally:
+        try:
+            sock.settimeout(timeout)
+        except OSError:
+            pass
+
+
+class UpstreamPool:
+    """单个上游地址的预热连接池"""
+
+    def __init__(self, host: str, port: int, size: int, idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, logger: Optional[logging.Logger] = None,
+                 resolver: Optional[Callable] = None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.logger = logger or logging.getLogger('PortForwarder')
+        self.resolver = resolver
+        # (套接字, 建立时间)
+        self.idle: Deque[Tuple[socket.socket, float]] = deque()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """启动后台补充线程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._refill_thread, name=f'UpstreamPool-{self.host}:{self.port}')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """停止后台线程并关闭池中所有连接"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=self.connect_timeout + 1)
+            self._thread = None
+        with self._lock:
+            idle = list(self.idle)
+            self.idle.clear()
+        for sock, _ in idle:
+            self._close(sock)
+
+    def acquire(self) -> Optional[socket.socket]:
+        """取出一个可用的预建连接，池为空时返回None（由调用方直接新建连接）"""
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self.idle:
+                    self.misses += 1
+                    self._wakeup.set()
+                    return None
+                sock, created = self.idle.popleft()
+
+            if now - created <= self.idle_timeout and is_socket_healthy(sock):
+                self.hits += 1
+                # 通知后台线程补充被取走的连接
+                self._wakeup.set()
+                sock.settimeout(None)
+                return sock
+
+            self.discarded += 1
+            self._close(sock)
+
+    def get_stats(self) -> dict:
+        """获取连接池统计"""
+        with self._lock:
+            idle = len(self.idle)
+        return {
+            'target': f'{self.host}:{self.port}',
+            'size': self.size,
+            'idle': idle,
+            'hits': self.hits,
+            'misses': self.misses,
+            'discarded': self.discarded
+        }
+
+    def _refill_thread(self):
+        """后台线程：淘汰过期/失效连接并补足到目标数量"""
+        while not self._stopping.is_set():
+            self._evict()
+
+            while not self._stopping.is_set():
+                with self._lock:
+                    if len(self.idle) >= self.size:
+                        break
+                sock = self._connect()
+                if sock is None:
+                    # 上游不可用时等待下一个维护周期再重试
+                    break
+                with self._lock:
+                    self.idle.append((sock, time.monotonic()))
+
+            self._wakeup.wait(MAINTENANCE_INTERVAL)
+            self._wakeup.clear()
+
+    def _evict(self):
+        """关闭空闲超时或已失效的连接"""
+        now = time.monotonic()
+        with self._lock:
+            idle = list(self.idle)
+            self.idle.clear()
+            for sock, created in idle:
+                if now - created <= self.idle_timeout and is_socket_healthy(sock):
+                    self.idle.append((sock, created))
+                else:
+                    self.discarded += 1
+                    self._close(sock)
+
+    def _connect(self) -> Optional[socket.socket]:
+        """建立一个上游连接"""
+        try:
+            return dual_stack.connect(self.host, self.port, self.connect_timeout, resolver=self.resolver)
+        except OSError as e:
+            self.logger.warning(f"预建上游连接失败 {self.host}:{self.port}: {str(e)}")
+            return None
+
+    @staticmethod
+    def _close(sock: socket.socket):
+        """关闭连接"""
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+
+class UpstreamPoolManager:
+    """按(规则, 上游地址)管理预热连接池"""
+
+    def __init__(self, logger: Optional[logging.Logger] = None, resolver: Optional[Callable] = None):
+        self.logger = logger
+        # 上游地址解析函数（PortForwarder传入解析缓存）
+        self.resolver = resolver
+        self.pools: Dict[Tuple[str, str, int], UpstreamPool] = {}
+        self._lock = threading.Lock()
+
+    def get_pool(self, rule, host: str, port: int) -> Optional[UpstreamPool]:
+        """获取规则到指定上游的连接池，规则未启用预热池时返回None"""
+        size = getattr(rule, 'pool_size', 0)
+        if not size:
+            return None
+
+        key = (rule.name, host, port)
+        pool = self.pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self.pools.get(key)
+                if pool is None:
+                    pool = UpstreamPool(host, port, size, rule.pool_idle_timeout,
+                                        getattr(rule, 'connect_timeout', DEFAULT_CONNECT_TIMEOUT) or DEFAULT_CONNECT_TIMEOUT,
+                                        logger=self.logger, resolver=self.resolver)
+                    pool.start()
+                    self.pools[key] = pool
+        return pool
+
+    def stop_rule(self, rule_name: str):
+        """关闭规则的所有连接池"""
+        with self._lock:
+            keys = [key for key in self.pools if key[0] == rule_name]
+            pools = [self.pools.pop(key) for key in keys]
+        for pool in pools:
+            pool.stop()
+
+    def stop_all(self):
+        """关闭所有连接池"""
+        with self._lock:
+            pools = list(self.pools.values())
+            self.pools.clear()
+        for pool in pools:
+            pool.stop()
+
+    def get_stats(self, rule_name: str) -> list:
+        """获取规则的连接池统计"""
+        return [pool.get_stats() for key, pool in list(self.pools.items()) if key[0] == rule_name]
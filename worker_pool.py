@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程转发模块
+启动N个工作进程，每个进程以SO_REUSEPORT绑定同一本地端口，由内核在进程间分配新连接；
+监督线程负责重启崩溃的工作进程，并把规则的启动/停止/删除同步到所有工作进程；
+指标导出时向各工作进程请求统计报告，经共享的回复队列汇总
+"""
+
+import queue
+import socket
+import sys
+import threading
+import time
+import logging
+import multiprocessing
+from typing import Dict, List, Optional
+from access_log import worker_log_path
+from metrics import merge_snapshots
+
+# 监督线程检查工作进程存活的间隔（秒）
+DEFAULT_CHECK_INTERVAL = 1.0
+# 等待工作进程回复指标报告的时间（秒），超时未回复的工作进程本次不计入
+DEFAULT_METRICS_TIMEOUT = 1.0
+# 指标报告中按工作进程求和的解析缓存统计
+DNS_COUNTERS = ('entries', 'hits', 'stale_hits', 'negative_hits', 'misses', 'coalesced')
+
+
+def reuse_port_supported() -> bool:
+    """当前平台是否支持SO_REUSEPORT负载分担"""
+    return hasattr(socket, 'SO_REUSEPORT') and sys.platform != 'win32'
+
+
+def merge_reports(reports: List[dict]) -> dict:
+    """汇总各工作进程的指标报告（格式同PortForwarder.get_metrics_report）"""
+    rule_snapshots: Dict[str, List[dict]] = {}
+    rejected_by_rule: Dict[str, int] = {}
+    for report in reports:
+        for rule_name, snapshot in report['rules'].items():
+            rule_snapshots.setdefault(rule_name, []).append(snapshot)
+        for rule_name, rejected in report['rejected_by_rule'].items():
+            rejected_by_rule[rule_name] = rejected_by_rule.get(rule_name, 0) + rejected
+    return {
+        'rules': {rule_name: merge_snapshots(snapshots) for rule_name, snapshots in rule_snapshots.items()},
+        'rejected_by_rule': rejected_by_rule,
+        'relay_tasks': sum(report['relay_tasks'] for report in reports),
+        'threads': sum(report['threads'] for report in reports),
+        'dns': {key: sum(report['dns'][key] for report in reports) for key in DNS_COUNTERS}
+    }
+
+
+def _worker_main(index: int, command_queue, reply_queue, options: dict):
+    """工作进程入口"""
+    # 在子进程中导入，避免与port_forwarder循环导入
+    from port_forwarder import PortForwarder, PortForwardRule
+
+    if options.get('access_log'):
+        options = dict(options, access_log=worker_log_path(options['access_log'], index))
+    forwarder = PortForwarder(reuse_port=True, **options)
+    forwarder.logger.info(f"工作进程 {index} 已启动")
+
+    while True:
+        command, payload = command_queue.get()
+        try:
+            if command == 'start':
+                if payload['name'] in forwarder.rules:
+                    forwarder.start_rule(payload['name'])
+                else:
+                    forwarder.add_rule(PortForwardRule.from_dict(payload))
+            elif command == 'stop':
+                rule_name, drain_timeout = payload
+                if drain_timeout is None:
+                    forwarder.stop_rule(rule_name)
+                else:
+                    forwarder.stop_rule(rule_name, graceful=True, drain_timeout=drain_timeout)
+            elif command == 'reload':
+                rule_name, rule_data, drain_timeout = payload
+                if rule_name in forwarder.rules:
+                    forwarder.reload_rule(rule_name, PortForwardRule.from_dict(rule_data), drain_timeout)
+                elif rule_data.get('enabled', True):
+                    forwarder.add_rule(PortForwardRule.from_dict(rule_data))
+            elif command == 'remove':
+                forwarder.remove_rule(payload)
+            elif command == 'metrics':
+                reply_queue.put((payload, forwarder.get_metrics_report()))
+            elif command == 'shutdown':
+                if payload is None:
+                    forwarder.stop_all()
+                else:
+                    forwarder.stop_all(graceful=True, drain_timeout=payload)
+                break
+        except Exception as e:
+            forwarder.logger.error(f"工作进程 {index} 执行命令 {command} 失败: {str(e)}")
+
+
+class WorkerSupervisor:
+    """工作进程监督器"""
+
+    def __init__(self, workers: int, options: dict, logger: logging.Logger,
+                 check_interval: float = DEFAULT_CHECK_INTERVAL):
+        self.workers = workers
+        # 传给工作进程中PortForwarder的构造参数
+        self.options = options
+        self.logger = logger
+        self.check_interval = check_interval
+        # spawn方式启动干净的解释器，避免在多线程进程中fork导致锁状态被继承
+        self.context = multiprocessing.get_context('spawn')
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.queues: List = [None] * workers
+        # 所有工作进程共用的指标回复队列: (请求序号, 报告)
+        self.replies = self.context.Queue()
+        self._request_id = 0
+        self._collect_lock = threading.Lock()
+        # 规则配置和运行状态，用于向重启后的工作进程重放
+        self.rules: Dict[str, dict] = {}
+        self.running: Dict[str, bool] = {}
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._monitor: Optional[threading.Thread] = None
+
+    def start(self):
+        """启动所有工作进程和监督线程"""
+        with self._lock:
+            if self._monitor and self._monitor.is_alive():
+                return
+
+            self._stopping.clear()
+            for index in range(self.workers):
+                self._spawn(index)
+
+            self._monitor = threading.Thread(target=self._monitor_thread, name='WorkerSupervisor')
+            self._monitor.daemon = True
+            self._monitor.start()
+
+    def _spawn(self, index: int):
+        """启动（或重启）指定序号的工作进程并重放规则"""
+        command_queue = self.context.Queue()
+        process = self.context.Process(
+            target=_worker_main,
+            args=(index, command_queue, self.replies, self.options),
+            name=f'PortForwarderWorker-{index}'
+        )
+        process.daemon = True
+        process.start()
+
+        self.processes[index] = process
+        self.queues[index] = command_queue
+
+        for name, rule_data in self.rules.items():
+            if self.running.get(name):
+                command_queue.put(('start', rule_data))
+
+    def _monitor_thread(self):
+        """监督线程：重启异常退出的工作进程"""
+        while not self._stopping.wait(self.check_interval):
+            with self._lock:
+                if self._stopping.is_set():
+                    break
+                for index, process in enumerate(self.processes):
+                    if process is not None and not process.is_alive():
+                        self.logger.warning(f"工作进程 {index} 已退出 (退出码: {process.exitcode})，正在重启")
+                        self.restarts += 1
+                        self._spawn(index)
+
+    def _broadcast(self, command: str, payload):
+        """向所有工作进程发送命令"""
+        for command_queue in self.queues:
+            if command_queue is not None:
+                command_queue.put((command, payload))
+
+    def start_rule(self, rule) -> bool:
+        """在所有工作进程中启动规则"""
+        self.start()
+        with self._lock:
+            rule_data = rule.to_dict()
+            self.rules[rule.name] = rule_data
+            self.running[rule.name] = True
+            self._broadcast('start', rule_data)
+        return True
+
+    def stop_rule(self, rule_name: str, drain_timeout: Optional[float] = None) -> bool:
+        """在所有工作进程中停止规则；指定drain_timeout时各工作进程先排空已建立的会话"""
+        with self._lock:
+            self.running[rule_name] = False
+            self._broadcast('stop', (rule_name, drain_timeout))
+        return True
+
+    def reload_rule(self, rule_name: str, rule, drain_timeout: float) -> bool:
+        """在所有工作进程中重载规则，各工作进程分别交接监听并排空旧会话"""
+        with self._lock:
+            rule_data = rule.to_dict()
+            self.rules.pop(rule_name, None)
+            self.running.pop(rule_name, None)
+            self.rules[rule.name] = rule_data
+            self.running[rule.name] = rule.enabled
+            self._broadcast('reload', (rule_name, rule_data, drain_timeout))
+        return True
+
+    def remove_rule(self, rule_name: str) -> bool:
+        """在所有工作进程中删除规则"""
+        with self._lock:
+            self.rules.pop(rule_name, None)
+            self.running.pop(rule_name, None)
+            self._broadcast('remove', rule_name)
+        return True
+
+    def collect_metrics(self, timeout: float = DEFAULT_METRICS_TIMEOUT) -> List[dict]:
+        """向所有工作进程请求指标报告，返回timeout内收到的报告；正在执行排空等耗时命令的工作进程本次缺席"""
+        with self._collect_lock:
+            with self._lock:
+                self._request_id += 1
+                request_id = self._request_id
+                expected = sum(1 for command_queue in self.queues if command_queue is not None)
+                self._broadcast('metrics', request_id)
+
+            reports = []
+            deadline = time.monotonic() + timeout
+            while len(reports) < expected:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    reply_id, report = self.replies.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                # 丢弃上一次请求超时后才到达的回复
+                if reply_id == request_id:
+                    reports.append(report)
+
+            if len(reports) < expected:
+                self.logger.warning(f"{expected - len(reports)} 个工作进程未及时回复指标报告")
+            return reports
+
+    def get_alive_count(self) -> int:
+        """获取存活的工作进程数"""
+        return sum(1 for process in self.processes if process is not None and process.is_alive())
+
+    def shutdown(self, timeout: float = 5, drain_timeout: Optional[float] = None):
+        """停止所有工作进程；指定drain_timeout时各工作进程先排空已建立的会话"""
+        if drain_timeout is not None:
+            timeout += drain_timeout
+        with self._lock:
+            self._stopping.set()
+            self._broadcast('shutdown', drain_timeout)
+            processes = [process for process in self.processes if process is not None]
+            self.processes = [None] * self.workers
+            self.queues = [None] * self.workers
+
+        for process in processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+        if self._monitor:
+            self._monitor.join(timeout)
+            self._monitor = None